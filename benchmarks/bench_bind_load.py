@@ -0,0 +1,94 @@
+"""
+Load a running gateway with concurrent clients, each one binding (and optionally searching the
+root DSE) in a loop on its own connection, and report the binds/sec and bind latency percentiles.
+
+Start the gateway (e.g. against the dummy static OTP backend) with and without `--workers`, then
+
+    python -m benchmarks.bench_bind_load --endpoint tcp:127.0.0.1:10389 --clients 50 --processes 4 \\
+        --dn cn=user,dc=example,dc=com --password password123456
+
+`--processes` spreads the clients over several load generator processes, so that a single
+client process doesn't become the bottleneck before the gateway does.
+"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import time
+
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap.ldapconnector import connectToLDAPEndpoint
+from twisted.internet import defer, task
+
+from ldap_otp_gateway.ldap_client import GatewayLDAPClient
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+@defer.inlineCallbacks
+def client_loop(reactor, args, deadline, latencies):
+    client = yield connectToLDAPEndpoint(reactor, args.endpoint, GatewayLDAPClient)
+    try:
+        while reactor.seconds() < deadline:
+            start = time.perf_counter()
+            response = yield client.send(pureldap.LDAPBindRequest(dn=args.dn.encode(), auth=args.password.encode()))
+            latencies.append(time.perf_counter() - start)
+            assert response.resultCode == 0, response
+            if args.search:
+                yield client.search_root_dse()
+    finally:
+        client.transport.loseConnection()
+
+
+@defer.inlineCallbacks
+def load(reactor, args):
+    latencies = []
+    deadline = reactor.seconds() + args.duration
+    yield defer.gatherResults([client_loop(reactor, args, deadline, latencies) for _ in range(args.clients)],
+                              consumeErrors=True)
+    if args.json:
+        print(json.dumps(latencies))
+    else:
+        report(args, latencies)
+
+
+def report(args, latencies):
+    print(f"{args.clients * args.processes} clients over {args.processes} process(es), {args.duration} s: "
+          f"{len(latencies) / args.duration:.0f} binds/s, "
+          f"p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms")
+
+
+def main(args):
+    if args.processes == 1:
+        task.react(load, [args])
+        return
+
+    # re-run this script as single process load generators, gathering the latencies they print
+    command = [sys.executable, '-m', 'benchmarks.bench_bind_load', '--processes', '1', '--json',
+               '--endpoint', args.endpoint, '--clients', str(args.clients), '--duration', str(args.duration),
+               '--dn', args.dn, '--password', args.password] + (['--search'] if args.search else [])
+    generators = [subprocess.Popen(command, stdout=subprocess.PIPE) for _ in range(args.processes)]
+    latencies = []
+    for generator in generators:
+        out, _ = generator.communicate()
+        latencies.extend(json.loads(out.splitlines()[-1]))
+    report(args, latencies)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint', default='tcp:127.0.0.1:10389', help='gateway endpoint, e.g. ssl:host:10636')
+    parser.add_argument('--dn', default='cn=user,dc=example,dc=com')
+    parser.add_argument('--password', default='password123456', help='password, followed by the OTP')
+    parser.add_argument('--clients', type=int, default=20, help='concurrent connections per process')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.0, help='in seconds')
+    parser.add_argument('--search', action='store_true', help='search the root DSE after every bind')
+    # print the raw latencies for the parent load generator, for internal use only
+    parser.add_argument('--json', action='store_true', help=argparse.SUPPRESS)
+    logging.disable(logging.ERROR)
+    main(parser.parse_args())
@@ -0,0 +1,140 @@
+"""
+Gateway memory per idle client connection: start the local fake LDAP directory in this process, run the gateway
+as a subprocess against it, open idle connections to its unsecure frontend, optionally binding once on each of
+them, and report the growth of the gateway resident memory (read from /proc, so Linux only) per connection, along
+with the backend connections the fake directory saw.
+
+    python -m benchmarks.bench_connection_memory --connections 5000
+    python -m benchmarks.bench_connection_memory --bind --env LDAP_GATEWAY_LAZY_BACKEND_CONNECTION=true
+    python -m benchmarks.bench_connection_memory --json > after.json
+
+Each connection takes a file descriptor in this process and one or two in the gateway, raise `ulimit -n`
+accordingly. Any other gateway setting can be given with `--env NAME=VALUE`.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+from ldaptor.protocols.ldap.ldapconnector import connectToLDAPEndpoint
+from twisted.internet import defer, task
+
+from benchmarks.bench_gateway import OTP, free_port, self_signed_certificate, wait_ready
+from ldap_otp_gateway.ldap_client import GatewayLDAPClient
+from tests.unit import fake_ldap_server
+
+
+def resident_memory(pid) -> int:
+    """
+    Resident memory of a process, in bytes, from /proc.
+    """
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f"No VmRSS in /proc/{pid}/status")
+
+
+@defer.inlineCallbacks
+def connect(reactor, endpoint, count, bind, concurrency=100):
+    """
+    Open `count` connections, `concurrency` at a time. Fires with the connected clients.
+    """
+    clients = []
+
+    @defer.inlineCallbacks
+    def open_connections(indexes):
+        for _ in indexes:
+            client = yield connectToLDAPEndpoint(reactor, endpoint, GatewayLDAPClient)
+            if bind:
+                yield client.simple_bind(fake_ldap_server.USER_DN.encode(),
+                                         (fake_ldap_server.USER_PASSWORD + OTP).encode())
+            clients.append(client)
+
+    indexes = iter(range(count))
+    yield defer.gatherResults([open_connections(indexes) for _ in range(concurrency)])
+    return clients
+
+
+@defer.inlineCallbacks
+def bench(reactor, args):
+    directory = tempfile.mkdtemp(prefix='bench_connection_memory_')
+    key_path, cert_path = self_signed_certificate(directory)
+
+    ldap_factory = fake_ldap_server.FakeLDAPServerFactory()
+    ldap_port = reactor.listenTCP(0, ldap_factory, interface='127.0.0.1', backlog=1024)
+
+    port = free_port()
+    env = dict(os.environ,
+               LDAP_HOST='127.0.0.1',
+               LDAP_PORT=str(ldap_port.getHost().port),
+               LDAP_GATEWAY_PORT=str(port),
+               LDAP_GATEWAY_SSL_PORT=str(free_port()),
+               LDAP_GATEWAY_SSL_KEY_PATH=key_path,
+               LDAP_GATEWAY_SSL_CERT_PATH=cert_path,
+               OTP_BACKEND_MODULE_NAME='ldap_otp_gateway.otp_backend.dummy_static',
+               OTP_STATIC_CODE=OTP,
+               LOG_LEVEL='WARNING')
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    log_path = os.path.join(directory, 'gateway.log')
+    with open(log_path, 'wb') as log:
+        gateway = subprocess.Popen([sys.executable, '-m', 'ldap_otp_gateway.run'], env=env, stdout=log,
+                                   stderr=subprocess.STDOUT)
+
+    clients = []
+    try:
+        endpoint = f'tcp:127.0.0.1:{port}'
+        yield wait_ready(reactor, endpoint, args.startup_timeout)
+        # warm the allocator and the lazily built structures up with a first batch, then measure the next one
+        clients += yield connect(reactor, endpoint, args.warmup, args.bind)
+        yield task.deferLater(reactor, args.settle, lambda: None)
+        before, backend_before = resident_memory(gateway.pid), ldap_factory.open_connections
+
+        clients += yield connect(reactor, endpoint, args.connections, args.bind)
+        yield task.deferLater(reactor, args.settle, lambda: None)
+        after, backend_after = resident_memory(gateway.pid), ldap_factory.open_connections
+    except Exception:
+        with open(log_path) as log:
+            sys.stderr.write(log.read())
+        raise
+    finally:
+        for client in clients:
+            client.transport.loseConnection()
+        gateway.terminate()
+        yield task.deferLater(reactor, 0, gateway.wait, args.startup_timeout)
+        yield ldap_port.stopListening()
+
+    report = {
+        'connections': args.connections,
+        'bind': args.bind,
+        'rss_before_bytes': before,
+        'rss_after_bytes': after,
+        'bytes_per_connection': (after - before) / args.connections,
+        'backend_connections_per_connection': (backend_after - backend_before) / args.connections,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{args.connections} idle connections{', bound once' if args.bind else ''}: "
+          f"{report['bytes_per_connection'] / 1024:.1f} KiB of gateway RSS per connection "
+          f"({before / 2 ** 20:.1f} MiB -> {after / 2 ** 20:.1f} MiB), "
+          f"{report['backend_connections_per_connection']:.2f} backend connection(s) per connection")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=5000, help='idle connections measured')
+    parser.add_argument('--warmup', type=int, default=500, help='idle connections opened before measuring')
+    parser.add_argument('--bind', action='store_true', help='bind once on every connection before idling')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='additional gateway environment variable, can be repeated')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds to wait before reading the memory')
+    parser.add_argument('--startup-timeout', type=float, default=30.0, help='in seconds')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    logging.disable(logging.ERROR)
+    task.react(bench, [parser.parse_args()])
@@ -0,0 +1,213 @@
+"""
+End-to-end gateway benchmark on equal terms: start the local fake LDAP directory (unsecure and SSL
+endpoints) and the fake RCDevs SOAP service in this process, run the gateway as a subprocess against
+them, then drive concurrent bind (and optionally search) clients against its unsecure and SSL frontends.
+
+Reports per frontend the binds/sec, the bind latency percentiles and the gateway CPU time per bind,
+summed over the gateway process and its workers (read from /proc, so Linux only).
+
+    python -m benchmarks.bench_gateway --clients 20 --processes 2 --duration 10
+    python -m benchmarks.bench_gateway --otp-backend rcdevs --otp-latency 0.005 --pool-size 20
+    python -m benchmarks.bench_gateway --workers 4 --frontend tcp --json > after.json
+
+Any other gateway setting can be given with `--env NAME=VALUE`.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+from ldaptor.protocols.ldap.ldapconnector import connectToLDAPEndpoint
+from twisted.internet import defer, ssl, task, utils
+
+from benchmarks.bench_bind_load import percentile
+from ldap_otp_gateway import certs
+from ldap_otp_gateway.ldap_client import GatewayLDAPClient
+from tests.unit import fake_ldap_server
+from tests.unit.otp_backend import fake_soap_server
+
+OTP = '123456'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def self_signed_certificate(directory) -> (str, str):
+    key_path, cert_path = os.path.join(directory, 'server.key.pem'), os.path.join(directory, 'server.crt.pem')
+    certs.generate(key_path, cert_path, common_name='127.0.0.1', days=1)
+    return key_path, cert_path
+
+
+def process_tree_cpu(pid) -> float:
+    """
+    User and system CPU seconds of a process and of its live descendants, from /proc.
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            # the command name may hold spaces, the fields after it are space separated
+            fields = f.read().rpartition(')')[2].split()
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            children = [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return 0.0
+    # utime and stime are the 14th and 15th fields, the first two being pid and (comm)
+    seconds = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return seconds + sum(process_tree_cpu(child) for child in children)
+
+
+@defer.inlineCallbacks
+def wait_ready(reactor, endpoint, timeout):
+    deadline = reactor.seconds() + timeout
+    while True:
+        try:
+            client = yield connectToLDAPEndpoint(reactor, endpoint, GatewayLDAPClient)
+        except Exception:
+            if reactor.seconds() > deadline:
+                raise
+            yield task.deferLater(reactor, 0.2, lambda: None)
+        else:
+            yield client.simple_bind(fake_ldap_server.USER_DN.encode(), (fake_ldap_server.USER_PASSWORD + OTP).encode())
+            client.transport.loseConnection()
+            return
+
+
+@defer.inlineCallbacks
+def load(args, endpoint):
+    """
+    Run the load generator processes against a frontend. Fires with the bind latencies.
+    """
+    command = ['-m', 'benchmarks.bench_bind_load', '--processes', '1', '--json',
+               '--endpoint', endpoint, '--clients', str(args.clients), '--duration', str(args.duration),
+               '--dn', fake_ldap_server.USER_DN, '--password', fake_ldap_server.USER_PASSWORD + OTP]
+    if args.search:
+        command.append('--search')
+    results = yield defer.gatherResults([
+        utils.getProcessOutputAndValue(sys.executable, command, env=os.environ, path=os.getcwd())
+        for _ in range(args.processes)])
+    latencies = []
+    for out, err, code in results:
+        if code != 0:
+            raise RuntimeError(f"Load generator failed ({code}): {err.decode()}")
+        latencies.extend(json.loads(out.splitlines()[-1]))
+    return latencies
+
+
+def gateway_environment(args, ldap_port, ldaps_port, soap_uri, key_path, cert_path, ports):
+    env = dict(os.environ,
+               LDAP_HOST='127.0.0.1',
+               LDAP_PORT=str(ldap_port),
+               LDAP_SSL_PORT=str(ldaps_port),
+               LDAP_GATEWAY_PORT=str(ports['tcp']),
+               LDAP_GATEWAY_SSL_PORT=str(ports['ssl']),
+               LDAP_GATEWAY_SSL_KEY_PATH=key_path,
+               LDAP_GATEWAY_SSL_CERT_PATH=cert_path,
+               LDAP_BACKEND_POOL_SIZE=str(args.pool_size),
+               LOG_LEVEL='WARNING')
+    if args.otp_backend == 'rcdevs':
+        protocol, _, rest = soap_uri.partition('://')
+        host_port, _, path = rest.partition('/')
+        host, _, port = host_port.partition(':')
+        env.update(OTP_BACKEND_MODULE_NAME='ldap_otp_gateway.otp_backend.rcdevs_soap',
+                   OTP_PROTOCOL=protocol, OTP_HOST=host, OTP_PORT=port, OTP_ENDPOINT=path)
+    else:
+        env.update(OTP_BACKEND_MODULE_NAME='ldap_otp_gateway.otp_backend.dummy_static', OTP_STATIC_CODE=OTP)
+    for item in args.env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    return env
+
+
+@defer.inlineCallbacks
+def bench(reactor, args):
+    directory = tempfile.mkdtemp(prefix='bench_gateway_')
+    key_path, cert_path = self_signed_certificate(directory)
+
+    ldap_factory = fake_ldap_server.FakeLDAPServerFactory(latency=args.ldap_latency)
+    ldap_port = reactor.listenTCP(0, ldap_factory, interface='127.0.0.1')
+    ldaps_port = reactor.listenSSL(0, ldap_factory, ssl.DefaultOpenSSLContextFactory(key_path, cert_path),
+                                   interface='127.0.0.1')
+    soap_site = fake_soap_server.FakeSoapSite(otp=OTP, latency=args.otp_latency)
+    soap_port, soap_uri = fake_soap_server.listen(soap_site)
+
+    ports = {'tcp': free_port(), 'ssl': free_port()}
+    env = gateway_environment(args, ldap_port.getHost().port, ldaps_port.getHost().port, soap_uri,
+                              key_path, cert_path, ports)
+    log_path = os.path.join(directory, 'gateway.log')
+    with open(log_path, 'wb') as log:
+        gateway = subprocess.Popen([sys.executable, '-m', 'ldap_otp_gateway.run', '--workers', str(args.workers)],
+                                   env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    report = {'workers': args.workers, 'otp_backend': args.otp_backend, 'pool_size': args.pool_size,
+              'clients': args.clients * args.processes, 'duration': args.duration, 'search': args.search,
+              'frontends': {}}
+    try:
+        for frontend in args.frontend:
+            endpoint = f'{frontend}:127.0.0.1:{ports[frontend]}'
+            yield wait_ready(reactor, endpoint, args.startup_timeout)
+            yield task.deferLater(reactor, args.warmup, lambda: None)
+
+            cpu = process_tree_cpu(gateway.pid)
+            latencies = yield load(args, endpoint)
+            cpu = process_tree_cpu(gateway.pid) - cpu
+
+            binds = len(latencies)
+            report['frontends'][frontend] = {
+                'binds': binds,
+                'binds_per_second': binds / args.duration,
+                'p50_ms': percentile(latencies, 50) * 1000 if binds else None,
+                'p99_ms': percentile(latencies, 99) * 1000 if binds else None,
+                'cpu_ms_per_bind': cpu / binds * 1000 if binds else None,
+            }
+    except Exception:
+        with open(log_path) as log:
+            sys.stderr.write(log.read())
+        raise
+    finally:
+        gateway.terminate()
+        yield task.deferLater(reactor, 0, gateway.wait, args.startup_timeout)
+        yield defer.gatherResults([defer.maybeDeferred(port.stopListening)
+                                   for port in (ldap_port, ldaps_port, soap_port)])
+        soap_site.cancel_delayed()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['clients']} clients, {args.duration} s, {args.workers} worker(s), "
+          f"{args.otp_backend} OTP backend, pool size {args.pool_size}{', with search' if args.search else ''}")
+    for frontend, result in report['frontends'].items():
+        if not result['binds']:
+            print(f"{frontend:>4}: no bind")
+            continue
+        print(f"{frontend:>4}: {result['binds_per_second']:.0f} binds/s, "
+              f"p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+              f"{result['cpu_ms_per_bind']:.3f} ms CPU/bind")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frontend', nargs='+', choices=['tcp', 'ssl'], default=['tcp', 'ssl'])
+    parser.add_argument('--clients', type=int, default=20, help='concurrent connections per load generator process')
+    parser.add_argument('--processes', type=int, default=1, help='load generator processes')
+    parser.add_argument('--duration', type=float, default=10.0, help='in seconds, per frontend')
+    parser.add_argument('--search', action='store_true', help='search the root DSE after every bind')
+    parser.add_argument('--workers', type=int, default=1, help='gateway --workers')
+    parser.add_argument('--pool-size', type=int, default=0, help='gateway LDAP_BACKEND_POOL_SIZE')
+    parser.add_argument('--otp-backend', choices=['static', 'rcdevs'], default='static',
+                        help='dummy static OTP backend, or RCDevs SOAP backend against the fake SOAP service')
+    parser.add_argument('--otp-latency', type=float, default=0.0, help='fake SOAP service latency, in seconds')
+    parser.add_argument('--ldap-latency', type=float, default=0.0, help='fake LDAP directory latency, in seconds')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='additional gateway environment variable, can be repeated')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds to wait once the gateway answers')
+    parser.add_argument('--startup-timeout', type=float, default=30.0, help='in seconds')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    logging.disable(logging.ERROR)
+    task.react(bench, [parser.parse_args()])
@@ -0,0 +1,60 @@
+"""
+Compare the lookup cost of the static user list gateway filter and of the DN index one,
+with a pass through list of `--entries` DNs (one percent of them being subtree rules for the DN index).
+
+    python -m benchmarks.bench_gateway_filter --entries 100000
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from unittest.mock import MagicMock
+
+from ldap_otp_gateway.gateway_filter import dn_index, ignore_static_user_list
+
+
+def bind_request(dn: str):
+    request = MagicMock()
+    request.dn = dn.encode()
+    return request
+
+
+def bench(name, gateway_filter, requests, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for request in requests:
+            gateway_filter.ignore(request)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>17}: {elapsed / (rounds * len(requests)) * 1e6:.2f} us per lookup")
+
+
+def main(args):
+    exact = [f'cn=svc{i},ou=apps,dc=example,dc=com' for i in range(args.entries - args.entries // 100)]
+    subtrees = [f'*,ou=team{i},ou=svc,dc=example,dc=com' for i in range(args.entries // 100)]
+    requests = [
+        bind_request(exact[len(exact) // 2]),                             # exact hit, middle of the list
+        bind_request('cn=app,ou=team7,ou=svc,dc=example,dc=com'),         # subtree hit
+        bind_request('cn=someone,ou=people,dc=example,dc=com'),           # miss
+    ]
+
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+        f.write('\n'.join(exact + subtrees))
+    try:
+        start = time.perf_counter()
+        indexed = dn_index.GatewayFilter(f.name, reload_interval=0)
+        print(f"DN index of {args.entries} entries built in {(time.perf_counter() - start) * 1000:.0f} ms")
+    finally:
+        os.remove(f.name)
+
+    # the static list has no subtree rule, only its exact lookups are comparable
+    bench('static user list', ignore_static_user_list.GatewayFilter(exact), requests, args.rounds)
+    bench('DN index', indexed, requests, args.rounds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=100)
+    logging.disable(logging.ERROR)
+    main(parser.parse_args())
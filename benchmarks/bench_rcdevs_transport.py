@@ -0,0 +1,53 @@
+"""
+Compare the RCDevs SOAP backend HTTP transports against the local fake SOAP server.
+
+The `requests` transport opens a new connection for every verification, while the `twisted`
+transport keeps persistent connections in its pool. The fake server charges `--connect-latency`
+on the first request of every connection, standing for the TCP/TLS handshake cost.
+
+    python -m benchmarks.bench_rcdevs_transport --verifications 200 --connect-latency 0.005
+"""
+import argparse
+import logging
+import time
+
+from twisted.internet import defer, task
+
+from ldap_otp_gateway.otp_backend.rcdevs_soap import OtpBackend
+from tests.unit.otp_backend.fake_soap_server import FakeSoapSite, listen
+
+
+@defer.inlineCallbacks
+def bench(reactor, transport, verifications, connect_latency, latency):
+    site = FakeSoapSite(otp='123456', latency=latency, connect_latency=connect_latency)
+    port, uri = listen(site)
+    backend = OtpBackend(uri=uri, transport=transport)
+    try:
+        start = time.perf_counter()
+        for _ in range(verifications):
+            access, error = yield backend.verify_async('user', 'password', '123456')
+            assert access, error
+        elapsed = time.perf_counter() - start
+    finally:
+        yield backend.close()
+        yield port.stopListening()
+
+    print(f"{transport:>8}: {verifications} verifications, {site.connections} connections, "
+          f"mean latency {elapsed / verifications * 1000:.2f} ms")
+
+
+@defer.inlineCallbacks
+def main(reactor, args):
+    for transport in ['requests', 'twisted']:
+        yield bench(reactor, transport, args.verifications, args.connect_latency, args.latency)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--verifications', type=int, default=200)
+    parser.add_argument('--connect-latency', type=float, default=0.005,
+                        help='latency added to the first request of each connection, in seconds')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='latency added to every request, in seconds')
+    logging.disable(logging.ERROR)
+    task.react(main, [parser.parse_args()])
@@ -0,0 +1,80 @@
+"""
+Compare the streaming openotpSimpleLoginResponse parser with the former double minidom parse.
+
+    python -m benchmarks.bench_soap_parser --number 20000
+"""
+import argparse
+import timeit
+from xml.dom import minidom
+
+from ldap_otp_gateway.otp_backend.rcdevs_soap import check_response, SimpleLoginResponseParser
+from tests.unit.otp_backend.fake_soap_server import RESPONSE_TEMPLATE
+
+SUCCESS = RESPONSE_TEMPLATE.format(code=1, message='Authentication success')
+FAILURE = RESPONSE_TEMPLATE.format(code=0, message='Wrong username or password')
+
+
+def remove_blanks(node):
+    for x in node.childNodes:
+        if x.nodeType == x.TEXT_NODE:
+            if x.nodeValue:
+                x.nodeValue = x.nodeValue.strip()
+        elif x.nodeType == x.ELEMENT_NODE:
+            remove_blanks(x)
+
+
+def normalize(xml_str) -> str:
+    xml = minidom.parseString(xml_str)
+    remove_blanks(xml)
+    xml.normalize()
+    return xml.toxml()
+
+
+def minidom_check_response(xml_str):
+    """
+    The former implementation: normalize (parse, strip, serialize), then parse again.
+    """
+    xml = minidom.parseString(normalize(xml_str))
+    response = xml.childNodes[0].childNodes[0].childNodes[0]
+    if len(response.childNodes) != 5:
+        raise Exception(f'Expected response size to be 5. Response was "{response.toxml()}')
+    code = response.childNodes[0]
+    if code.childNodes[0].data != '1':
+        raise Exception(f'Expected response code to be "1". Response was "{response.toxml()}')
+    return True, None
+
+
+def streaming_check_chunks(chunks):
+    parser = SimpleLoginResponseParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def run(name, statement, number):
+    elapsed = min(timeit.repeat(statement, number=number, repeat=3))
+    print(f"{name:<32} {elapsed / number * 1e6:8.2f} us/response")
+
+
+def failing(check):
+    def call(payload):
+        try:
+            check(payload)
+        except Exception:
+            pass
+    return call
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    encoded = SUCCESS.encode()
+    chunks = [encoded[i:i + 64] for i in range(0, len(encoded), 64)]
+
+    run('minidom success', lambda: minidom_check_response(SUCCESS), args.number)
+    run('streaming success', lambda: check_response(SUCCESS), args.number)
+    run('streaming success, 64B chunks', lambda: streaming_check_chunks(chunks), args.number)
+    run('minidom failure', lambda: failing(minidom_check_response)(FAILURE), args.number)
+    run('streaming failure', lambda: failing(check_response)(FAILURE), args.number)
@@ -0,0 +1,101 @@
+"""
+Gateway cold start benchmark: wall-clock time of fresh interpreters importing the configuration, printing
+the CLI help, and starting the gateway until its frontend accepts connections, with and without existing
+SSL certificates.
+
+    python -m benchmarks.bench_startup --rounds 5
+    python -m benchmarks.bench_startup --json > after.json
+
+Any other gateway setting can be given with `--env NAME=VALUE`.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_gateway import free_port
+
+
+def timed(command, env) -> float:
+    started_at = time.perf_counter()
+    subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started_at
+
+
+def accepting(port) -> bool:
+    try:
+        socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+        return True
+    except OSError:
+        return False
+
+
+def time_to_listen(env, timeout) -> float:
+    """
+    Seconds from the gateway process start until its unsecure frontend accepts connections.
+    """
+    port = int(env['LDAP_GATEWAY_PORT'])
+    started_at = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'ldap_otp_gateway.run'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while not accepting(port):
+            if process.poll() is not None:
+                raise RuntimeError(f"Gateway exited with code {process.returncode}")
+            if time.perf_counter() - started_at > timeout:
+                raise RuntimeError(f"Gateway not listening after {timeout} seconds")
+            time.sleep(0.005)
+        return time.perf_counter() - started_at
+    finally:
+        process.kill()
+        process.wait()
+
+
+def bench(args) -> dict:
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    env.update(item.split('=', 1) for item in args.env)
+    results = {name: [] for name in ('import_config', 'help', 'listen_with_certs', 'listen_without_certs')}
+    for _ in range(args.rounds):
+        with tempfile.TemporaryDirectory() as directory:
+            def certs_env(name):
+                return dict(env,
+                            LDAP_GATEWAY_PORT=str(free_port()),
+                            LDAP_GATEWAY_SSL_PORT=str(free_port()),
+                            LDAP_GATEWAY_SSL_KEY_PATH=os.path.join(directory, name, 'server.key.pem'),
+                            LDAP_GATEWAY_SSL_CERT_PATH=os.path.join(directory, name, 'server.crt.pem'))
+
+            # every step without certificates gets its own empty directory
+            results['import_config'].append(timed([sys.executable, '-c', 'import ldap_otp_gateway.config'],
+                                                  certs_env('import')))
+            results['help'].append(timed([sys.executable, '-m', 'ldap_otp_gateway.run', '--help'], certs_env('help')))
+            run_env = certs_env('run')
+            results['listen_without_certs'].append(time_to_listen(run_env, args.timeout))
+            results['listen_with_certs'].append(time_to_listen(run_env, args.timeout))
+    return {name: statistics.median(values) for name, values in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5, help='measures per step, the median is reported')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for the gateway to listen')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='additional gateway environment variable, can be repeated')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = bench(args)
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"median of {args.rounds} rounds")
+    for name, value in results.items():
+        print(f" {name}: {value * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
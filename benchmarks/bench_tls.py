@@ -0,0 +1,126 @@
+"""
+Server side CPU time of the SSL frontend TLS handshakes, full and resumed, with the ECDSA P-256 certificate
+generated by the gateway and with the RSA 4096 one it generated before. Both ends run in memory, only the
+server side is timed.
+
+    python -m benchmarks.bench_tls --number 200
+    python -m benchmarks.bench_tls --env LDAP_GATEWAY_TLS_MIN_VERSION=1.3
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from OpenSSL import SSL
+
+from ldap_otp_gateway import certs, metrics, tls
+from ldap_otp_gateway.config import Settings
+
+
+def generate_rsa(key_path, cert_path, bits=4096):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'localhost')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number()).not_valid_before(now)
+            .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256()))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+def pump(source, destination):
+    try:
+        data = source.bio_read(65536)
+    except SSL.WantReadError:
+        return False
+    destination.bio_write(data)
+    return True
+
+
+def handshake(server_context, client_context, session=None) -> (float, SSL.Session):
+    """
+    Server side seconds spent in a handshake, and the session the client can resume.
+    """
+    server = SSL.Connection(server_context)
+    server.set_accept_state()
+    client = SSL.Connection(client_context)
+    client.set_connect_state()
+    if session is not None:
+        client.set_session(session)
+
+    elapsed = 0.0
+    done = [False, False]
+    while not all(done):
+        for index, connection in enumerate((client, server)):
+            started_at = time.perf_counter()
+            try:
+                connection.do_handshake()
+                done[index] = True
+            except SSL.WantReadError:
+                pass
+            if connection is server:
+                elapsed += time.perf_counter() - started_at
+        pump(client, server)
+        pump(server, client)
+
+    # TLS 1.3 session tickets are sent after the handshake
+    client.send(b'\x00')
+    pump(client, server)
+    started_at = time.perf_counter()
+    server.recv(1)
+    elapsed += time.perf_counter() - started_at
+    pump(server, client)
+    try:
+        client.recv(1)
+    except SSL.WantReadError:
+        pass
+
+    # sessions of connections freed without a TLS shutdown are not resumable
+    client.shutdown()
+    pump(client, server)
+    started_at = time.perf_counter()
+    server.shutdown()
+    elapsed += time.perf_counter() - started_at
+    return elapsed, client.get_session()
+
+
+def bench(name, settings, number):
+    options = tls.build_options(settings)
+    server_context = options.getContext()
+    client_context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+
+    full = [handshake(server_context, client_context)[0] for _ in range(number)]
+    _, session = handshake(server_context, client_context)
+    resumed_before = metrics.TLS_HANDSHAKES_RESUMED.get()
+    resumed = [handshake(server_context, client_context, session)[0] for _ in range(number)]
+    ratio = (metrics.TLS_HANDSHAKES_RESUMED.get() - resumed_before) / number
+    print(f"{name:<10} full {sum(full) / number * 1e6:8.0f} us/handshake   "
+          f"resumed {sum(resumed) / number * 1e6:8.0f} us/handshake ({ratio:.0%} resumed)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200, help='handshakes per measure')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='additional gateway environment variable, can be repeated')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, generate in (('ECDSA', certs.generate), ('RSA 4096', generate_rsa)):
+            key_path, cert_path = os.path.join(directory, f'{name}.key'), os.path.join(directory, f'{name}.crt')
+            generate(key_path, cert_path)
+            environ = dict(os.environ, LDAP_GATEWAY_SSL_KEY_PATH=key_path, LDAP_GATEWAY_SSL_CERT_PATH=cert_path)
+            environ.update(item.split('=', 1) for item in args.env)
+            bench(name, Settings(environ), args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,10 @@
-from .otp_gateway import OtpGateway
+# the gateway protocol imports ldaptor and twisted, only loaded once used so that the CLI starts fast
+__all__ = ['OtpGateway', 'OtpGatewayFactory']
+
+
+def __getattr__(name):
+    if name in __all__:
+        from . import otp_gateway
+
+        return getattr(otp_gateway, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,173 @@
+"""
+Audit log of the bind decisions: who tried to bind from where, how the bind was handled, and what was answered.
+
+The gateway queues the records in memory, and a dedicated thread writes them in batches to the sink, a rotating
+JSON lines file or a PostgreSQL table, every `flush_interval` seconds or as soon as `batch_size` records are queued.
+Beyond `queue_size` queued records, the overflow policy applies:
+- drop_newest: the new records are dropped
+- drop_oldest: the oldest queued records are dropped
+- fail_closed: no record is dropped, but the new binds are answered `unavailable` until the queue has room again
+"""
+import logging
+import os
+from collections import deque
+
+from twisted.internet import defer, task, threads
+from twisted.python.threadpool import ThreadPool
+
+from .. import metrics
+from .base_audit_sink import BaseAuditSink
+
+logger = logging.getLogger(__name__)
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+FAIL_CLOSED = 'fail_closed'
+OVERFLOW_POLICIES = [DROP_NEWEST, DROP_OLDEST, FAIL_CLOSED]
+
+SINKS = ['jsonl', 'postgres']
+
+
+class AuditLog:
+    """
+    Bounded queue of audit records, written to `sink` in batches off the reactor thread. A batch failing to be
+    written is queued again, and retried with the next flush.
+    """
+
+    def __init__(self, sink: BaseAuditSink, queue_size=10000, batch_size=500, flush_interval=1.0,
+                 overflow=DROP_NEWEST, reactor=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'AUDIT_OVERFLOW must be one of {OVERFLOW_POLICIES}. found {overflow} instead')
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.sink = sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.reactor = reactor
+        self.queue = deque()
+        # whether a batch is being written, and the callers waiting for it
+        self.flushing = False
+        self.flush_waiters = []
+        # a single writer, keeping the records in order
+        self.threadpool = ThreadPool(1, 1, name='audit-writer')
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.clock = reactor
+        metrics.AUDIT_QUEUED.set_function(lambda: len(self.queue))
+
+    @property
+    def accepting(self) -> bool:
+        """
+        Whether new binds may be handled, always unless failing closed with a full queue.
+        """
+        return self.overflow != FAIL_CLOSED or len(self.queue) < self.queue_size
+
+    def start(self):
+        self.threadpool.start()
+        self.flusher.start(self.flush_interval, now=False)
+
+    def stop(self) -> defer.Deferred:
+        """
+        Write the queued records, then release the sink.
+        """
+        if self.flusher.running:
+            self.flusher.stop()
+        d = self.drain()
+        d.addCallback(lambda _: threads.deferToThreadPool(self.reactor, self.threadpool, self.sink.close))
+        d.addErrback(lambda failure: logger.error(f"Failed to close the audit sink: {failure.value}"))
+        d.addBoth(lambda _: self.threadpool.stop())
+        return d
+
+    def record(self, record: dict):
+        # failing closed, the binds in flight when the queue got full are still recorded
+        if len(self.queue) >= self.queue_size and self.overflow != FAIL_CLOSED:
+            metrics.AUDIT_RECORDS_DROPPED.inc()
+            if self.overflow == DROP_NEWEST:
+                return
+            self.queue.popleft()
+        self.queue.append(record)
+        if len(self.queue) == self.batch_size:
+            self.flush()
+
+    def flush(self) -> defer.Deferred:
+        """
+        Write the next batch of queued records, unless one is being written already.
+        """
+        if self.flushing or not self.queue:
+            return defer.succeed(None)
+        batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+        self.flushing = True
+        d = threads.deferToThreadPool(self.reactor, self.threadpool, self.sink.write, batch)
+        d.addCallbacks(self.written, self.failed, callbackArgs=(batch,), errbackArgs=(batch,))
+        return d
+
+    def written(self, _, batch):
+        metrics.AUDIT_RECORDS_WRITTEN.inc(len(batch))
+        self.flushed()
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+
+    def failed(self, failure, batch):
+        metrics.AUDIT_RECORDS_RETRIED.inc(len(batch))
+        logger.error(f"Failed to write {len(batch)} audit records, retrying: {failure.value}")
+        self.queue.extendleft(reversed(batch))
+        self.flushed()
+
+    def flushed(self):
+        self.flushing = False
+        waiters, self.flush_waiters = self.flush_waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def drain(self) -> defer.Deferred:
+        """
+        Fires once every queued record is written, or a batch failed to be.
+        """
+        if self.flushing:
+            waiter = defer.Deferred()
+            self.flush_waiters.append(waiter)
+            waiter.addCallback(lambda _: self.drain())
+            return waiter
+        if not self.queue:
+            return defer.succeed(None)
+        queued = len(self.queue)
+        d = self.flush()
+        d.addCallback(lambda _: self.drain() if len(self.queue) < queued else None)
+        return d
+
+
+def worker_path(path, worker_index) -> str:
+    """
+    Path of the audit file of a worker process, e.g. `audit.1.jsonl` for `audit.jsonl`, the workers not sharing
+    their files.
+    """
+    root, extension = os.path.splitext(path)
+    return f'{root}.{worker_index}{extension}'
+
+
+def build_audit_log(settings, worker_index=None) -> AuditLog or None:
+    """
+    Audit log from the AUDIT_* settings, None when AUDIT_SINK is empty. With `worker_index`, the JSON lines file
+    is the one of the worker.
+    """
+    if not settings.AUDIT_SINK:
+        return None
+    if settings.AUDIT_SINK == 'jsonl':
+        from .jsonl import JsonLinesSink
+
+        path = settings.AUDIT_FILE_PATH if worker_index is None else worker_path(settings.AUDIT_FILE_PATH,
+                                                                                 worker_index)
+        logger.info(f"- auditing the binds to {path}")
+        sink = JsonLinesSink(path, max_bytes=settings.AUDIT_FILE_MAX_BYTES,
+                             backup_count=settings.AUDIT_FILE_BACKUP_COUNT)
+    elif settings.AUDIT_SINK == 'postgres':
+        from .postgres import PostgresSink
+
+        logger.info(f"- auditing the binds to the {settings.AUDIT_PG_TABLE} PostgreSQL table")
+        sink = PostgresSink(settings.AUDIT_PG_DSN, table=settings.AUDIT_PG_TABLE)
+    else:
+        raise ValueError(f'AUDIT_SINK must be one of {SINKS}. found {settings.AUDIT_SINK} instead')
+    return AuditLog(sink, queue_size=settings.AUDIT_QUEUE_SIZE, batch_size=settings.AUDIT_BATCH_SIZE,
+                    flush_interval=settings.AUDIT_FLUSH_INTERVAL, overflow=settings.AUDIT_OVERFLOW)
@@ -0,0 +1,16 @@
+class BaseAuditSink:
+    """
+    Destination of the audit records, written in batches from the audit writer thread: the methods may block.
+    """
+
+    def write(self, records: list):
+        """
+        Durably write a batch of audit records, dicts as built by the gateway. Raising makes the batch retried
+        with the next flush.
+        """
+        raise NotImplementedError("Not implemented")
+
+    def close(self):
+        """
+        Release the resources of the sink once the last batch is written.
+        """
@@ -0,0 +1,63 @@
+import datetime
+import json
+import os
+
+from .base_audit_sink import BaseAuditSink
+
+
+def as_json(record: dict) -> dict:
+    return dict(record, time=datetime.datetime.fromtimestamp(record['time'], datetime.timezone.utc).isoformat())
+
+
+class JsonLinesSink(BaseAuditSink):
+    """
+    Audit records appended as JSON lines to `path`, synced to disk after every batch. Once the file exceeds
+    `max_bytes`, it is renamed `<path>.1`, the former `<path>.1` to `<path>.2`, and so on up to `backup_count`
+    files, the oldest being deleted. A `max_bytes` of 0 disables the rotation.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=10):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        # the directory entry of a new file must be durable too
+        self.sync_directory()
+
+    def sync_directory(self):
+        fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        if self.backup_count > 0:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = f'{self.path}.{index}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.path}.{index + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, records: list):
+        if self.file is None:
+            self.open()
+        self.file.write(b''.join(json.dumps(as_json(record), separators=(',', ':')).encode() + b'\n'
+                                 for record in records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if 0 < self.max_bytes <= self.file.tell():
+            self.rotate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,73 @@
+"""
+PostgreSQL audit sink, copying the records to a table of the following schema:
+
+    CREATE TABLE ldap_otp_gateway_audit (
+        time timestamptz NOT NULL,
+        dn text NOT NULL,
+        peer text,
+        mode text NOT NULL,
+        result_code integer NOT NULL,
+        message text,
+        otp text,
+        timings jsonb NOT NULL
+    );
+"""
+import datetime
+import json
+import logging
+
+from .base_audit_sink import BaseAuditSink
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('time', 'dn', 'peer', 'mode', 'result_code', 'message', 'otp', 'timings')
+
+
+def as_row(record: dict) -> tuple:
+    return (datetime.datetime.fromtimestamp(record['time'], datetime.timezone.utc), record['dn'], record['peer'],
+            record['mode'], record['result_code'], record['message'], record['otp'], json.dumps(record['timings']))
+
+
+class PostgresSink(BaseAuditSink):
+    """
+    Audit records copied to `table` in a transaction per batch, with `COPY ... FROM STDIN`. The connection is
+    opened on the first batch, and opened again on the next one after a failure.
+    """
+
+    def __init__(self, dsn, table='ldap_otp_gateway_audit', connect=None):
+        if not dsn:
+            raise ValueError('AUDIT_PG_DSN is required by the PostgreSQL audit sink')
+        if connect is None:
+            import psycopg
+
+            connect = psycopg.connect
+        self.dsn = dsn
+        self.table = table
+        self.connect = connect
+        self.connection = None
+
+    def copy_statement(self):
+        from psycopg import sql
+
+        return sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(*self.table.split('.')), sql.SQL(', ').join(map(sql.Identifier, COLUMNS)))
+
+    def write(self, records: list):
+        if self.connection is None or self.connection.closed:
+            self.connection = self.connect(self.dsn)
+        try:
+            with self.connection.cursor() as cursor, cursor.copy(self.copy_statement()) as copy:
+                for record in records:
+                    copy.write_row(as_row(record))
+            self.connection.commit()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception as e:
+                logger.warning(f"Failed to close the audit database connection: {e}")
+            self.connection = None
@@ -0,0 +1,235 @@
+import logging
+from collections import deque
+
+from twisted.internet import defer, task
+
+from .ldap_client import GatewayLDAPClient
+
+logger = logging.getLogger(__name__)
+
+# What to do with a connection on which the frontend client did bind, once released:
+# - anonymous: reset its identity with an anonymous bind, then reuse it
+# - service: re-bind it with the configured service identity, then reuse it
+# - close: close it, a bound connection only ever serves a single frontend client
+BIND_POLICIES = ['anonymous', 'service', 'close']
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class PooledConnection:
+    __slots__ = ('client', 'created_at', 'released_at')
+
+    def __init__(self, client, created_at):
+        self.client = client
+        self.created_at = created_at
+        self.released_at = created_at
+
+
+class LDAPClientPool:
+    """
+    Bounded pool of warm connections to one backend LDAP endpoint.
+
+    A connection is checked out for the whole life of a frontend connection, so the requests
+    of a frontend client are never interleaved with another client's ones. Once released, a
+    connection on which the frontend client did bind gets its identity reset according to the
+    bind policy before being reused. Idle connections are health checked with a root DSE search,
+    and closed once idle for `idle_timeout` seconds or older than `max_lifetime` seconds.
+    """
+
+    def __init__(self, connector, max_size=10, idle_timeout=300.0, max_lifetime=3600.0,
+                 health_check_interval=30.0, acquire_timeout=10.0, bind_policy='anonymous',
+                 bind_dn=None, bind_password=None, name='', reactor=None):
+        if bind_policy not in BIND_POLICIES:
+            raise ValueError(f'bind policy must be one of {BIND_POLICIES}. found {bind_policy} instead')
+        if bind_policy == 'service' and not bind_dn:
+            raise ValueError('a bind DN is required by the service bind policy')
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.connector = connector
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.bind_policy = bind_policy
+        self.bind_dn = (bind_dn or '').encode()
+        self.bind_password = (bind_password or '').encode()
+        self.name = name
+        self.reactor = reactor
+
+        # every open or opening connection, checked out or not
+        self.size = 0
+        self.connections = {}
+        # idle connections, most recently released last
+        self.idle = deque()
+        self.waiters = deque()
+        self.sweeper = None
+
+    def start(self):
+        if self.health_check_interval > 0:
+            self.sweeper = task.LoopingCall(self.sweep)
+            self.sweeper.clock = self.reactor
+            self.sweeper.start(self.health_check_interval, now=False)
+
+    def stop(self):
+        if self.sweeper is not None and self.sweeper.running:
+            self.sweeper.stop()
+        while self.idle:
+            self.idle.pop().client.transport.loseConnection()
+
+    def acquire(self) -> defer.Deferred:
+        """
+        Check a connection out. Fires with a connected GatewayLDAPClient.
+        """
+        while self.idle:
+            connection = self.idle.pop()
+            if self.expired(connection):
+                self.close(connection)
+                continue
+            return defer.succeed(connection.client)
+
+        if self.size < self.max_size:
+            return self.connect()
+
+        waiter = defer.Deferred()
+        waiter.addTimeout(self.acquire_timeout, self.reactor, onTimeoutCancel=self.acquire_timed_out)
+        waiter.addBoth(self.forget_waiter, waiter)
+        self.waiters.append(waiter)
+        return waiter
+
+    def acquire_timed_out(self, result, timeout):
+        logger.warning(f"LDAP backend pool {self.name}: no connection available within {timeout} seconds")
+        raise PoolExhausted(f'No backend LDAP connection available within {timeout} seconds')
+
+    def forget_waiter(self, result, waiter):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+        return result
+
+    def connect(self) -> defer.Deferred:
+        self.size += 1
+        d = self.connector()
+
+        def connected(client):
+            assert isinstance(client, GatewayLDAPClient)
+            connection = PooledConnection(client, self.reactor.seconds())
+            self.connections[client] = connection
+            client.notify_connection_lost(self.lost)
+            logger.debug(f"LDAP backend pool {self.name}: new connection, size={self.size}")
+            return client
+
+        def failed(failure):
+            self.size -= 1
+            self.serve_waiters()
+            return failure
+
+        d.addCallbacks(connected, failed)
+        return d
+
+    def release(self, client, bound=False) -> defer.Deferred:
+        """
+        Check a connection back in. `bound` tells whether the frontend client did bind on it.
+        Fires once the connection is either available again or closed.
+        """
+        connection = self.connections.get(client)
+        if connection is None:
+            return defer.succeed(None)
+        if not client.connected or client.busy or self.expired(connection):
+            # requests still on the wire would have their responses delivered to nobody
+            self.close(connection)
+            return defer.succeed(None)
+
+        if not bound:
+            self.check_in(connection)
+            return defer.succeed(None)
+        if self.bind_policy == 'close':
+            self.close(connection)
+            return defer.succeed(None)
+
+        dn, password = (b'', b'') if self.bind_policy == 'anonymous' else (self.bind_dn, self.bind_password)
+        d = client.simple_bind(dn, password)
+        d.addCallback(lambda _: self.check_in(connection))
+        d.addErrback(self.reset_failed, connection)
+        return d
+
+    def reset_failed(self, failure, connection):
+        logger.warning(f"LDAP backend pool {self.name}: failed to reset connection identity: {failure.value}")
+        self.close(connection)
+
+    def check_in(self, connection):
+        if not connection.client.connected:
+            return
+        connection.released_at = self.reactor.seconds()
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.called:
+                waiter.callback(connection.client)
+                return
+        self.idle.append(connection)
+
+    def close(self, connection):
+        if connection in self.idle:
+            self.idle.remove(connection)
+        if connection.client.connected:
+            connection.client.transport.loseConnection()
+        else:
+            self.lost(connection.client)
+
+    def lost(self, client):
+        connection = self.connections.pop(client, None)
+        if connection is None:
+            return
+        self.size -= 1
+        if connection in self.idle:
+            self.idle.remove(connection)
+        logger.debug(f"LDAP backend pool {self.name}: connection closed, size={self.size}")
+        self.serve_waiters()
+
+    def serve_waiters(self):
+        while self.waiters and self.size < self.max_size:
+            waiter = self.waiters.popleft()
+            if not waiter.called:
+                self.connect().addCallbacks(self.serve_waiter, self.fail_waiter,
+                                            callbackArgs=(waiter,), errbackArgs=(waiter,))
+
+    def serve_waiter(self, client, waiter):
+        if waiter.called:
+            # timed out while connecting, keep the connection for the next one
+            self.check_in(self.connections[client])
+        else:
+            waiter.callback(client)
+
+    def fail_waiter(self, failure, waiter):
+        if not waiter.called:
+            waiter.errback(failure)
+
+    def expired(self, connection) -> bool:
+        return self.max_lifetime > 0 and self.reactor.seconds() - connection.created_at > self.max_lifetime
+
+    def sweep(self):
+        """
+        Close the expired and idle for too long connections, and health check the others.
+        """
+        now = self.reactor.seconds()
+        for connection in list(self.idle):
+            if self.expired(connection) or (0 < self.idle_timeout < now - connection.released_at):
+                self.close(connection)
+            else:
+                # taken out of the idle list while being checked
+                self.idle.remove(connection)
+                d = connection.client.search_root_dse()
+                d.addTimeout(self.health_check_interval, self.reactor)
+                d.addCallbacks(self.healthy, self.unhealthy, callbackArgs=(connection,), errbackArgs=(connection,))
+
+    def healthy(self, result, connection):
+        released_at = connection.released_at
+        self.check_in(connection)
+        # a health check doesn't count as a use
+        connection.released_at = released_at
+
+    def unhealthy(self, failure, connection):
+        logger.warning(f"LDAP backend pool {self.name}: health check failed: {failure.value}")
+        self.close(connection)
@@ -0,0 +1,94 @@
+"""
+Just enough BER to relay LDAP messages without decoding them: read the envelope of an LDAPMessage
+(message ID and protocol operation tag) and re-encode it with another message ID, the operation
+and controls being copied as is.
+
+    LDAPMessage ::= SEQUENCE {
+         messageID       MessageID,
+         protocolOp      CHOICE { ... },
+         controls       [0] Controls OPTIONAL }
+"""
+from ldaptor.protocols import pureber
+
+SEQUENCE_TAG = 0x30
+INTEGER_TAG = 0x02
+
+# protocol operation tags
+BIND_REQUEST_TAG = 0x60
+UNBIND_REQUEST_TAG = 0x42
+SEARCH_REQUEST_TAG = 0x63
+SEARCH_RESULT_ENTRY_TAG = 0x64
+SEARCH_RESULT_DONE_TAG = 0x65
+MODIFY_REQUEST_TAG = 0x66
+ADD_REQUEST_TAG = 0x68
+DEL_REQUEST_TAG = 0x4a
+MODIFY_DN_REQUEST_TAG = 0x6c
+COMPARE_REQUEST_TAG = 0x6e
+ABANDON_REQUEST_TAG = 0x50
+SEARCH_RESULT_REFERENCE_TAG = 0x73
+EXTENDED_REQUEST_TAG = 0x77
+INTERMEDIATE_RESPONSE_TAG = 0x79
+
+# requests the gateway never looks into, each answered by one or more responses
+RELAYABLE_REQUEST_TAGS = frozenset([SEARCH_REQUEST_TAG, MODIFY_REQUEST_TAG, ADD_REQUEST_TAG, DEL_REQUEST_TAG,
+                                    MODIFY_DN_REQUEST_TAG, COMPARE_REQUEST_TAG])
+# requests relayed when the search results are cached, the searches and writes being handled by the proxy to use
+# and invalidate the cache
+UNCACHED_RELAYABLE_REQUEST_TAGS = frozenset([COMPARE_REQUEST_TAG])
+# responses followed by others for the same request
+INTERMEDIATE_RESPONSE_TAGS = frozenset([SEARCH_RESULT_ENTRY_TAG, SEARCH_RESULT_REFERENCE_TAG,
+                                        INTERMEDIATE_RESPONSE_TAG])
+
+
+def read_length(buffer, offset) -> (int, int) or None:
+    """
+    Length at `offset`, and the offset following it. None if the buffer doesn't hold it fully.
+    """
+    if offset >= len(buffer):
+        return None
+    first = buffer[offset]
+    if not first & 0x80:
+        return first, offset + 1
+    size = first & 0x7f
+    if offset + 1 + size > len(buffer):
+        return None
+    return int.from_bytes(buffer[offset + 1:offset + 1 + size], 'big'), offset + 1 + size
+
+
+def peek_message(buffer, offset=0) -> (int, int, int, int) or None:
+    """
+    Envelope of the LDAPMessage starting at `offset`: its message ID, the tag of its protocol operation,
+    the offset of the protocol operation and the offset following the message.
+    None if the buffer doesn't hold the whole message yet. Raises ValueError if it isn't an LDAPMessage.
+    """
+    if offset >= len(buffer):
+        return None
+    if buffer[offset] != SEQUENCE_TAG:
+        raise ValueError(f'LDAPMessage expected, found tag {buffer[offset]:#x}')
+    length = read_length(buffer, offset + 1)
+    if length is None:
+        return None
+    length, content = length
+    end = content + length
+    if end > len(buffer):
+        return None
+
+    if buffer[content] != INTEGER_TAG:
+        raise ValueError(f'LDAPMessage ID expected, found tag {buffer[content]:#x}')
+    id_length, id_offset = read_length(buffer, content + 1)
+    operation = id_offset + id_length
+    if operation >= end:
+        raise ValueError('LDAPMessage without protocol operation')
+    message_id = int.from_bytes(buffer[id_offset:operation], 'big', signed=True)
+    return message_id, buffer[operation], operation, end
+
+
+def with_message_id(buffer, operation, end, message_id) -> bytes:
+    """
+    LDAPMessage of the given ID, with the protocol operation and controls found between `operation` and `end`.
+    """
+    content_length = end - operation
+    encoded_id = pureber.int2ber(message_id)
+    length = 2 + len(encoded_id) + content_length
+    return b''.join([bytes((SEQUENCE_TAG,)), pureber.int2berlen(length),
+                     bytes((INTEGER_TAG, len(encoded_id))), encoded_id, buffer[operation:end]])
@@ -0,0 +1,64 @@
+"""
+Self signed certificate of the SSL frontend, generated by `ldap-otp-gateway gen-certs` or on startup when
+neither the key nor the certificate file exists. ECDSA P-256 keys are generated in milliseconds, where the RSA
+4096 bits keys generated before took seconds on small containers.
+"""
+import datetime
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def check(key_path, cert_path) -> bool:
+    """
+    Whether both files exist. Raises an exception if only one of them does.
+    """
+    key_exists, cert_exists = os.path.exists(key_path), os.path.exists(cert_path)
+    if key_exists and not cert_exists:
+        raise Exception("SSL cert path doesn't exists but a key file was provided. Please provide none or both")
+    if cert_exists and not key_exists:
+        raise Exception("SSL cert path exists but a key file don't. Please provide none or both")
+    return key_exists
+
+
+def generate(key_path, cert_path, common_name='localhost', days=10 * 365):
+    """
+    Write a new ECDSA P-256 private key and its self signed certificate, valid for `days` days.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + datetime.timedelta(days=days))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(common_name)]), critical=False)
+            .sign(key, hashes.SHA256()))
+
+    for path in (key_path, cert_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the private key is only readable by its owner
+    with open(os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(cert_path, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    logger.info(f"Generated self signed certificate {cert_path} for {common_name}")
+
+
+def ensure(key_path, cert_path):
+    """
+    Generate a self signed certificate unless both files exist.
+    """
+    if not check(key_path, cert_path):
+        logger.info("SSL cert and key files not found. Generating it ...")
+        generate(key_path, cert_path)
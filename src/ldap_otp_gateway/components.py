@@ -0,0 +1,104 @@
+import logging
+
+from twisted.internet import defer
+
+from .gateway_filter.base_gateway_filter import BaseGatewayFilter
+from .otp_backend.base_otp_backend import BaseOtpBackend
+from .otp_extractor.base_otp_extractor import BaseOTPExtractor
+
+logger = logging.getLogger(__name__)
+
+
+class Components:
+    """
+    The OTP backend, OTP extractor and gateway filter used together by the gateway, replaced as a whole by a
+    configuration reload. A bind holds the components it started with until it is answered, and replaced
+    components are closed once their last bind is answered.
+    """
+
+    def __init__(self, otp_backend, otp_extractor, gateway_filter=None):
+        assert otp_backend is not None and isinstance(otp_backend, BaseOtpBackend)
+        assert otp_extractor is not None and isinstance(otp_extractor, BaseOTPExtractor)
+        assert gateway_filter is None or isinstance(gateway_filter, BaseGatewayFilter)
+
+        self.otp_backend = otp_backend
+        self.otp_extractor = otp_extractor
+        self.gateway_filter = gateway_filter
+        # binds started with these components and not answered yet
+        self.in_flight = 0
+        # fires once idle after being replaced
+        self.idle = None
+
+    def start(self):
+        self.otp_backend.start()
+
+    def acquire(self) -> 'Components':
+        self.in_flight += 1
+        return self
+
+    def release(self):
+        self.in_flight -= 1
+        if self.in_flight == 0 and self.idle is not None and not self.idle.called:
+            self.idle.callback(None)
+
+    def retire(self, timeout, reactor=None) -> defer.Deferred:
+        """
+        Close the components once their in-flight binds are answered, or after `timeout` seconds.
+        Fires once closed.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.idle = defer.Deferred()
+        if self.in_flight == 0:
+            self.idle.callback(None)
+        else:
+            def timed_out(result, timeout):
+                logger.warning(f"Closing replaced OTP components with {self.in_flight} bind(s) still in flight "
+                               f"after {timeout} seconds")
+
+            self.idle.addTimeout(timeout, reactor, onTimeoutCancel=timed_out)
+        self.idle.addCallback(lambda _: self.close())
+        return self.idle
+
+    def close(self) -> defer.Deferred:
+        """
+        Close every plugin, logging their failures.
+        """
+        def failed(failure, plugin):
+            logger.error(f"Failed to close {plugin.__class__.__name__}: {failure.value}")
+
+        closing = []
+        for plugin in (self.otp_backend, self.otp_extractor, self.gateway_filter):
+            if plugin is not None:
+                d = defer.maybeDeferred(plugin.close)
+                d.addErrback(failed, plugin)
+                closing.append(d)
+        return defer.gatherResults(closing).addCallback(lambda _: None)
+
+
+def innermost_backend(backend):
+    """
+    The OTP backend wrapped by the resilience, cache and single flight layers, if any.
+    """
+    while hasattr(backend, 'backend'):
+        backend = backend.backend
+    return backend
+
+
+class ComponentsHolder:
+    """
+    The current components, shared by all the gateway connections of a process.
+    """
+
+    def __init__(self, components: Components):
+        self.current = components
+
+    def swap(self, components: Components, timeout=10.0, reactor=None) -> defer.Deferred:
+        """
+        Start `components` and use them for the next binds, and retire the previous ones. Fires once they are closed.
+        """
+        innermost_backend(components.otp_backend).take_over(innermost_backend(self.current.otp_backend))
+        components.start()
+        previous, self.current = self.current, components
+        return previous.retire(timeout, reactor)
@@ -1,99 +1,298 @@
+"""
+Run configuration of the gateway, read from environment variables.
+
+Importing this module has no side effect: `Settings()` reads and validates the environment on demand, and the
+OTP backend, OTP extractor and gateway filter plugins are only imported and built on first use.
+"""
+import functools
 import importlib
 import logging
 import os
 
-# BACKEND SETTINGS
-LDAP_HOST = os.getenv('LDAP_HOST', 'localhost')
-LDAP_PORT = os.getenv('LDAP_PORT', '389')
-LDAP_SSL_PORT = os.getenv('LDAP_SSL_PORT', '636')
-
-# FRONTEND SETTINGS
-try:
-    LDAP_GATEWAY_PORT = int(os.getenv('LDAP_GATEWAY_PORT', '10389'))
-except ValueError:
-    raise ValueError(f'LDAP_GATEWAY_PORT must be an integer value. found {os.getenv("LDAP_GATEWAY_PORT")} instead')
-
-try:
-    LDAP_GATEWAY_SSL_PORT = int(os.getenv('LDAP_GATEWAY_SSL_PORT', '10636'))
-except ValueError:
-    raise ValueError(f'LDAP_GATEWAY_SSL_PORT must be an integer value. found {os.getenv("LDAP_GATEWAY_SSL_PORT")} instead')
-
-LDAP_GATEWAY_SSL_KEY_PATH = os.getenv('LDAP_GATEWAY_SSL_KEY_PATH', './certs/server.key.pem')
-LDAP_GATEWAY_SSL_CERT_PATH = os.getenv('LDAP_GATEWAY_SSL_CERT_PATH', './certs/server.crt.pem')
-
-generate_certificates = False
-if not os.path.isabs(LDAP_GATEWAY_SSL_KEY_PATH):
-    LDAP_GATEWAY_SSL_KEY_PATH = os.path.join(os.getcwd(), LDAP_GATEWAY_SSL_KEY_PATH)
-if not os.path.exists(LDAP_GATEWAY_SSL_KEY_PATH):
-    generate_certificates = True
-    os.makedirs(os.path.dirname(LDAP_GATEWAY_SSL_KEY_PATH), exist_ok=True)
-
-if not os.path.isabs(LDAP_GATEWAY_SSL_CERT_PATH):
-    LDAP_GATEWAY_SSL_CERT_PATH=os.path.join(os.getcwd(), LDAP_GATEWAY_SSL_CERT_PATH)
-if not os.path.exists(LDAP_GATEWAY_SSL_CERT_PATH):
-    if not generate_certificates:
-        raise Exception("SSL cert path doesn't exists but a key file was provided. Please provide none or both")
-    os.makedirs(os.path.dirname(LDAP_GATEWAY_SSL_CERT_PATH), exist_ok=True)
-elif generate_certificates:
-    raise Exception("SSL cert path exists but a key file don't. Please provide none or both")
-
-if generate_certificates:
-    from OpenSSL import crypto, SSL
-
-    logging.info("SSL cert and key files not found. Generating it ...")
-    def cert_gen(
-            emailAddress="emailAddress",
-            commonName="commonName",
-            countryName="NT",
-            localityName="localityName",
-            stateOrProvinceName="stateOrProvinceName",
-            organizationName="organizationName",
-            organizationUnitName="organizationUnitName",
-            serialNumber=0,
-            validityStartInSeconds=0,
-            validityEndInSeconds=10 * 365 * 24 * 60 * 60):
-        # can look at generated file using openssl:
-        # openssl x509 -inform pem -in selfsigned.crt -noout -text
-        # create a key pair
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 4096)
-        # create a self-signed cert
-        cert = crypto.X509()
-        cert.get_subject().C = countryName
-        cert.get_subject().ST = stateOrProvinceName
-        cert.get_subject().L = localityName
-        cert.get_subject().O = organizationName
-        cert.get_subject().OU = organizationUnitName
-        cert.get_subject().CN = commonName
-        cert.get_subject().emailAddress = emailAddress
-        cert.set_serial_number(serialNumber)
-        cert.gmtime_adj_notBefore(validityStartInSeconds)
-        cert.gmtime_adj_notAfter(validityEndInSeconds)
-        cert.set_issuer(cert.get_subject())
-        cert.set_pubkey(k)
-        cert.sign(k, 'sha512')
-        with open(LDAP_GATEWAY_SSL_CERT_PATH, "wt") as f:
-            f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert).decode("utf-8"))
-        with open(LDAP_GATEWAY_SSL_KEY_PATH, "wt") as f:
-            f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, k).decode("utf-8"))
-
-    cert_gen()
-
-
-# OTP SETTINGS
-OTP_BACKEND_MODULE_NAME = os.getenv('OTP_BACKEND_MODULE_NAME', 'ldap_otp_gateway.otp_backend.dummy_static')
-logging.info(f"Loading OTP Backend: {OTP_BACKEND_MODULE_NAME}")
-OTP_BACKEND = getattr(importlib.import_module(OTP_BACKEND_MODULE_NAME), 'OtpBackend')()
-
-OTP_EXTRACTOR_MODULE_NAME = os.getenv('OTP_EXTRACTOR_MODULE_NAME', 'ldap_otp_gateway.otp_extractor.suffix')
-logging.info(f"Loading OTP Extractor: {OTP_EXTRACTOR_MODULE_NAME}")
-OTP_EXTRACTOR = getattr(importlib.import_module(OTP_EXTRACTOR_MODULE_NAME), 'OtpExtractor')()
-
-# Experimental
-OTP_BIND = False
-
-
-# GATEWAY SETTINGS
-GATEWAY_FILTER_MODULE_NAME = os.getenv('GATEWAY_FILTER_MODULE_NAME', None)
-GATEWAY_FILTER = None if GATEWAY_FILTER_MODULE_NAME is None else (
-    getattr(importlib.import_module(GATEWAY_FILTER_MODULE_NAME), 'GatewayFilter')())
+logger = logging.getLogger(__name__)
+
+
+def getenv_int(name, default, environ=None) -> int:
+    environ = os.environ if environ is None else environ
+    try:
+        return int(environ.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} must be an integer value. found {environ.get(name)} instead')
+
+
+def getenv_float(name, default, environ=None) -> float:
+    environ = os.environ if environ is None else environ
+    try:
+        return float(environ.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} must be a number. found {environ.get(name)} instead')
+
+
+def getenv_bool(name, default, environ=None) -> bool:
+    environ = os.environ if environ is None else environ
+    value = environ.get(name, default).lower()
+    if value not in ('true', 'false'):
+        raise ValueError(f'{name} must be either true or false. found {environ.get(name)} instead')
+    return value == 'true'
+
+
+def getenv_port(name, default, environ=None) -> int:
+    port = getenv_int(name, default, environ)
+    if not 0 <= port <= 65535:
+        raise ValueError(f'{name} must be a port number. found {port} instead')
+    return port
+
+
+def parse_upstreams(hosts, weights, port, ssl_port) -> list:
+    """
+    (host, port, SSL port, weight) of every backend LDAP server listed in `hosts`.
+    """
+    upstreams = []
+    for entry in hosts.split(','):
+        parts = entry.strip().split(':')
+        if not parts[0] or len(parts) > 3:
+            raise ValueError(f'LDAP_HOSTS entries must be host[:port[:ssl_port]]. found {entry} instead')
+        try:
+            ports = [int(value) for value in parts[1:]]
+        except ValueError:
+            raise ValueError(f'LDAP_HOSTS ports must be integer values. found {entry} instead')
+        ports += [port, ssl_port][len(ports):]
+        upstreams.append((parts[0], ports[0], ports[1], 1))
+    if weights.strip():
+        try:
+            weights = [int(weight) for weight in weights.split(',')]
+        except ValueError:
+            raise ValueError(f'LDAP_HOST_WEIGHTS must be comma separated integers. found {weights} instead')
+        if len(weights) != len(upstreams):
+            raise ValueError(f'LDAP_HOST_WEIGHTS must have one weight per LDAP_HOSTS entry. found {weights} instead')
+        upstreams = [upstream[:3] + (weight,) for upstream, weight in zip(upstreams, weights)]
+    return upstreams
+
+
+def load_plugin(module_name, class_name, reload=False):
+    """
+    New instance of the `class_name` class of a plugin module. With `reload`, an already imported module is
+    executed again, so that the settings it reads from the environment on import are refreshed.
+    """
+    logger.info(f"Loading {class_name}: {module_name}")
+    module = importlib.import_module(module_name)
+    if reload:
+        module = importlib.reload(module)
+    return getattr(module, class_name)()
+
+
+class Settings:
+    """
+    Gateway settings, read from `environ` (the process environment by default) and validated at creation:
+    malformed values raise a ValueError naming the variable. The choices among several policies are validated
+    by the components using them, when built.
+
+    With `reload_plugins`, the plugin modules are executed again when building the plugins, as done by a
+    configuration reload.
+    """
+
+    # settings applied by a configuration reload, the other ones requiring a restart
+    RELOADABLE_PREFIXES = ('OTP_', 'GATEWAY_FILTER_')
+    # settings of the reloadable prefixes only applied on restart, the OTP backend thread pool being shared by the
+    # successive backends
+    RESTART_ONLY = ('OTP_BACKEND_THREAD_POOL_SIZE',)
+
+    def __init__(self, environ=None, reload_plugins=False):
+        environ = os.environ if environ is None else environ
+        self.reload_plugins = reload_plugins
+
+        # BACKEND SETTINGS
+        self.LDAP_HOST = environ.get('LDAP_HOST', 'localhost')
+        self.LDAP_PORT = getenv_port('LDAP_PORT', '389', environ)
+        self.LDAP_SSL_PORT = getenv_port('LDAP_SSL_PORT', '636', environ)
+
+        # Replicated backend LDAP servers, as comma separated `host[:port[:ssl_port]]`, replacing LDAP_HOST. The
+        # ports default to LDAP_PORT and LDAP_SSL_PORT, and the optional LDAP_HOST_WEIGHTS are used by
+        # least_connections
+        self.LDAP_HOSTS = environ.get('LDAP_HOSTS', '')
+        self.LDAP_HOST_WEIGHTS = environ.get('LDAP_HOST_WEIGHTS', '')
+        self.LDAP_BALANCER = environ.get('LDAP_BALANCER', 'failover')
+        self.LDAP_HEALTH_CHECK_INTERVAL = getenv_float('LDAP_HEALTH_CHECK_INTERVAL', '10', environ)
+        self.LDAP_HEALTH_CHECK_TIMEOUT = getenv_float('LDAP_HEALTH_CHECK_TIMEOUT', '5', environ)
+        self.LDAP_EJECTION_TIME = getenv_float('LDAP_EJECTION_TIME', '30', environ)
+        # (host, port, SSL port, weight) of every backend LDAP server
+        self.LDAP_UPSTREAMS = parse_upstreams(self.LDAP_HOSTS if self.LDAP_HOSTS.strip() else self.LDAP_HOST,
+                                              self.LDAP_HOST_WEIGHTS, self.LDAP_PORT, self.LDAP_SSL_PORT)
+
+        # Backend connection pool, disabled with a size of 0: each frontend connection then opens its own backend
+        # connection
+        self.LDAP_BACKEND_POOL_SIZE = getenv_int('LDAP_BACKEND_POOL_SIZE', '0', environ)
+        self.LDAP_BACKEND_POOL_IDLE_TIMEOUT = getenv_float('LDAP_BACKEND_POOL_IDLE_TIMEOUT', '300', environ)
+        self.LDAP_BACKEND_POOL_MAX_LIFETIME = getenv_float('LDAP_BACKEND_POOL_MAX_LIFETIME', '3600', environ)
+        self.LDAP_BACKEND_POOL_HEALTH_CHECK_INTERVAL = getenv_float(
+            'LDAP_BACKEND_POOL_HEALTH_CHECK_INTERVAL', '30', environ)
+        self.LDAP_BACKEND_POOL_ACQUIRE_TIMEOUT = getenv_float('LDAP_BACKEND_POOL_ACQUIRE_TIMEOUT', '10', environ)
+        self.LDAP_BACKEND_POOL_BIND_POLICY = environ.get('LDAP_BACKEND_POOL_BIND_POLICY', 'anonymous')
+        self.LDAP_BACKEND_POOL_BIND_DN = environ.get('LDAP_BACKEND_POOL_BIND_DN', None)
+        self.LDAP_BACKEND_POOL_BIND_PASSWORD = environ.get('LDAP_BACKEND_POOL_BIND_PASSWORD', None)
+
+        # FRONTEND SETTINGS
+        self.LDAP_GATEWAY_PORT = getenv_port('LDAP_GATEWAY_PORT', '10389', environ)
+        self.LDAP_GATEWAY_SSL_PORT = getenv_port('LDAP_GATEWAY_SSL_PORT', '10636', environ)
+        # Seconds given to the open connections to close on shutdown, before closing them
+        self.LDAP_GATEWAY_SHUTDOWN_TIMEOUT = getenv_float('LDAP_GATEWAY_SHUTDOWN_TIMEOUT', '10', environ)
+
+        # Open the backend connection on the first request to forward rather than on the client connection, so that
+        # the idle client connections don't hold a backend connection
+        self.LDAP_GATEWAY_LAZY_BACKEND_CONNECTION = getenv_bool('LDAP_GATEWAY_LAZY_BACKEND_CONNECTION', 'false',
+                                                                environ)
+
+        # Relay the operations other than binds to the backend without decoding them, once the client did bind
+        self.LDAP_GATEWAY_RELAY_OPERATIONS = getenv_bool('LDAP_GATEWAY_RELAY_OPERATIONS', 'false', environ)
+
+        # When the OTP of the filtered binds is verified: after (sequential), along (parallel) or before (otp_first)
+        # the backend bind
+        self.LDAP_GATEWAY_VERIFY_ORDER = environ.get('LDAP_GATEWAY_VERIFY_ORDER', 'sequential')
+
+        # Token buckets of the binds per DN and per client address, refilled at RATE binds per second up to BURST
+        # binds, disabled with a rate of 0. At most RATE_LIMIT_MAX_KEYS DNs and addresses are tracked, see `rate_limit`
+        self.LDAP_GATEWAY_RATE_LIMIT_DN_RATE = getenv_float('LDAP_GATEWAY_RATE_LIMIT_DN_RATE', '0', environ)
+        self.LDAP_GATEWAY_RATE_LIMIT_DN_BURST = getenv_int('LDAP_GATEWAY_RATE_LIMIT_DN_BURST', '10', environ)
+        self.LDAP_GATEWAY_RATE_LIMIT_ADDRESS_RATE = getenv_float('LDAP_GATEWAY_RATE_LIMIT_ADDRESS_RATE', '0', environ)
+        self.LDAP_GATEWAY_RATE_LIMIT_ADDRESS_BURST = getenv_int('LDAP_GATEWAY_RATE_LIMIT_ADDRESS_BURST', '100', environ)
+        self.LDAP_GATEWAY_RATE_LIMIT_MAX_KEYS = getenv_int('LDAP_GATEWAY_RATE_LIMIT_MAX_KEYS', '100000', environ)
+        # Lockout of a DN or an address for LOCKOUT_DURATION seconds after FAILURES failed binds within LOCKOUT_WINDOW
+        # seconds, disabled with 0 failures
+        self.LDAP_GATEWAY_LOCKOUT_DN_FAILURES = getenv_int('LDAP_GATEWAY_LOCKOUT_DN_FAILURES', '0', environ)
+        self.LDAP_GATEWAY_LOCKOUT_ADDRESS_FAILURES = getenv_int('LDAP_GATEWAY_LOCKOUT_ADDRESS_FAILURES', '0', environ)
+        self.LDAP_GATEWAY_LOCKOUT_WINDOW = getenv_float('LDAP_GATEWAY_LOCKOUT_WINDOW', '300', environ)
+        self.LDAP_GATEWAY_LOCKOUT_DURATION = getenv_float('LDAP_GATEWAY_LOCKOUT_DURATION', '900', environ)
+
+        # Cache of the results of the searches of the allowed shapes, `<scope>:<base DN>` separated by semicolons,
+        # disabled when empty. See `search_cache`
+        self.LDAP_GATEWAY_SEARCH_CACHE_SHAPES = environ.get('LDAP_GATEWAY_SEARCH_CACHE_SHAPES', '')
+        self.LDAP_GATEWAY_SEARCH_CACHE_TTL = getenv_float('LDAP_GATEWAY_SEARCH_CACHE_TTL', '60', environ)
+        self.LDAP_GATEWAY_SEARCH_CACHE_MAX_SIZE = getenv_int('LDAP_GATEWAY_SEARCH_CACHE_MAX_SIZE', '10000', environ)
+        self.LDAP_GATEWAY_SEARCH_CACHE_MAX_RESULTS = getenv_int('LDAP_GATEWAY_SEARCH_CACHE_MAX_RESULTS', '100',
+                                                                environ)
+
+        # HTTP port of the Prometheus metrics endpoint, 0 to disable it. Worker processes listen on the following
+        # ports. The endpoint is not authenticated, it only listens on the loopback interface unless told otherwise
+        self.METRICS_PORT = getenv_port('METRICS_PORT', '0', environ)
+        self.METRICS_INTERFACE = environ.get('METRICS_INTERFACE', '127.0.0.1')
+
+        # Self signed certificate generated on startup when none of both files exists, see `certs`
+        self.LDAP_GATEWAY_SSL_KEY_PATH = os.path.abspath(
+            environ.get('LDAP_GATEWAY_SSL_KEY_PATH', './certs/server.key.pem'))
+        self.LDAP_GATEWAY_SSL_CERT_PATH = os.path.abspath(
+            environ.get('LDAP_GATEWAY_SSL_CERT_PATH', './certs/server.crt.pem'))
+
+        # TLS of the SSL frontend, see `tls`. The ciphers (OpenSSL cipher string) only apply up to TLS 1.2, and the
+        # key exchange groups are the OpenSSL defaults when empty
+        self.LDAP_GATEWAY_TLS_MIN_VERSION = environ.get('LDAP_GATEWAY_TLS_MIN_VERSION', '1.2')
+        self.LDAP_GATEWAY_TLS_CIPHERS = environ.get('LDAP_GATEWAY_TLS_CIPHERS', '')
+        self.LDAP_GATEWAY_TLS_GROUPS = environ.get('LDAP_GATEWAY_TLS_GROUPS', '')
+        # Resumption of the sessions of reconnecting clients, skipping the costly full handshakes
+        self.LDAP_GATEWAY_TLS_SESSION_CACHE = getenv_bool('LDAP_GATEWAY_TLS_SESSION_CACHE', 'true', environ)
+        self.LDAP_GATEWAY_TLS_SESSION_TICKETS = getenv_bool('LDAP_GATEWAY_TLS_SESSION_TICKETS', 'true', environ)
+        self.LDAP_GATEWAY_TLS_SESSION_TIMEOUT = getenv_int('LDAP_GATEWAY_TLS_SESSION_TIMEOUT', '3600', environ)
+
+        # OTP SETTINGS
+        self.OTP_BACKEND_MODULE_NAME = environ.get('OTP_BACKEND_MODULE_NAME',
+                                                   'ldap_otp_gateway.otp_backend.dummy_static')
+        # Threads running the blocking OTP backends, read by the pool when started. See `otp_backend`
+        self.OTP_BACKEND_THREAD_POOL_SIZE = getenv_int('OTP_BACKEND_THREAD_POOL_SIZE', '10', environ)
+
+        # Deadlines, concurrency limit and circuit breaker around the OTP backend calls
+        self.OTP_RESILIENCE = getenv_bool('OTP_RESILIENCE', 'false', environ)
+        self.OTP_TIMEOUT_MIN = getenv_float('OTP_TIMEOUT_MIN', '0.5', environ)
+        self.OTP_TIMEOUT_MAX = getenv_float('OTP_TIMEOUT_MAX', '10', environ)
+        self.OTP_TIMEOUT_PERCENTILE = getenv_float('OTP_TIMEOUT_PERCENTILE', '99', environ)
+        self.OTP_TIMEOUT_MULTIPLIER = getenv_float('OTP_TIMEOUT_MULTIPLIER', '3', environ)
+        self.OTP_MAX_CONCURRENCY = getenv_int('OTP_MAX_CONCURRENCY', '50', environ)
+        self.OTP_QUEUE_SIZE = getenv_int('OTP_QUEUE_SIZE', '200', environ)
+        self.OTP_QUEUE_TIMEOUT = getenv_float('OTP_QUEUE_TIMEOUT', '5', environ)
+        self.OTP_CIRCUIT_FAILURE_THRESHOLD = getenv_int('OTP_CIRCUIT_FAILURE_THRESHOLD', '5', environ)
+        self.OTP_CIRCUIT_RESET_TIMEOUT = getenv_float('OTP_CIRCUIT_RESET_TIMEOUT', '30', environ)
+
+        # Concurrent verifications of the same credentials share a single OTP backend call
+        self.OTP_SINGLE_FLIGHT = getenv_bool('OTP_SINGLE_FLIGHT', 'true', environ)
+
+        # Cache of the successful OTP verifications, disabled with a TTL of 0
+        self.OTP_CACHE_TTL = getenv_float('OTP_CACHE_TTL', '0', environ)
+        self.OTP_CACHE_MAX_SIZE = getenv_int('OTP_CACHE_MAX_SIZE', '10000', environ)
+        # Seconds an OTP code stays valid for the OTP backend, capping the cache TTL
+        self.OTP_VALIDITY_WINDOW = getenv_float('OTP_VALIDITY_WINDOW', '30', environ)
+
+        self.OTP_EXTRACTOR_MODULE_NAME = environ.get('OTP_EXTRACTOR_MODULE_NAME',
+                                                     'ldap_otp_gateway.otp_extractor.suffix')
+
+        # Experimental
+        self.OTP_BIND = False
+
+        # GATEWAY SETTINGS
+        self.GATEWAY_FILTER_MODULE_NAME = environ.get('GATEWAY_FILTER_MODULE_NAME', None)
+
+        # AUDIT LOG
+        # Sink of the bind audit records, `jsonl` or `postgres`, disabled when empty. See `audit`
+        self.AUDIT_SINK = environ.get('AUDIT_SINK', '')
+        self.AUDIT_QUEUE_SIZE = getenv_int('AUDIT_QUEUE_SIZE', '10000', environ)
+        self.AUDIT_BATCH_SIZE = getenv_int('AUDIT_BATCH_SIZE', '500', environ)
+        self.AUDIT_FLUSH_INTERVAL = getenv_float('AUDIT_FLUSH_INTERVAL', '1', environ)
+        self.AUDIT_OVERFLOW = environ.get('AUDIT_OVERFLOW', 'drop_newest')
+        # JSON lines file, each worker process writing to its own `<name>.<worker index><extension>` file
+        self.AUDIT_FILE_PATH = os.path.abspath(environ.get('AUDIT_FILE_PATH', './audit.jsonl'))
+        self.AUDIT_FILE_MAX_BYTES = getenv_int('AUDIT_FILE_MAX_BYTES', str(100 * 1024 * 1024), environ)
+        self.AUDIT_FILE_BACKUP_COUNT = getenv_int('AUDIT_FILE_BACKUP_COUNT', '10', environ)
+        self.AUDIT_PG_DSN = environ.get('AUDIT_PG_DSN', '')
+        self.AUDIT_PG_TABLE = environ.get('AUDIT_PG_TABLE', 'ldap_otp_gateway_audit')
+
+        # CONFIGURATION RELOAD
+        # File whose modification triggers a configuration reload, as SIGHUP does, checked every
+        # RELOAD_WATCH_INTERVAL seconds. Not watched when empty
+        self.RELOAD_WATCH_PATH = environ.get('RELOAD_WATCH_PATH', '')
+        self.RELOAD_WATCH_INTERVAL = getenv_float('RELOAD_WATCH_INTERVAL', '5', environ)
+
+    def changes(self, other) -> list:
+        """
+        Names of the settings having a different value in `other`.
+        """
+        return sorted(name for name, value in vars(self).items()
+                      if name.isupper() and getattr(other, name, None) != value)
+
+    @functools.cached_property
+    def OTP_BACKEND(self):
+        backend = load_plugin(self.OTP_BACKEND_MODULE_NAME, 'OtpBackend', self.reload_plugins)
+
+        if self.OTP_RESILIENCE:
+            from .otp_backend.resilience import ResilientOtpBackend
+
+            backend = ResilientOtpBackend(
+                backend,
+                min_timeout=self.OTP_TIMEOUT_MIN,
+                max_timeout=self.OTP_TIMEOUT_MAX,
+                timeout_percentile=self.OTP_TIMEOUT_PERCENTILE,
+                timeout_multiplier=self.OTP_TIMEOUT_MULTIPLIER,
+                max_concurrency=self.OTP_MAX_CONCURRENCY,
+                queue_size=self.OTP_QUEUE_SIZE,
+                queue_timeout=self.OTP_QUEUE_TIMEOUT,
+                failure_threshold=self.OTP_CIRCUIT_FAILURE_THRESHOLD,
+                reset_timeout=self.OTP_CIRCUIT_RESET_TIMEOUT)
+
+        if self.OTP_SINGLE_FLIGHT:
+            from .otp_backend.single_flight import SingleFlightOtpBackend
+
+            backend = SingleFlightOtpBackend(backend)
+
+        if self.OTP_CACHE_TTL > 0:
+            from .otp_backend.cache import CachingOtpBackend
+
+            logger.info(f"Caching successful OTP verifications for {self.OTP_CACHE_TTL} seconds")
+            backend = CachingOtpBackend(backend, ttl=self.OTP_CACHE_TTL, max_size=self.OTP_CACHE_MAX_SIZE,
+                                        validity_window=self.OTP_VALIDITY_WINDOW)
+        return backend
+
+    @functools.cached_property
+    def OTP_EXTRACTOR(self):
+        return load_plugin(self.OTP_EXTRACTOR_MODULE_NAME, 'OtpExtractor', self.reload_plugins)
+
+    @functools.cached_property
+    def GATEWAY_FILTER(self):
+        if self.GATEWAY_FILTER_MODULE_NAME is None:
+            return None
+        return load_plugin(self.GATEWAY_FILTER_MODULE_NAME, 'GatewayFilter', self.reload_plugins)
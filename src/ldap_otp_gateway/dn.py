@@ -0,0 +1,53 @@
+"""
+Distinguished name normalization, so that DNs differing only by case or insignificant spaces compare equal.
+"""
+
+
+def split_unescaped(value: str, separator: str) -> list[str]:
+    """
+    Split on the separator, except when escaped with a backslash.
+    """
+    if '\\' not in value:
+        return value.split(separator)
+    parts = []
+    current = []
+    escaped = False
+    for char in value:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif char == '\\':
+            current.append(char)
+            escaped = True
+        elif char == separator:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    parts.append(''.join(current))
+    return parts
+
+
+def normalize_ava(ava: str) -> str:
+    attribute, _, value = ava.partition('=')
+    return attribute.strip().lower() + '=' + ' '.join(value.lower().split())
+
+
+def normalize_rdn(rdn: str) -> str:
+    if '+' not in rdn:
+        return normalize_ava(rdn)
+    # the order of the values of a multi-valued RDN is not significant
+    return '+'.join(sorted(normalize_ava(ava) for ava in split_unescaped(rdn, '+')))
+
+
+def split_dn(dn: str) -> tuple[str, ...]:
+    """
+    Normalized RDNs of a DN, the leftmost (most specific) first. The empty DN has no RDN.
+    """
+    if not dn.strip():
+        return ()
+    return tuple(normalize_rdn(rdn) for rdn in split_unescaped(dn, ','))
+
+
+def normalize_dn(dn: str) -> str:
+    return ','.join(split_dn(dn))
@@ -1,3 +1,8 @@
 class BaseGatewayFilter():
     def ignore(self, request) -> bool:
         return False
+
+    def close(self):
+        """
+        Release the resources of the filter once replaced by a configuration reload. May return a Deferred.
+        """
@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+
+from twisted.internet import threads
+
+from .base_gateway_filter import BaseGatewayFilter
+from ..dn import normalize_dn, split_dn
+
+logger = logging.getLogger(__name__)
+
+SUBTREE_PREFIX = '*,'
+
+
+class SubtreeNode:
+    __slots__ = ('children', 'subtree')
+
+    def __init__(self):
+        self.children = {}
+        # whether every DN below this node matches
+        self.subtree = False
+
+
+class DNIndex:
+    """
+    Exact DNs in a set, and subtree rules in a trie of RDNs from the root of the tree down,
+    so that a lookup costs one hash and at most one step per RDN of the DN.
+    """
+
+    def __init__(self, entries):
+        exact = set()
+        self.root = SubtreeNode()
+        self.subtrees = 0
+        for entry in entries:
+            if entry.startswith(SUBTREE_PREFIX):
+                node = self.root
+                for rdn in reversed(split_dn(entry[len(SUBTREE_PREFIX):])):
+                    node = node.children.setdefault(rdn, SubtreeNode())
+                node.subtree = True
+                self.subtrees += 1
+            else:
+                exact.add(normalize_dn(entry))
+        self.exact = frozenset(exact)
+
+    def __len__(self):
+        return len(self.exact) + self.subtrees
+
+    def match(self, dn: str) -> bool:
+        rdns = split_dn(dn)
+        if ','.join(rdns) in self.exact:
+            return True
+        node = self.root
+        # a subtree rule only matches the DNs strictly below its base
+        for rdn in reversed(rdns[1:]):
+            node = node.children.get(rdn)
+            if node is None:
+                return False
+            if node.subtree:
+                return True
+        return False
+
+
+def read_entries(path) -> list[str]:
+    """
+    One DN per line, `*,<base DN>` for all the DNs below a base DN. Blank lines and `#` comments are ignored.
+    """
+    with open(path) as f:
+        lines = (line.strip() for line in f)
+        return [line for line in lines if line and not line.startswith('#')]
+
+
+class GatewayFilter(BaseGatewayFilter):
+    """
+    Pass through for the DNs listed in the `GATEWAY_FILTER_DN_FILE` file, matched case and
+    insignificant space insensitive. The file is checked for modification at most every
+    `GATEWAY_FILTER_DN_RELOAD_INTERVAL` seconds and reloaded in a thread, without restarting.
+    """
+
+    def __init__(self, path=None, reload_interval=None, clock=time.monotonic):
+        self.path = path if path is not None else os.getenv('GATEWAY_FILTER_DN_FILE', None)
+        if self.path is None:
+            raise ValueError('GATEWAY_FILTER_DN_FILE is required by the DN index gateway filter')
+        self.reload_interval = float(reload_interval if reload_interval is not None
+                                     else os.getenv('GATEWAY_FILTER_DN_RELOAD_INTERVAL', '5'))
+        self.clock = clock
+        self.mtime = os.stat(self.path).st_mtime_ns
+        self.index = DNIndex(read_entries(self.path))
+        self.checked_at = self.clock()
+        self.reloading = None
+        logger.info(f"Gateway filter DN index of {len(self.index)} entries loaded from {self.path}")
+
+    def ignore(self, request) -> bool:
+        self.check_reload()
+        return self.index.match(request.dn.decode())
+
+    def check_reload(self):
+        now = self.clock()
+        if self.reload_interval <= 0 or now - self.checked_at < self.reload_interval or self.reloading is not None:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            logger.warning(f"Gateway filter DN file not available, keeping the loaded entries: {e}")
+            return
+        if mtime != self.mtime:
+            self.reload(mtime)
+
+    def reload(self, mtime):
+        def loaded(index):
+            self.mtime = mtime
+            self.index = index
+            logger.info(f"Gateway filter DN index of {len(index)} entries reloaded from {self.path}")
+
+        def failed(failure):
+            logger.error(f"Failed to reload the gateway filter DN file, keeping the loaded entries: "
+                         f"{failure.value}")
+
+        def done(_):
+            self.reloading = None
+
+        d = self.reloading = threads.deferToThread(lambda: DNIndex(read_entries(self.path)))
+        d.addCallbacks(loaded, failed)
+        d.addBoth(done)
+        return d
@@ -0,0 +1,143 @@
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols.ldap import ldapclient
+from ldaptor.protocols.ldap.ldapclient import LDAPClient
+from twisted.internet import defer, endpoints, protocol
+
+from . import ber, metrics
+
+
+class GatewayLDAPClient(LDAPClient):
+    """
+    LDAP client used by the gateway to reach the backend LDAP servers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.connection_lost_callbacks = []
+        # handlers of the relayed requests in flight, by message ID
+        self.relay_handlers = {}
+        # assigned on connection, declared upfront for the instances to share their attribute names, see OtpGateway
+        self.factory = None
+        self.transport = None
+
+    def connectionMade(self):
+        metrics.BACKEND_CONNECTIONS.inc()
+        super().connectionMade()
+
+    def connectionLost(self, reason=None):
+        metrics.BACKEND_CONNECTIONS.dec()
+        self.relay_handlers = {}
+        super().connectionLost(reason)
+        callbacks, self.connection_lost_callbacks = self.connection_lost_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def dataReceived(self, data):
+        if not self.relay_handlers:
+            return super().dataReceived(data)
+
+        self.buffer += data
+        offset = 0
+        try:
+            while True:
+                envelope = ber.peek_message(self.buffer, offset)
+                if envelope is None:
+                    break
+                message_id, tag, operation, end = envelope
+                handler = self.relay_handlers.get(message_id)
+                if handler is not None:
+                    if tag not in ber.INTERMEDIATE_RESPONSE_TAGS:
+                        del self.relay_handlers[message_id]
+                    handler(self.buffer, operation, end)
+                else:
+                    message, _ = pureber.berDecodeObject(self.berdecoder, self.buffer[offset:end])
+                    if message is not None:
+                        self.handle(message)
+                offset = end
+        except ValueError:
+            # not an LDAPMessage, leave it to the LDAP client
+            self.buffer = self.buffer[offset:]
+            return super().dataReceived(b'')
+        self.buffer = self.buffer[offset:]
+
+    def relay(self, buffer, operation, end, handler):
+        """
+        Send an already encoded request, the protocol operation and controls of the LDAPMessage found
+        between `operation` and `end` in `buffer`, without decoding it.
+        `handler(buffer, operation, end)` is called the same way with every encoded response.
+        """
+        if not self.connected:
+            raise ldapclient.LDAPClientConnectionLostException()
+        message_id = pureldap.alloc_ldap_message_id()
+        self.relay_handlers[message_id] = handler
+        self.transport.write(ber.with_message_id(buffer, operation, end, message_id))
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether requests are waiting for responses.
+        """
+        return bool(self.onwire or self.relay_handlers)
+
+    def notify_connection_lost(self, callback):
+        """
+        Call `callback(client)` once the connection is lost.
+        """
+        self.connection_lost_callbacks.append(callback)
+
+    def simple_bind(self, dn: bytes, password: bytes) -> defer.Deferred:
+        """
+        Bind with the given identity, an empty DN binding anonymously.
+        Fires with the bind response, or fails with the matching LDAPException.
+        """
+        d = self.send(pureldap.LDAPBindRequest(dn=dn, auth=password))
+
+        def check(response):
+            if response.resultCode != ldaperrors.Success.resultCode:
+                raise ldaperrors.get(response.resultCode, response.errorMessage)
+            return response
+
+        d.addCallback(check)
+        return d
+
+    def search_root_dse(self) -> defer.Deferred:
+        """
+        Cheap liveness probe: base search of the root DSE, asking no attribute.
+        Fires with True once the search is done successfully.
+        """
+        request = pureldap.LDAPSearchRequest(
+            baseObject=b'',
+            scope=pureldap.LDAP_SCOPE_baseObject,
+            filter=pureldap.LDAPFilter_present('objectClass'),
+            attributes=[b'1.1'])
+        done = defer.Deferred()
+
+        def handler(response):
+            if isinstance(response, pureldap.LDAPSearchResultDone):
+                if response.resultCode == ldaperrors.Success.resultCode:
+                    done.callback(True)
+                else:
+                    done.errback(ldaperrors.get(response.resultCode, response.errorMessage))
+                return True
+            return False
+
+        self.send_multiResponse(request, handler).addErrback(done.errback)
+        return done
+
+
+def build_connector(reactor, endpoint_description):
+    """
+    Function connecting to the backend LDAP server of a Twisted client endpoint description, e.g. `tcp:host:389`,
+    firing with the connected GatewayLDAPClient.
+    Unlike ldaptor's connectToLDAPEndpoint, the description is parsed once, and the connections share a factory
+    instead of each holding a factory class of its own.
+    """
+    endpoint = endpoints.clientFromString(reactor, endpoint_description)
+    factory = protocol.Factory.forProtocol(GatewayLDAPClient)
+    factory.noisy = False
+
+    def connect() -> defer.Deferred:
+        return endpoint.connect(factory)
+
+    return connect
@@ -0,0 +1,89 @@
+"""
+Logging configuration, and safe representation of the values logged on the hot path: computed only if the
+record is actually emitted, with the secrets redacted and truncated to `LOG_MAX_LENGTH` characters.
+"""
+import logging
+import os
+import re
+
+from ldaptor.protocols import pureldap
+
+from .config import getenv_int
+
+LOG_FORMAT = '%(levelname)s:%(name)s:%(message)s'
+# until `configure()` reads `LOG_MAX_LENGTH`
+LOG_MAX_LENGTH = 1000
+
+REDACTED = '****'
+SECRET_PATTERNS = [
+    # SOAP password elements, e.g. <m:anyPassword xsi:type="xsd:string">...</m:anyPassword>
+    (re.compile(r'(<(?:\w+:)?\w*[Pp]assword\b[^>]*>)[^<]*(</)'), rf'\g<1>{REDACTED}\g<2>'),
+    # password attribute values of add and modify requests
+    (re.compile(r"""((?i:userPassword|unicodePwd)'\)?,\s*\w*\((?:value|vals)=\[)[^\]]*"""), rf'\g<1>{REDACTED}'),
+]
+
+
+def configure(level=None, levels=None, max_length=None):
+    """
+    Set the root log level (`LOG_LEVEL`, INFO by default), the per logger levels
+    (`LOG_LEVELS`, e.g. `ldap_otp_gateway.otp_gateway=DEBUG,ldap_otp_gateway.backend_pool=WARNING`)
+    and the maximum length of the logged values (`LOG_MAX_LENGTH`, 0 for no limit).
+    Can be called again once the environment changed.
+    """
+    global LOG_MAX_LENGTH
+    LOG_MAX_LENGTH = int(max_length) if max_length is not None else getenv_int('LOG_MAX_LENGTH', '1000')
+    level = level if level is not None else os.getenv('LOG_LEVEL', 'INFO')
+    levels = levels if levels is not None else os.getenv('LOG_LEVELS', '')
+
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format=LOG_FORMAT)
+    root.setLevel(level.upper())
+    for item in levels.split(','):
+        if not item.strip():
+            continue
+        name, separator, logger_level = item.partition('=')
+        if not separator:
+            raise ValueError(f'LOG_LEVELS must be a comma separated list of <logger>=<level>. found {item} instead')
+        logging.getLogger(name.strip()).setLevel(logger_level.strip().upper())
+
+
+def bind_request_repr(request: pureldap.LDAPBindRequest) -> str:
+    parts = [f'version={request.version}', f'dn={request.dn!r}', f'auth={REDACTED}']
+    if request.tag != request.__class__.tag:
+        parts.append(f'tag={request.tag}')
+    parts.append(f'sasl={request.sasl!r}')
+    return f'{request.__class__.__name__}({", ".join(parts)})'
+
+
+def redact(value) -> str:
+    """
+    Representation of a value (LDAP message, SOAP payload, ...) without the secrets it holds.
+    """
+    if isinstance(value, pureldap.LDAPBindRequest):
+        return bind_request_repr(value)
+    text = value if isinstance(value, str) else repr(value)
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def truncate(text: str, max_length=None) -> str:
+    max_length = max_length if max_length is not None else LOG_MAX_LENGTH
+    if 0 < max_length < len(text):
+        return f'{text[:max_length]}... ({len(text) - max_length} more characters)'
+    return text
+
+
+class Loggable:
+    """
+    Log argument deferring the redacted and truncated representation of its value until formatted:
+    `logger.debug("Request => %s", Loggable(request))` costs nothing if DEBUG is disabled.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return truncate(redact(self.value))
@@ -0,0 +1,298 @@
+"""
+Minimal in-process metrics, exposed in the Prometheus text format by an optional HTTP listener.
+
+Label values must come from a small fixed set (stage names, outcomes, ...), never from the requests
+(DNs, addresses), so that the number of series stays bounded.
+"""
+import bisect
+import logging
+import time
+
+from twisted.web import resource, server
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self.new_child()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def new_child(self):
+        raise NotImplementedError("Not implemented")
+
+    def labels(self, *values):
+        """
+        Child metric of the given label values, to be kept by the callers on the hot path.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}. found {values} instead')
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def label_pairs(self, values, extra=()) -> str:
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, values)]
+        pairs.extend(f'{name}="{escape(value)}"' for name, value in extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, child in sorted(self.children.items()):
+            lines.extend(self.render_child(values, child))
+        return lines
+
+    def render_child(self, values, child) -> list[str]:
+        return [f'{self.name}{self.label_pairs(values)} {format_value(child.get())}']
+
+    # unlabelled metrics are used directly
+    def __getattr__(self, item):
+        if item != 'children' and () in self.children:
+            return getattr(self.children[()], item)
+        raise AttributeError(item)
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+
+class GaugeChild:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        Compute the value when collected instead.
+        """
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def new_child(self):
+        return GaugeChild()
+
+
+class HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        # non cumulative, the last one for the observations above the highest bound
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+    def time(self, start):
+        """
+        Observe the seconds elapsed since `start`, a `time.perf_counter()` value.
+        """
+        self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return HistogramChild(self.upper_bounds)
+
+    def render_child(self, values, child) -> list[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.upper_bounds + (float('inf'),), child.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{self.label_pairs(values, [("le", format_value(upper_bound))])} '
+                         f'{cumulative}')
+        lines.append(f'{self.name}_sum{self.label_pairs(values)} {child.sum}')
+        lines.append(f'{self.name}_count{self.label_pairs(values)} {cumulative}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry=None):
+        super().__init__()
+        self.registry = registry if registry is not None else REGISTRY
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return self.registry.render()
+
+
+def listen(port, interface='', registry=None, reactor=None):
+    """
+    Serve the metrics over HTTP on the given port, whatever the path.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    site = server.Site(MetricsResource(registry))
+    site.noisy = False
+    logger.info(f"- metrics listening on {interface}:{port}")
+    return reactor.listenTCP(port, site, interface=interface)
+
+
+REGISTRY = Registry()
+
+# gateway metrics
+BINDS = Counter('ldap_otp_gateway_binds_total', 'Bind requests received, by handling mode', ['mode'])
+BINDS_PASS_THROUGH = BINDS.labels('pass_through')
+BINDS_FILTERED = BINDS.labels('filtered')
+
+OTP_EXTRACTION_FAILURES = Counter('ldap_otp_gateway_otp_extraction_failures_total',
+                                  'Filtered bind requests whose OTP could not be extracted')
+
+OTP_VERIFICATIONS = Counter('ldap_otp_gateway_otp_verifications_total',
+                            'OTP verifications, by result', ['result'])
+OTP_VERIFICATIONS_SUCCESS = OTP_VERIFICATIONS.labels('success')
+OTP_VERIFICATIONS_FAILURE = OTP_VERIFICATIONS.labels('failure')
+OTP_VERIFICATIONS_ERROR = OTP_VERIFICATIONS.labels('error')
+OTP_VERIFICATIONS_UNAVAILABLE = OTP_VERIFICATIONS.labels('unavailable')
+
+STAGE_DURATION = Histogram('ldap_otp_gateway_bind_stage_duration_seconds',
+                           'Duration of the bind handling stages', ['stage'])
+STAGE_BEFORE_FORWARD = STAGE_DURATION.labels('before_forward')
+STAGE_BACKEND = STAGE_DURATION.labels('backend')
+STAGE_OTP_VERIFY = STAGE_DURATION.labels('otp_verify')
+STAGE_TOTAL = STAGE_DURATION.labels('total')
+
+FRONTEND_CONNECTIONS = Gauge('ldap_otp_gateway_frontend_connections', 'Open frontend connections', ['endpoint'])
+# OTP backend resilience
+OTP_BACKEND_IN_FLIGHT = Gauge('ldap_otp_gateway_otp_backend_in_flight', 'OTP backend calls in flight')
+OTP_BACKEND_QUEUED = Gauge('ldap_otp_gateway_otp_backend_queued', 'OTP verifications waiting for an OTP backend slot')
+OTP_BACKEND_DEADLINE = Gauge('ldap_otp_gateway_otp_backend_deadline_seconds', 'Current OTP backend call deadline')
+OTP_BACKEND_REJECTIONS = Counter('ldap_otp_gateway_otp_backend_rejections_total',
+                                 'OTP verifications failed fast or timed out, by reason', ['reason'])
+OTP_CIRCUIT_STATE = Gauge('ldap_otp_gateway_otp_circuit_state',
+                          'OTP backend circuit breaker state, 1 for the current one', ['state'])
+
+# OTP backend endpoints
+OTP_ENDPOINT_EJECTIONS = Counter('ldap_otp_gateway_otp_endpoint_ejections_total',
+                                 'OTP endpoints ejected after consecutive failures', ['endpoint'])
+OTP_HEDGED_REQUESTS = Counter('ldap_otp_gateway_otp_hedged_requests_total',
+                              'Hedged OTP verification requests sent, and the ones replying a success first',
+                              ['outcome'])
+
+BACKEND_CONNECTIONS = Gauge('ldap_otp_gateway_backend_connections', 'Open backend LDAP connections')
+# upstream LDAP servers
+LDAP_UPSTREAM_UP = Gauge('ldap_otp_gateway_ldap_upstream_up',
+                         'Upstream LDAP servers, 1 when available and 0 when ejected', ['upstream'])
+LDAP_UPSTREAM_CONNECTIONS = Gauge('ldap_otp_gateway_ldap_upstream_connections',
+                                  'Open backend LDAP connections, by upstream server', ['upstream'])
+LDAP_UPSTREAM_EJECTIONS = Counter('ldap_otp_gateway_ldap_upstream_ejections_total',
+                                  'Upstream LDAP servers ejected after a failed connection or health check',
+                                  ['upstream'])
+
+# bind rate limiting and lockout
+RATE_LIMITED_BINDS = Counter('ldap_otp_gateway_rate_limited_binds_total',
+                             'Bind requests rejected by the rate limiter, by limiting key and reason', ['key', 'reason'])
+LOCKOUTS = Counter('ldap_otp_gateway_lockouts_total', 'DNs and addresses locked out after failed binds', ['key'])
+RATE_LIMIT_KEYS = Gauge('ldap_otp_gateway_rate_limit_keys', 'DNs and addresses tracked by the rate limiter', ['key'])
+
+# search cache
+SEARCH_CACHE = Counter('ldap_otp_gateway_search_cache_total', 'Cacheable searches, by cache result', ['result'])
+SEARCH_CACHE_HITS = SEARCH_CACHE.labels('hit')
+SEARCH_CACHE_MISSES = SEARCH_CACHE.labels('miss')
+SEARCH_CACHE_INVALIDATIONS = Counter('ldap_otp_gateway_search_cache_invalidations_total',
+                                     'Cached searches invalidated by write operations')
+SEARCH_CACHE_ENTRIES = Gauge('ldap_otp_gateway_search_cache_entries', 'Searches whose results are cached')
+
+# audit log
+AUDIT_RECORDS = Counter('ldap_otp_gateway_audit_records_total', 'Bind audit records, by outcome', ['outcome'])
+AUDIT_RECORDS_WRITTEN = AUDIT_RECORDS.labels('written')
+AUDIT_RECORDS_DROPPED = AUDIT_RECORDS.labels('dropped')
+AUDIT_RECORDS_RETRIED = AUDIT_RECORDS.labels('retried')
+# binds refused, as their record couldn't be queued
+AUDIT_BINDS_REFUSED = AUDIT_RECORDS.labels('refused')
+AUDIT_QUEUED = Gauge('ldap_otp_gateway_audit_queued', 'Bind audit records waiting to be written')
+
+# SSL frontend
+TLS_HANDSHAKES = Counter('ldap_otp_gateway_tls_handshakes_total', 'Completed TLS handshakes of the SSL frontend',
+                         ['type'])
+TLS_HANDSHAKES_FULL = TLS_HANDSHAKES.labels('full')
+TLS_HANDSHAKES_RESUMED = TLS_HANDSHAKES.labels('resumed')
+
+# configuration reload
+CONFIG_RELOADS = Counter('ldap_otp_gateway_config_reloads_total', 'Configuration reloads, by result', ['result'])
+CONFIG_RELOADS_SUCCESS = CONFIG_RELOADS.labels('success')
+CONFIG_RELOADS_FAILURE = CONFIG_RELOADS.labels('failure')
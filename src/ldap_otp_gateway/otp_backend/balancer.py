@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+LEAST_OUTSTANDING = 'least_outstanding'
+EWMA = 'ewma'
+POLICIES = [LEAST_OUTSTANDING, EWMA]
+
+
+class Endpoint:
+    __slots__ = ('uri', 'outstanding', 'ewma', 'failures', 'ejected_until')
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.outstanding = 0
+        # smoothed latency of the successful requests, in seconds
+        self.ewma = 0.0
+        # consecutive failed requests
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self):
+        return f'Endpoint({self.uri})'
+
+
+class Balancer:
+    """
+    Spreads the requests over several equivalent endpoints, picking the one with the least outstanding requests
+    (`least_outstanding`), or the lowest latency moving average weighted by its outstanding requests (`ewma`).
+
+    An endpoint failing `ejection_failures` requests in a row is left aside for `ejection_time` seconds, unless all
+    of them are. Safe to use from several threads.
+    """
+
+    def __init__(self, uris, policy=LEAST_OUTSTANDING, ejection_failures=3, ejection_time=30.0, ewma_weight=0.2,
+                 clock=time.monotonic):
+        if not uris:
+            raise ValueError('At least one endpoint is required')
+        if policy not in POLICIES:
+            raise ValueError(f'Balancing policy must be one of {POLICIES}. found {policy} instead')
+        self.endpoints = [Endpoint(uri) for uri in uris]
+        self.policy = policy
+        self.ejection_failures = ejection_failures
+        self.ejection_time = ejection_time
+        self.ewma_weight = ewma_weight
+        self.clock = clock
+        self.lock = threading.Lock()
+        # rotates the first endpoint considered, spreading the requests between equally good endpoints
+        self.next = 0
+
+    def score(self, endpoint):
+        if self.policy == EWMA:
+            return endpoint.ewma * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def select(self, exclude=None) -> Endpoint:
+        """
+        Pick an endpoint other than `exclude` if possible, and count a request outstanding on it.
+        """
+        with self.lock:
+            now = self.clock()
+            count = len(self.endpoints)
+            start = self.next
+            self.next = (start + 1) % count
+            best = None
+            fallback = None
+            for i in range(count):
+                endpoint = self.endpoints[(start + i) % count]
+                if endpoint is exclude and count > 1:
+                    continue
+                if endpoint.ejected_until > now:
+                    if fallback is None or endpoint.ejected_until < fallback.ejected_until:
+                        fallback = endpoint
+                    continue
+                if best is None or self.score(endpoint) < self.score(best):
+                    best = endpoint
+            selected = best if best is not None else fallback
+            selected.outstanding += 1
+            return selected
+
+    def done(self, endpoint, latency, ok):
+        """
+        Account for the end of a request. `ok` is False when the endpoint didn't reply properly.
+        """
+        with self.lock:
+            endpoint.outstanding -= 1
+            if ok:
+                endpoint.failures = 0
+                endpoint.ewma = latency if endpoint.ewma == 0 else (
+                    self.ewma_weight * latency + (1 - self.ewma_weight) * endpoint.ewma)
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.ejection_failures and endpoint.ejected_until <= self.clock():
+                logger.warning(f"Ejecting OTP endpoint {endpoint.uri} for {self.ejection_time} seconds after "
+                               f"{endpoint.failures} consecutive failures")
+                endpoint.ejected_until = self.clock() + self.ejection_time
+                metrics.OTP_ENDPOINT_EJECTIONS.labels(endpoint.uri).inc()
+
+    def cancelled(self, endpoint):
+        """
+        Account for a request abandoned before its end, e.g. the losing one of hedged requests.
+        """
+        with self.lock:
+            endpoint.outstanding -= 1
@@ -1,3 +1,93 @@
+import hashlib
+import logging
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from ..config import getenv_int
+
+logger = logging.getLogger(__name__)
+
+_thread_pool = None
+
+
+def get_thread_pool() -> ThreadPool:
+    """
+    Bounded thread pool shared by all the blocking (legacy) OTP backends.
+    Started on first use, sized by `OTP_BACKEND_THREAD_POOL_SIZE` then, and stopped with the reactor.
+    """
+    global _thread_pool
+    if _thread_pool is None:
+        from twisted.internet import reactor
+
+        size = getenv_int('OTP_BACKEND_THREAD_POOL_SIZE', '10')
+        logger.info(f"Starting OTP backend thread pool of size {size}")
+        _thread_pool = ThreadPool(minthreads=0, maxthreads=size, name='otp-backend')
+        _thread_pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', stop_thread_pool)
+    return _thread_pool
+
+
+def stop_thread_pool():
+    global _thread_pool
+    if _thread_pool is not None:
+        _thread_pool.stop()
+        _thread_pool = None
+
+
+def credentials_key(salt: bytes, username, password, otp) -> bytes:
+    """
+    Salted digest of a set of credentials, to index them without keeping the raw secrets in memory.
+    """
+    digest = hashlib.blake2b(key=salt, digest_size=32)
+    for value in (username, password, otp):
+        data = value.encode()
+        # length prefixed, so that ('ab', 'c') and ('a', 'bc') don't collide
+        digest.update(len(data).to_bytes(4, 'big'))
+        digest.update(data)
+    return digest.digest()
+
+
+class OtpBackendUnavailable(Exception):
+    """
+    The OTP backend can't verify OTPs for now, e.g. overloaded or down. Answered with an LDAP unavailable result.
+    """
+
+
 class BaseOtpBackend:
+    # whether cancelling the Deferred of `verify_async()` stops the verification, e.g. aborts its HTTP request. A
+    # verification running in a thread can't be stopped, its cancelled Deferred fires right away while it goes on
+    cancellable = False
+
     def verify(self, username, password, otp) -> (bool, (str or None)):
         raise NotImplementedError("Not implemented")
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        """
+        Non-blocking verification, called by the gateway from the reactor thread.
+        Must return a Deferred firing the same `(bool, str or None)` tuple as `verify()`.
+
+        The default implementation runs the blocking `verify()` in the shared OTP backend
+        thread pool. Backends that can verify without blocking should override it.
+        """
+        from twisted.internet import reactor
+
+        return threads.deferToThreadPool(reactor, get_thread_pool(), self.verify, username, password, otp)
+
+    def start(self):
+        """
+        Start the background work of the backend, if any, once the reactor runs and before its first verification.
+        """
+
+    def take_over(self, previous):
+        """
+        Carry over the state worth keeping from the backend replaced by a configuration reload, before starting.
+        `previous` may be an instance of another class, built before its plugin module was executed again.
+        """
+
+    def close(self) -> defer.Deferred:
+        """
+        Release the resources of the backend (connections, threads...) once replaced by a configuration reload,
+        after its last verification. Fires once done.
+        """
+        return defer.succeed(None)
@@ -0,0 +1,84 @@
+import logging
+import os
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+from .base_otp_backend import BaseOtpBackend, credentials_key
+
+logger = logging.getLogger(__name__)
+
+
+class CachingOtpBackend(BaseOtpBackend):
+    """
+    Wraps an OTP backend to remember the successful verifications for `ttl` seconds, so that a client
+    binding again with the same credentials doesn't hit the OTP backend again.
+
+    Only salted digests of the credentials are kept. The TTL is capped to the OTP validity window,
+    and the least recently used entries are evicted beyond `max_size` entries. Failed verifications
+    are never cached.
+    """
+
+    def __init__(self, backend: BaseOtpBackend, ttl=10.0, max_size=10000, validity_window=30.0, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if ttl > validity_window:
+            logger.warning(f"OTP cache TTL of {ttl} seconds capped to the OTP validity window of "
+                           f"{validity_window} seconds")
+            ttl = validity_window
+
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+        self.reactor = reactor
+        self.salt = os.urandom(16)
+        # credentials key => expiration time, least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, username, password, otp) -> bytes:
+        return credentials_key(self.salt, username, password, otp)
+
+    def lookup(self, key) -> bool:
+        expires_at = self.entries.get(key)
+        if expires_at is not None:
+            if expires_at > self.reactor.seconds():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+            del self.entries[key]
+        self.misses += 1
+        return False
+
+    def store(self, result, key):
+        access, error = result
+        if access:
+            self.entries[key] = self.reactor.seconds() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return result
+
+    def verify(self, username, password, otp) -> (bool, (str or None)):
+        key = self.key(username, password, otp)
+        if self.lookup(key):
+            logger.debug("OTP verification served from cache")
+            return True, None
+        return self.store(self.backend.verify(username, password, otp), key)
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        key = self.key(username, password, otp)
+        if self.lookup(key):
+            logger.debug("OTP verification served from cache")
+            return defer.succeed((True, None))
+        d = defer.maybeDeferred(self.backend.verify_async, username, password, otp)
+        d.addCallback(self.store, key)
+        return d
+
+    def start(self):
+        self.backend.start()
+
+    def close(self) -> defer.Deferred:
+        return self.backend.close()
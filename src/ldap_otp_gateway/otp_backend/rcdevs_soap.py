@@ -1,78 +1,213 @@
 import logging
 import os
+import time
+from io import BytesIO
 
-import requests
+from twisted.internet import defer, protocol
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, ResponseDone, readBody
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
 
+from .. import metrics
+from ..logs import Loggable
+from .balancer import Balancer
 from .base_otp_backend import BaseOtpBackend
+from .resilience import LatencyTracker
 
-from xml.dom import minidom
-from xml.dom.minidom import Node
+from xml.parsers import expat
+
+logger = logging.getLogger(__name__)
 
 
 OTP_PROTOCOL = os.getenv('OTP_PROTOCOL', 'http')
 OTP_HOST = os.getenv('OTP_HOST', 'localhost')
 OTP_PORT = os.getenv('OTP_PORT', '8080')
 OTP_ENDPOINT = os.getenv('OTP_ENDPOINT', 'openotp/')
+# comma separated URIs of several equivalent OTP servers, replacing the settings above
+OTP_URIS = os.getenv('OTP_URIS', '')
 
+# Balancing between several OTP servers: `least_outstanding` or `ewma`, and passive ejection of the failing ones
+OTP_BALANCER = os.getenv('OTP_BALANCER', 'least_outstanding')
+OTP_EJECTION_FAILURES = os.getenv('OTP_EJECTION_FAILURES', '3')
+OTP_EJECTION_TIME = os.getenv('OTP_EJECTION_TIME', '30')
+# Send the same verification to a second OTP server when the first one is slower than usual. Only for OTP servers
+# sharing their replay protection, and answering a replayed OTP with a rejection
+OTP_HEDGE = os.getenv('OTP_HEDGE', 'false')
+OTP_HEDGE_PERCENTILE = os.getenv('OTP_HEDGE_PERCENTILE', '95')
+OTP_HEDGE_MIN_DELAY = os.getenv('OTP_HEDGE_MIN_DELAY', '0.01')
 
-def remove_blanks(node):
-    for x in node.childNodes:
-        if x.nodeType == Node.TEXT_NODE:
-            if x.nodeValue:
-                x.nodeValue = x.nodeValue.strip()
-        elif x.nodeType == Node.ELEMENT_NODE:
-            remove_blanks(x)
+# HTTP transport: `twisted` (non-blocking, persistent connections) or `requests` (legacy, blocking in a thread pool)
+OTP_HTTP_TRANSPORT = os.getenv('OTP_HTTP_TRANSPORT', 'twisted')
+OTP_HTTP_MAX_CONNECTIONS_PER_HOST = os.getenv('OTP_HTTP_MAX_CONNECTIONS_PER_HOST', '10')
+OTP_HTTP_IDLE_TIMEOUT = os.getenv('OTP_HTTP_IDLE_TIMEOUT', '30')
+OTP_HTTP_CONNECT_TIMEOUT = os.getenv('OTP_HTTP_CONNECT_TIMEOUT', '5')
+OTP_HTTP_READ_TIMEOUT = os.getenv('OTP_HTTP_READ_TIMEOUT', '10')
 
+HTTP_TRANSPORTS = ['twisted', 'requests']
 
-def normalize(xml_str) -> str:
-    xml = minidom.parseString(xml_str)
-    remove_blanks(xml)
-    xml.normalize()
-    return xml.toxml()
 
+SOAP_ENV_NAMESPACE = 'http://schemas.xmlsoap.org/soap/envelope/'
+OPENOTP_NAMESPACE = 'urn:openotp'
 
-def check_response(xml_str):
-    xml = minidom.parseString(normalize(xml_str))
-    if len(xml.childNodes) != 1:
-        raise Exception(f'Expected root size to be 1 but got {len(xml.childNodes)} instead. XML was "{xml.toxml()}"')
+ENVELOPE_NAME = f'{SOAP_ENV_NAMESPACE} Envelope'
+BODY_NAME = f'{SOAP_ENV_NAMESPACE} Body'
+RESPONSE_NAME = f'{OPENOTP_NAMESPACE} openotpSimpleLoginResponse'
+RESPONSE_FIELDS = ('code', 'error', 'message', 'data', 'concat')
+
+
+class InvalidResponse(Exception):
+    """
+    The OTP service replied, but not with a successful openotpSimpleLoginResponse.
+    """
+
+
+class SimpleLoginResponseParser:
+    """
+    Single pass, incremental parser of an openotpSimpleLoginResponse SOAP envelope.
+
+    Checks the Envelope/Body/openotpSimpleLoginResponse structure while the response chunks are
+    fed, without building any DOM, and collects the stripped text of the response fields.
+    Any unexpected structure raises an InvalidResponse, from `feed()` or `close()`.
+    """
+
+    def __init__(self):
+        self.parser = expat.ParserCreate(namespace_separator=' ')
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.character_data
+        self.depth = 0
+        # number of child elements of the envelope, the body and the response
+        self.sizes = [0, 0, 0]
+        self.field = None
+        self.text = []
+        self.fields = {}
+
+    def feed(self, chunk: bytes):
+        try:
+            self.parser.Parse(chunk, False)
+        except expat.ExpatError as e:
+            raise InvalidResponse(f'Malformed XML: {e}')
 
-    envelope_name = 'SOAP-ENV:Envelope'
-    if xml.childNodes[0].nodeName != envelope_name:
-        raise Exception(f'Expected root child node name to be "{envelope_name}" but got "{xml.childNodes[0].nodeName}" instead. XML was "{xml.toxml()}"')
+    def close(self) -> dict:
+        try:
+            self.parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise InvalidResponse(f'Malformed XML: {e}')
+        if self.sizes[0] != 1:
+            raise InvalidResponse(f'Expected envelope size to be 1 but got {self.sizes[0]} instead')
+        if self.sizes[1] != 1:
+            raise InvalidResponse(f'Expected body size to be 1 but got {self.sizes[1]} instead')
+        if self.sizes[2] != len(RESPONSE_FIELDS):
+            raise InvalidResponse(f'Expected response size to be {len(RESPONSE_FIELDS)} but got {self.sizes[2]} instead. '
+                                  f'Response fields were {self.fields}')
+        return self.fields
 
-    envelope = xml.childNodes[0]
+    def start_element(self, name, attributes):
+        self.depth += 1
+        if self.depth == 1:
+            expect_name('root', name, ENVELOPE_NAME)
+        elif self.depth == 2:
+            self.sizes[0] += 1
+            if self.sizes[0] > 1:
+                raise InvalidResponse('Expected envelope size to be 1 but got more')
+            expect_name('envelope', name, BODY_NAME)
+        elif self.depth == 3:
+            self.sizes[1] += 1
+            if self.sizes[1] > 1:
+                raise InvalidResponse('Expected body size to be 1 but got more')
+            expect_name('body', name, RESPONSE_NAME)
+        elif self.depth == 4:
+            self.sizes[2] += 1
+            if name not in RESPONSE_FIELDS:
+                raise InvalidResponse(f'Unexpected response field "{name}". Response fields were {self.fields}')
+            if name in self.fields:
+                raise InvalidResponse(f'Duplicated response field "{name}". Response fields were {self.fields}')
+            self.field = name
+            self.text = []
+        else:
+            raise InvalidResponse(f'Unexpected element "{name}" in response field "{self.field}"')
 
-    if len(envelope.childNodes) != 1:
-        raise Exception(f'Expected envelope size to be 1 but got {len(envelope.childNodes)} instead. Envelope was "{envelope.toxml()}"')
+    def end_element(self, name):
+        if self.depth == 4:
+            self.fields[self.field] = ''.join(self.text).strip()
+            self.field = None
+        self.depth -= 1
 
-    body_name = 'SOAP-ENV:Body'
-    if envelope.childNodes[0].nodeName != body_name:
-        raise Exception(f'Expected envelope child node name to be "{body_name}" but got "{envelope.childNodes[0].nodeName}" instead. Envelope was "{envelope.toxml()}"')
+    def character_data(self, data):
+        if self.field is not None:
+            self.text.append(data)
 
-    body = envelope.childNodes[0]
 
-    if len(body.childNodes) != 1:
-        raise Exception(f'Expected body size to be 1 but got {len(body.childNodes)} instead. Body was "{body.toxml()}"')
+def expect_name(parent, name, expected):
+    if name != expected:
+        raise InvalidResponse(f'Expected {parent} child node name to be "{expected}" but got "{name}" instead')
 
-    response_name = 'ns1:openotpSimpleLoginResponse'
-    if body.childNodes[0].nodeName != response_name:
-        raise Exception(f'Expected body child node name to be "{response_name}" but got "{body.childNodes[0].nodeName}" instead. Body was "{body.toxml()}"')
 
-    response = body.childNodes[0]
-    if len(response.childNodes) != 5:
-        raise Exception(f'Expected response size to be 5 but got {len(body.childNodes)} instead. Response was "{response.toxml()}')
+def check_fields(fields: dict):
+    code = fields['code']
+    if code != '1':
+        raise InvalidResponse(f'Expected response code to be "1" but got {code} instead. '
+                              f'Response message was "{fields["message"]}", error was "{fields["error"]}"')
 
-    code = response.childNodes[0]
-    if len(code.childNodes) != 1:
-        raise Exception(f'Expected response code size to be 1. Response was "{response.toxml()}')
-    if code.childNodes[0].nodeType != code.childNodes[0].TEXT_NODE:
-        raise Exception(f'Expected response code type to be textual. Response was "{response.toxml()}')
-    if code.childNodes[0].data != '1':
-        raise Exception(f'Expected response code to be "1" but got {code.childNodes[0].data} instead. Response was "{response.toxml()}')
 
+def check_response(xml_str):
+    parser = SimpleLoginResponseParser()
+    parser.feed(xml_str.encode() if isinstance(xml_str, str) else xml_str)
+    check_fields(parser.close())
     return True, None
 
 
+class SimpleLoginResponseProtocol(protocol.Protocol):
+    """
+    Feeds an HTTP response body to a SimpleLoginResponseParser as the chunks arrive.
+    `finished` fires with the parsed response fields, or with the parsing failure.
+    """
+
+    def __init__(self, finished: defer.Deferred):
+        self.finished = finished
+        self.parser = SimpleLoginResponseParser()
+        self.error = None
+
+    def dataReceived(self, data):
+        if self.error is not None:
+            return
+        try:
+            self.parser.feed(data)
+        except InvalidResponse as e:
+            # keep consuming the body so that the connection can be reused
+            self.error = e
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+            return
+        if self.error is None:
+            try:
+                fields = self.parser.close()
+            except InvalidResponse as e:
+                self.error = e
+        if self.error is not None:
+            self.finished.errback(self.error)
+        else:
+            self.finished.callback(fields)
+
+
+class Attempt:
+    """
+    Request to one of the OTP servers.
+    """
+    __slots__ = ('endpoint', 'deferred', 'replied', 'abandoned')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.deferred = None
+        # the Deferred is already called while waiting for the response body
+        self.replied = False
+        self.abandoned = False
+
+
 class OtpBackend(BaseOtpBackend):
     """
     Example success response:
@@ -90,11 +225,52 @@ class OtpBackend(BaseOtpBackend):
     </SOAP-ENV:Envelope>
     ```
     """
-    def __init__(self):
-        self.uri = f"{OTP_PROTOCOL}://{OTP_HOST}:{OTP_PORT}/{OTP_ENDPOINT}"
-        logging.debug(f"OtpBackend() uri={self.uri}")
+    def __init__(self, uri=None, transport=None, reactor=None, uris=None, balancer=None, hedge=None):
+        if uris is None:
+            if uri is not None:
+                uris = [uri]
+            elif OTP_URIS.strip():
+                uris = [item.strip() for item in OTP_URIS.split(',') if item.strip()]
+            else:
+                uris = [f"{OTP_PROTOCOL}://{OTP_HOST}:{OTP_PORT}/{OTP_ENDPOINT}"]
+        self.uris = uris
+        self.uri = uris[0]
+        self.transport = transport if transport is not None else OTP_HTTP_TRANSPORT
+        if self.transport not in HTTP_TRANSPORTS:
+            raise ValueError(f'OTP_HTTP_TRANSPORT must be one of {HTTP_TRANSPORTS}. found {self.transport} instead')
+        self.connect_timeout = float(OTP_HTTP_CONNECT_TIMEOUT)
+        self.read_timeout = float(OTP_HTTP_READ_TIMEOUT)
+        logger.debug(f"OtpBackend() uris={self.uris} transport={self.transport}")
 
-    def verify(self, username, password, otp) -> (bool, (str or None)):
+        self.balancer = Balancer(uris, policy=balancer if balancer is not None else OTP_BALANCER,
+                                 ejection_failures=int(OTP_EJECTION_FAILURES),
+                                 ejection_time=float(OTP_EJECTION_TIME))
+        if hedge is None:
+            if OTP_HEDGE.lower() not in ('true', 'false'):
+                raise ValueError(f'OTP_HEDGE must be either true or false. found {OTP_HEDGE} instead')
+            hedge = OTP_HEDGE.lower() == 'true'
+        if hedge and (len(uris) < 2 or self.transport != 'twisted'):
+            logger.warning("OTP_HEDGE requires several OTP_URIS and the twisted HTTP transport, ignored")
+            hedge = False
+        self.hedge = hedge
+        self.hedge_min_delay = float(OTP_HEDGE_MIN_DELAY)
+        self.latencies = LatencyTracker(percentile=float(OTP_HEDGE_PERCENTILE))
+
+        self.reactor = reactor
+        self.pool = None
+        self.agent = None
+        if self.transport == 'twisted':
+            if self.reactor is None:
+                from twisted.internet import reactor as default_reactor
+                self.reactor = default_reactor
+            self.pool = HTTPConnectionPool(self.reactor, persistent=True)
+            self.pool.maxPersistentPerHost = int(OTP_HTTP_MAX_CONNECTIONS_PER_HOST)
+            self.pool.cachedConnectionTimeout = float(OTP_HTTP_IDLE_TIMEOUT)
+            self.agent = Agent(self.reactor, connectTimeout=self.connect_timeout, pool=self.pool)
+        # cancelling a request aborts its connection, while the legacy transport goes on in its thread
+        self.cancellable = self.agent is not None
+
+    def request_data(self, username, password, otp) -> str:
         data = (
             "<SOAP-ENV:Envelope xmlns:SOAP-ENV=\"http://schemas.xmlsoap.org/soap/envelope/\" xmlns:xsi=\"http://www.w3.org/1999/XMLSchema-instance\" xmlns:xsd=\"http://www.w3.org/1999/XMLSchema\" SOAP-ENV:encodingStyle=\"http://schemas.xmlsoap.org/soap/encoding/\">"
             "<SOAP-ENV:Header/>"
@@ -112,24 +288,174 @@ class OtpBackend(BaseOtpBackend):
             "</SOAP-ENV:Body>"
             "</SOAP-ENV:Envelope>")
 
-        logging.error(f"RCDevs OTP Backend verify() Request data={data}".replace(
-            "{password}{otp}",
-            f"{'*'*len(password)}{'*'*len(otp)}"
-        ))
+        logger.debug("RCDevs OTP Backend verify() Request data=%s", Loggable(data))
+
+        return data
+
+    def verify(self, username, password, otp) -> (bool, (str or None)):
+        # only needed by the legacy transport
+        import requests
+
+        data = self.request_data(username, password, otp)
+
+        endpoint = self.balancer.select()
+        started_at = time.monotonic()
+        try:
+            r = requests.post(
+                endpoint.uri,
+                headers={"Content-Type": "text/xml"},
+                data=data,
+                timeout=(self.connect_timeout, self.read_timeout))
+
+            response_txt = r.text
+            logger.debug("RCDevs OTP Backend verify() Response: %s", Loggable(response_txt))
+
+            r.raise_for_status()
+        except Exception:
+            self.balancer.done(endpoint, time.monotonic() - started_at, False)
+            raise
+        self.balancer.done(endpoint, time.monotonic() - started_at, True)
+
+        return self.verify_response(response_txt)
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        if self.agent is None:
+            return super().verify_async(username, password, otp)
+
+        data = self.request_data(username, password, otp)
+        if self.hedge and self.latencies.value is not None:
+            return self.hedged_post(data)
+        return self.post(Attempt(self.balancer.select()), data)
 
-        r = requests.post(
-            self.uri,
-            headers={"Content-Type": "text/xml"},
-            data=data)
+    def post(self, attempt: Attempt, data: str) -> defer.Deferred:
+        """
+        Verification request to the endpoint of the attempt, accounted for by the balancer.
+        """
+        uri = attempt.endpoint.uri
+        started_at = self.reactor.seconds()
+        d = self.agent.request(
+            b'POST',
+            uri.encode(),
+            Headers({'Content-Type': ['text/xml']}),
+            FileBodyProducer(BytesIO(data.encode())))
 
-        response_txt = r.text
-        logging.debug(f"RCDevs OTP Backend verify() Response: {response_txt}")
+        def read(response):
+            if response.code >= 400:
+                def http_error(content):
+                    logger.debug("RCDevs OTP Backend verify() Response: %s", Loggable(content.decode(errors='replace')))
+                    raise Exception(f'RCDevs OTP Backend HTTP error {response.code} for url: {uri}')
 
-        r.raise_for_status()
+                return readBody(response).addCallback(http_error)
 
+            finished = defer.Deferred()
+            response.deliverBody(SimpleLoginResponseProtocol(finished))
+            return finished
+
+        def check(fields):
+            logger.debug("RCDevs OTP Backend verify() Response: %s", Loggable(fields))
+            check_fields(fields)
+            return True, None
+
+        def rejected(failure):
+            failure.trap(InvalidResponse)
+            return False, f'RCDevs OTP Backend replied: {failure.value}'
+
+        def timed_out(result, timeout):
+            # cancelling an Agent request fails with ResponseNeverReceived rather than CancelledError
+            raise defer.TimeoutError(f'RCDevs OTP Backend did not reply within {timeout} seconds')
+
+        def account(result):
+            if attempt.abandoned:
+                self.balancer.cancelled(attempt.endpoint)
+                return result
+            # rejected OTPs are proper replies of the OTP server
+            latency = self.reactor.seconds() - started_at
+            ok = not isinstance(result, Failure)
+            self.balancer.done(attempt.endpoint, latency, ok)
+            if ok:
+                self.latencies.add(latency)
+            return result
+
+        d.addCallback(read)
+        # the read timeout covers the whole exchange, from the request sending to the response body reading
+        d.addTimeout(self.read_timeout, self.reactor, onTimeoutCancel=timed_out)
+        d.addCallback(check)
+        d.addErrback(rejected)
+        d.addBoth(account)
+        attempt.deferred = d
+        return d
+
+    def hedged_post(self, data: str) -> defer.Deferred:
+        """
+        Verification request to an endpoint, followed by the same request to another endpoint if the first
+        one didn't reply within the usual latency. A success wins right away, whichever endpoint replies it,
+        while a rejection or an error only counts once no other request is pending: a replayed OTP rejected by
+        the slowest endpoint doesn't hide the success of the other one.
+        """
+        attempts = []
+        outcomes = []
+
+        def abandon(_=None):
+            if call.active():
+                call.cancel()
+            for attempt in attempts:
+                if not attempt.replied:
+                    attempt.abandoned = True
+                    attempt.deferred.cancel()
+
+        result = defer.Deferred(abandon)
+
+        def finish(outcome, attempt):
+            abandon()
+            if isinstance(outcome, Failure):
+                result.errback(outcome)
+                return
+            if outcome[0] and attempt is not attempts[0]:
+                # only a success replied by the hedge counts as won, a held rejection or error doesn't
+                metrics.OTP_HEDGED_REQUESTS.labels('won').inc()
+            result.callback(outcome)
+
+        def replied(outcome, attempt):
+            attempt.replied = True
+            if attempt.abandoned or result.called:
+                return
+            if not isinstance(outcome, Failure) and outcome[0]:
+                return finish(outcome, attempt)
+            if call.active():
+                # the first request failed before the hedge delay, the OTP server did reply
+                return finish(outcome, attempt)
+            outcomes.append((outcome, attempt))
+            if any(not other.replied for other in attempts):
+                # hold the rejection or error until the other request replies
+                return
+            finish(*outcomes[0])
+
+        def send(endpoint):
+            attempt = Attempt(endpoint)
+            attempts.append(attempt)
+            self.post(attempt, data).addBoth(replied, attempt)
+
+        def hedge():
+            metrics.OTP_HEDGED_REQUESTS.labels('sent').inc()
+            send(self.balancer.select(exclude=attempts[0].endpoint))
+
+        delay = max(self.hedge_min_delay, self.latencies.value)
+        call = self.reactor.callLater(delay, hedge)
+        send(self.balancer.select())
+        return result
+
+    def verify_response(self, response_txt) -> (bool, (str or None)):
         try:
             check_response(response_txt)
         except Exception as e:
             return False, f'RCDevs OTP Backend replied: {e}'
 
         return True, None
+
+    def close(self) -> defer.Deferred:
+        """
+        Close the persistent connections to the OTP server.
+        """
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
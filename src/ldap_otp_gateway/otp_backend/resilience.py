@@ -0,0 +1,202 @@
+import collections
+import logging
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from .. import metrics
+from .base_otp_backend import BaseOtpBackend, OtpBackendUnavailable
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class LatencyTracker:
+    """
+    Latencies of the last `size` successful calls, and their `percentile` recomputed every `refresh` samples.
+    """
+
+    def __init__(self, size=200, percentile=99.0, min_samples=20, refresh=20):
+        self.samples = collections.deque(maxlen=size)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self.pending = 0
+        self.value = None
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.pending += 1
+        if self.pending >= self.refresh and len(self.samples) >= self.min_samples:
+            self.pending = 0
+            samples = sorted(self.samples)
+            self.value = samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+
+
+class ResilientOtpBackend(BaseOtpBackend):
+    """
+    Wraps an OTP backend to protect the gateway and the OTP service from each other during partial outages:
+
+    * every call gets a deadline of `timeout_multiplier` times the `timeout_percentile` of the recent latencies,
+      bounded by `min_timeout` and `max_timeout` (`max_timeout` until enough latencies are known);
+    * at most `max_concurrency` calls are in flight, up to `queue_size` others wait for a slot at most
+      `queue_timeout` seconds;
+    * after `failure_threshold` consecutive errors or timeouts, the circuit opens and the verifications fail
+      right away for `reset_timeout` seconds. Then a single trial call closes the circuit again if it succeeds.
+
+    Rejected verifications fail with `OtpBackendUnavailable`. Failed OTP checks are not errors.
+
+    A call past its deadline is cancelled if the backend is `cancellable`. Otherwise, e.g. running in a thread, the
+    call goes on, and keeps its slot until it really finishes: `max_concurrency` caps the work actually running in
+    the backend, the other verifications waiting in the bounded queue.
+    """
+
+    def __init__(self, backend: BaseOtpBackend, min_timeout=0.5, max_timeout=10.0, timeout_percentile=99.0,
+                 timeout_multiplier=3.0, max_concurrency=50, queue_size=200, queue_timeout=5.0,
+                 failure_threshold=5, reset_timeout=30.0, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.backend = backend
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.reactor = reactor
+        self.latencies = LatencyTracker(percentile=timeout_percentile)
+
+        self.in_flight = 0
+        # Deferreds waiting for a slot, fired with None once they got one
+        self.queue = collections.deque()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_pending = False
+
+        metrics.OTP_BACKEND_IN_FLIGHT.set_function(lambda: self.in_flight)
+        metrics.OTP_BACKEND_QUEUED.set_function(lambda: len(self.queue))
+        metrics.OTP_BACKEND_DEADLINE.set_function(self.deadline)
+        for state in (CLOSED, OPEN, HALF_OPEN):
+            metrics.OTP_CIRCUIT_STATE.labels(state).set_function(lambda state=state: int(self.state == state))
+
+    def verify(self, username, password, otp) -> (bool, (str or None)):
+        return self.backend.verify(username, password, otp)
+
+    def start(self):
+        self.backend.start()
+
+    def close(self) -> defer.Deferred:
+        return self.backend.close()
+
+    def deadline(self) -> float:
+        if self.latencies.value is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.latencies.value * self.timeout_multiplier))
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.warning(f"OTP backend circuit {state}")
+            self.state = state
+
+    def reject(self, reason, message) -> defer.Deferred:
+        metrics.OTP_BACKEND_REJECTIONS.labels(reason).inc()
+        return defer.fail(OtpBackendUnavailable(message))
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        trial = False
+        if self.state != CLOSED:
+            if self.state == OPEN and self.reactor.seconds() - self.opened_at >= self.reset_timeout:
+                self.set_state(HALF_OPEN)
+            if self.state == OPEN or self.trial_pending:
+                return self.reject('circuit_open', "OTP backend unavailable")
+            # half open, let this call probe the OTP backend
+            trial = self.trial_pending = True
+
+        if self.in_flight < self.max_concurrency:
+            self.in_flight += 1
+            return self.call(username, password, otp, trial)
+
+        if len(self.queue) >= self.queue_size:
+            if trial:
+                self.trial_pending = False
+            return self.reject('queue_full', "Too many pending OTP verifications")
+
+        waiter = defer.Deferred()
+        self.queue.append(waiter)
+
+        def timed_out(result, timeout):
+            self.queue.remove(waiter)
+            if trial:
+                self.trial_pending = False
+            metrics.OTP_BACKEND_REJECTIONS.labels('queue_timeout').inc()
+            raise OtpBackendUnavailable(f"No OTP backend slot available after {timeout} seconds")
+
+        waiter.addTimeout(self.queue_timeout, self.reactor, onTimeoutCancel=timed_out)
+        waiter.addCallback(lambda _: self.call(username, password, otp, trial))
+        return waiter
+
+    def call(self, username, password, otp, trial) -> defer.Deferred:
+        started_at = self.reactor.seconds()
+        deadline = self.deadline()
+
+        def cancel(_):
+            if self.backend.cancellable:
+                backend_call.cancel()
+
+        # the outcome of the call for the caller, failing on the deadline even if the backend call goes on
+        d = defer.Deferred(cancel)
+
+        def finished(result):
+            # the slot is only given back once the backend is done, be it past the deadline
+            self.release()
+            if not d.called:
+                d.callback(result)
+            elif isinstance(result, Failure):
+                logger.debug(f"OTP backend call failed past its deadline: {result.value}")
+            return None
+
+        def timed_out(result, timeout):
+            metrics.OTP_BACKEND_REJECTIONS.labels('deadline').inc()
+            raise OtpBackendUnavailable(f"OTP backend didn't answer within {timeout:.3f} seconds")
+
+        def succeeded(result):
+            self.latencies.add(self.reactor.seconds() - started_at)
+            self.failures = 0
+            if trial or self.state != CLOSED:
+                self.set_state(CLOSED)
+            return result
+
+        def failed(failure):
+            self.failures += 1
+            if trial or self.failures >= self.failure_threshold:
+                self.opened_at = self.reactor.seconds()
+                self.set_state(OPEN)
+            return failure
+
+        def done(result):
+            if trial:
+                self.trial_pending = False
+            return result
+
+        d.addTimeout(deadline, self.reactor, onTimeoutCancel=timed_out)
+        d.addCallbacks(succeeded, failed)
+        d.addBoth(done)
+        backend_call = defer.maybeDeferred(self.backend.verify_async, username, password, otp)
+        backend_call.addBoth(finished)
+        return d
+
+    def release(self):
+        """
+        Give the slot of a finished call to the next waiting verification, if any.
+        """
+        if self.queue:
+            self.queue.popleft().callback(None)
+        else:
+            self.in_flight -= 1
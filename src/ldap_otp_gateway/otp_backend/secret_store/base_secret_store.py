@@ -0,0 +1,53 @@
+from twisted.internet import defer
+
+
+class BaseSecretStore:
+    """
+    Source of the OTP secrets of the users, for the backends verifying the OTP in-process.
+    """
+
+    # whether the store records the used time steps and counters for all the gateway processes and across restarts,
+    # `claim()` deciding which codes are accepted
+    persistent = False
+
+    def get(self, username) -> (str or None):
+        """
+        Base32 encoded OTP secret of the user, or None if the user has none.
+        """
+        raise NotImplementedError("Not implemented")
+
+    def get_async(self, username) -> defer.Deferred:
+        """
+        Non-blocking lookup, called from the reactor thread. Must return a Deferred firing the same
+        value as `get()`. Stores that need to block (e.g. on network) must override it.
+        """
+        return defer.maybeDeferred(self.get, username)
+
+    def claim(self, username, select) -> (int or None):
+        """
+        Record the time step (TOTP) or counter (HOTP) of a code accepted for the user. `select(last_used)` is given
+        the last step or counter recorded for the user, None if unknown, and returns the one to record, or None if
+        the code can't be accepted. Returns the recorded step or counter, or None.
+
+        Persistent stores look the last used step up and record the selected one atomically, so that a code is
+        only accepted once whatever the gateway process verifying it. The others don't record anything.
+        """
+        return select(None)
+
+    def claim_async(self, username, select) -> defer.Deferred:
+        """
+        Non-blocking claim, called from the reactor thread. Must return a Deferred firing the same value as
+        `claim()`. Stores that need to block must override it.
+        """
+        return defer.maybeDeferred(self.claim, username, select)
+
+    def start(self):
+        """
+        Start the background work of the store, if any, once the reactor runs. Called once by its backend.
+        """
+
+    def close(self):
+        """
+        Stop the store and release its resources, once its backend is replaced by a configuration reload
+        or on shutdown. May return a Deferred.
+        """
@@ -0,0 +1,249 @@
+"""
+PostgreSQL secret store, expecting the following schema (user DNs stored lower case):
+
+    CREATE TABLE otp_secrets (
+        username text PRIMARY KEY,
+        secret text NOT NULL
+    );
+    CREATE TABLE otp_used_steps (
+        username text NOT NULL,
+        step bigint NOT NULL,
+        used_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (username, step)
+    );
+
+Cached secrets are invalidated by notifications on the `OTP_SECRETS_PG_CHANNEL` channel, whose payload is the
+user DN, or empty to invalidate all of them. E.g. from a trigger on `otp_secrets`:
+
+    NOTIFY otp_secrets, 'cn=user,dc=example,dc=com';
+
+The used steps are recorded when a code is verified, the database deciding whether it was already used by any
+gateway process. Only the last used step of every user is worth keeping, the older ones are pruned.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer, task
+
+from .base_secret_store import BaseSecretStore
+
+logger = logging.getLogger(__name__)
+
+SELECT_SECRET = "SELECT secret FROM otp_secrets WHERE username = %s"
+# serializes the claims of a user until the end of their transaction, whatever the gateway process
+LOCK_USER = "SELECT pg_advisory_xact_lock(hashtext(%s))"
+SELECT_LAST_USED = "SELECT max(step) FROM otp_used_steps WHERE username = %s"
+INSERT_USED_STEP = "INSERT INTO otp_used_steps (username, step) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING step"
+PRUNE_USED_STEPS = ("DELETE FROM otp_used_steps u USING otp_used_steps n "
+                    "WHERE n.username = u.username AND n.step > u.step")
+
+
+def claim_step(cursor, username, select) -> (int or None):
+    """
+    Record the step selected from the last one used by the user, in the transaction of `cursor`.
+    Returns the recorded step, or None if none was selected or it was already recorded.
+    """
+    cursor.execute(LOCK_USER, (username,))
+    cursor.execute(SELECT_LAST_USED, (username,))
+    [last_used] = cursor.fetchone()
+    step = select(last_used)
+    if step is None:
+        return None
+    cursor.execute(INSERT_USED_STEP, (username, step))
+    return None if cursor.fetchone() is None else step
+
+
+class CachedSecret:
+    __slots__ = ('secret', 'expires_at')
+
+    def __init__(self, secret, expires_at):
+        self.secret = secret
+        self.expires_at = expires_at
+
+
+class NotificationListener:
+    """
+    Listens to a PostgreSQL notification channel from a dedicated thread and connection, calling
+    `callback(payload)` in the reactor thread for every notification, and `callback(None)` after
+    (re)connecting, as notifications may have been missed meanwhile.
+    """
+
+    def __init__(self, dsn, channel, callback, reactor, poll_timeout=1.0, retry_delay=5.0):
+        self.dsn = dsn
+        self.channel = channel
+        self.callback = callback
+        self.reactor = reactor
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.listen, name='otp-secrets-listener', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def listen(self):
+        import psycopg
+        from psycopg import sql
+
+        while not self.stopping.is_set():
+            try:
+                with psycopg.connect(self.dsn, autocommit=True) as connection:
+                    connection.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    self.reactor.callFromThread(self.callback, None)
+                    while not self.stopping.is_set():
+                        for notify in connection.notifies(timeout=self.poll_timeout):
+                            self.reactor.callFromThread(self.callback, notify.payload)
+            except Exception as e:
+                logger.warning(f"OTP secrets notification listener failed: {e}. "
+                               f"Retrying in {self.retry_delay} seconds")
+                self.stopping.wait(self.retry_delay)
+
+
+class SecretStore(BaseSecretStore):
+    """
+    Secrets stored in PostgreSQL, looked up through a Twisted adbapi pool of psycopg connections so that
+    the reactor never waits on the database. Secrets are cached for `OTP_SECRETS_CACHE_TTL` seconds, the users
+    without any for `OTP_SECRETS_MISS_CACHE_TTL` seconds, up to `OTP_SECRETS_CACHE_MAX_SIZE` users forgetting first
+    the least recently looked up ones, and invalidated on notification. The used steps are claimed in the database,
+    never from the cache, and pruned every `OTP_SECRETS_PRUNE_INTERVAL` seconds. The blocking `get()` and `claim()`
+    open their own connection.
+    """
+
+    persistent = True
+
+    def __init__(self, dsn=None, pool=None, cache_ttl=None, miss_cache_ttl=None, cache_max_size=None,
+                 prune_interval=None, listen=True, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        # read when built rather than when imported, as this module is not executed again by a configuration reload
+        self.dsn = dsn if dsn is not None else os.getenv('OTP_SECRETS_PG_DSN', '')
+        if pool is None:
+            if not self.dsn:
+                raise ValueError('OTP_SECRETS_PG_DSN is required by the PostgreSQL OTP secret store')
+            pool = adbapi.ConnectionPool('psycopg', conninfo=self.dsn,
+                                         cp_min=int(os.getenv('OTP_SECRETS_PG_POOL_MIN', '1')),
+                                         cp_max=int(os.getenv('OTP_SECRETS_PG_POOL_MAX', '5')),
+                                         cp_reconnect=True, cp_reactor=reactor)
+        self.pool = pool
+        self.cache_ttl = float(cache_ttl if cache_ttl is not None else os.getenv('OTP_SECRETS_CACHE_TTL', '300'))
+        # any client can look up made up DNs before being authenticated: they are cached shortly, and the cache bounded
+        self.miss_cache_ttl = float(miss_cache_ttl if miss_cache_ttl is not None
+                                    else os.getenv('OTP_SECRETS_MISS_CACHE_TTL', '5'))
+        self.cache_max_size = int(cache_max_size if cache_max_size is not None
+                                  else os.getenv('OTP_SECRETS_CACHE_MAX_SIZE', '10000'))
+        self.prune_interval = float(prune_interval if prune_interval is not None
+                                    else os.getenv('OTP_SECRETS_PRUNE_INTERVAL', '3600'))
+        self.reactor = reactor
+
+        # user => CachedSecret, least recently looked up first
+        self.cache = OrderedDict()
+        self.pending = {}
+        # bumped on every invalidation, so that lookups started before one are not cached
+        self.invalidations = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.pruner = task.LoopingCall(self.prune)
+        self.pruner.clock = reactor
+        self.listener = None
+        if listen:
+            self.listener = NotificationListener(self.dsn, os.getenv('OTP_SECRETS_PG_CHANNEL', 'otp_secrets'),
+                                                 self.invalidate, reactor)
+
+    def start(self):
+        if self.prune_interval > 0:
+            self.pruner.start(self.prune_interval, now=False)
+        if self.listener is not None:
+            self.listener.start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+        if self.pruner.running:
+            self.pruner.stop()
+        self.pool.close()
+
+    def connect(self):
+        import psycopg
+
+        return psycopg.connect(self.dsn)
+
+    def get(self, username) -> (str or None):
+        with self.connect() as connection:
+            row = connection.execute(SELECT_SECRET, (str.lower(username),)).fetchone()
+        return None if row is None else row[0]
+
+    def get_async(self, username) -> defer.Deferred:
+        username = str.lower(username)
+        cached = self.cache.get(username)
+        if cached is not None:
+            if cached.expires_at > self.reactor.seconds():
+                self.cache.move_to_end(username)
+                self.hits += 1
+                return defer.succeed(cached.secret)
+            del self.cache[username]
+        self.misses += 1
+
+        # concurrent lookups of the same user share the query
+        waiters = self.pending.get(username)
+        if waiters is not None:
+            waiter = defer.Deferred()
+            waiters.append(waiter)
+            return waiter
+        waiters = self.pending[username] = []
+        invalidations = self.invalidations
+
+        def loaded(rows):
+            secret = rows[0][0] if rows else None
+            ttl = self.cache_ttl if secret is not None else self.miss_cache_ttl
+            if invalidations == self.invalidations and ttl > 0 and self.cache_max_size > 0:
+                self.cache[username] = CachedSecret(secret, self.reactor.seconds() + ttl)
+                self.cache.move_to_end(username)
+                while len(self.cache) > self.cache_max_size:
+                    self.cache.popitem(last=False)
+            return secret
+
+        def done(result):
+            del self.pending[username]
+            for waiter in waiters:
+                waiter.callback(result)
+            return result
+
+        d = self.pool.runQuery(SELECT_SECRET, (username,))
+        d.addCallback(loaded)
+        d.addBoth(done)
+        return d
+
+    def claim(self, username, select) -> (int or None):
+        # committed when leaving the connection block
+        with self.connect() as connection:
+            return claim_step(connection.cursor(), str.lower(username), select)
+
+    def claim_async(self, username, select) -> defer.Deferred:
+        return self.pool.runInteraction(claim_step, str.lower(username), select)
+
+    def prune(self) -> defer.Deferred:
+        """
+        Delete the used steps older than the last one of their user, which alone decides of the next claims.
+        """
+        def failed(failure):
+            logger.error(f"Failed to prune the used OTP steps: {failure.value}")
+
+        d = self.pool.runOperation(PRUNE_USED_STEPS)
+        d.addErrback(failed)
+        return d
+
+    def invalidate(self, username=None):
+        self.invalidations += 1
+        if username:
+            self.cache.pop(str.lower(username), None)
+        else:
+            self.cache.clear()
@@ -0,0 +1,28 @@
+import json
+import logging
+import os
+
+from .base_secret_store import BaseSecretStore
+
+logger = logging.getLogger(__name__)
+
+
+class SecretStore(BaseSecretStore):
+    """
+    Static secrets, loaded at startup from a JSON object mapping the user DNs to their base32 secrets,
+    either given in `OTP_SECRETS` or in the `OTP_SECRETS_FILE` file. DNs are compared case-insensitively.
+    """
+
+    def __init__(self, secrets: dict[str, str] = None):
+        if secrets is None:
+            secrets_file = os.getenv('OTP_SECRETS_FILE', None)
+            if secrets_file is not None:
+                with open(secrets_file) as f:
+                    secrets = json.load(f)
+            else:
+                secrets = json.loads(os.getenv('OTP_SECRETS', '{}'))
+        self.secrets = {str.lower(username): secret for username, secret in secrets.items()}
+        logger.info(f"Static OTP secret store of {len(self.secrets)} users")
+
+    def get(self, username) -> (str or None):
+        return self.secrets.get(str.lower(username))
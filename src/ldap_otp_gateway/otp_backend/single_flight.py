@@ -0,0 +1,54 @@
+import logging
+import os
+
+from twisted.internet import defer
+
+from .base_otp_backend import BaseOtpBackend, credentials_key
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlightOtpBackend(BaseOtpBackend):
+    """
+    Wraps an OTP backend so that concurrent verifications of the same credentials share a single
+    backend call: the ones arriving while a verification is pending wait for its result instead
+    of submitting the same OTP again.
+    """
+
+    def __init__(self, backend: BaseOtpBackend):
+        self.backend = backend
+        self.salt = os.urandom(16)
+        # credentials key => Deferreds waiting for the pending verification
+        self.pending = {}
+        self.coalesced = 0
+
+    def verify(self, username, password, otp) -> (bool, (str or None)):
+        return self.backend.verify(username, password, otp)
+
+    def start(self):
+        self.backend.start()
+
+    def close(self) -> defer.Deferred:
+        return self.backend.close()
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        key = credentials_key(self.salt, username, password, otp)
+        waiters = self.pending.get(key)
+        if waiters is not None:
+            logger.debug("Joining the pending verification of the same credentials")
+            self.coalesced += 1
+            waiter = defer.Deferred()
+            waiters.append(waiter)
+            return waiter
+
+        waiters = self.pending[key] = []
+
+        def done(result):
+            del self.pending[key]
+            for waiter in waiters:
+                waiter.callback(result)
+            return result
+
+        d = defer.maybeDeferred(self.backend.verify_async, username, password, otp)
+        d.addBoth(done)
+        return d
@@ -0,0 +1,185 @@
+import hashlib
+import hmac
+import importlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import pyotp
+from twisted.internet import defer
+
+from .base_otp_backend import BaseOtpBackend
+from .secret_store.base_secret_store import BaseSecretStore
+
+logger = logging.getLogger(__name__)
+
+# `totp` (time based) or `hotp` (counter based)
+OTP_TOTP_MODE = os.getenv('OTP_TOTP_MODE', 'totp')
+OTP_TOTP_DIGITS = os.getenv('OTP_TOTP_DIGITS', '6')
+OTP_TOTP_PERIOD = os.getenv('OTP_TOTP_PERIOD', '30')
+OTP_TOTP_DIGEST = os.getenv('OTP_TOTP_DIGEST', 'sha1')
+# time steps accepted before and after the current one (totp), or counters accepted ahead of the expected one (hotp)
+OTP_TOTP_DRIFT = os.getenv('OTP_TOTP_DRIFT', '1')
+OTP_TOTP_REPLAY_CACHE_SIZE = os.getenv('OTP_TOTP_REPLAY_CACHE_SIZE', '100000')
+OTP_SECRET_STORE_MODULE_NAME = os.getenv('OTP_SECRET_STORE_MODULE_NAME',
+                                         'ldap_otp_gateway.otp_backend.secret_store.static')
+
+MODES = ['totp', 'hotp']
+
+
+class ReplayGuard:
+    """
+    Remembers the last time step used by every user, so that a code is never accepted twice.
+    Bounded to `max_size` users, forgetting first the ones that didn't authenticate for the longest.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # user => last used time step, least recently used first
+        self.last_steps = OrderedDict()
+
+    def used(self, username, step) -> bool:
+        last = self.last_steps.get(username)
+        return last is not None and step <= last
+
+    def take_over(self, last_steps):
+        """
+        Remember the last used time steps of another guard, the most recently used ones last.
+        """
+        self.last_steps.update(last_steps)
+        while len(self.last_steps) > self.max_size:
+            self.last_steps.popitem(last=False)
+
+    def use(self, username, step, oldest_valid_step):
+        self.last_steps[username] = step
+        self.last_steps.move_to_end(username)
+        # steps that can't be submitted anymore are not worth remembering
+        while self.last_steps:
+            first = next(iter(self.last_steps))
+            if self.last_steps[first] >= oldest_valid_step and len(self.last_steps) <= self.max_size:
+                break
+            del self.last_steps[first]
+
+
+class OtpBackend(BaseOtpBackend):
+    """
+    Verifies TOTP (RFC 6238) or HOTP (RFC 4226) codes in-process, against the user secrets of a secret store
+    plugin (`OTP_SECRET_STORE_MODULE_NAME`, a module containing a `SecretStore` class extending `BaseSecretStore`).
+
+    TOTP replay protection is kept in memory, per gateway process, and the accepted codes claimed from the secret
+    store: a `persistent` store rejects the codes already used through any gateway process. HOTP counters are only
+    kept by the secret store, which must be `persistent`.
+    """
+
+    def __init__(self, secret_store: BaseSecretStore = None, mode=None, digits=None, period=None, digest=None,
+                 drift=None, replay_cache_size=None, clock=time.time):
+        self.mode = mode if mode is not None else OTP_TOTP_MODE
+        if self.mode not in MODES:
+            raise ValueError(f'OTP_TOTP_MODE must be one of {MODES}. found {self.mode} instead')
+        try:
+            self.digits = int(digits if digits is not None else OTP_TOTP_DIGITS)
+            self.period = int(period if period is not None else OTP_TOTP_PERIOD)
+            self.drift = int(drift if drift is not None else OTP_TOTP_DRIFT)
+            replay_cache_size = int(replay_cache_size if replay_cache_size is not None else OTP_TOTP_REPLAY_CACHE_SIZE)
+        except ValueError as e:
+            raise ValueError(f'OTP_TOTP_DIGITS, OTP_TOTP_PERIOD, OTP_TOTP_DRIFT and OTP_TOTP_REPLAY_CACHE_SIZE '
+                             f'must be integer values: {e}')
+        digest = digest if digest is not None else OTP_TOTP_DIGEST
+        if digest not in hashlib.algorithms_guaranteed:
+            raise ValueError(f'OTP_TOTP_DIGEST must be a hashlib algorithm. found {digest} instead')
+        self.digest = getattr(hashlib, digest)
+
+        if secret_store is None:
+            logger.info(f"Loading OTP secret store: {OTP_SECRET_STORE_MODULE_NAME}")
+            secret_store = getattr(importlib.import_module(OTP_SECRET_STORE_MODULE_NAME), 'SecretStore')()
+        assert isinstance(secret_store, BaseSecretStore)
+        if self.mode == 'hotp' and not secret_store.persistent:
+            raise ValueError(f'OTP_TOTP_MODE hotp requires a secret store persisting the counters, such as the '
+                             f'PostgreSQL one. found {type(secret_store).__module__} instead')
+        if not secret_store.persistent:
+            logger.warning(f"{type(secret_store).__module__} doesn't record the used time steps: a code may be "
+                           f"accepted once by every gateway process, and again after a restart")
+        self.secret_store = secret_store
+        self.clock = clock
+        self.replay_guard = ReplayGuard(replay_cache_size)
+        logger.info(f"{self.mode.upper()} backend: digits={self.digits} period={self.period} drift={self.drift}")
+
+    def verify(self, username, password, otp) -> (bool, (str or None)):
+        return self.check(username, self.secret_store.get(username), otp, self.secret_store.claim)
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        d = self.secret_store.get_async(username)
+        d.addCallback(lambda secret: self.check(username, secret, otp, self.secret_store.claim_async))
+        return d
+
+    def take_over(self, previous):
+        # the time steps of the codes already used stay valid with the same period
+        if getattr(previous, 'period', None) == self.period and hasattr(previous, 'replay_guard'):
+            self.replay_guard.take_over(previous.replay_guard.last_steps)
+
+    def start(self):
+        self.secret_store.start()
+
+    def close(self) -> defer.Deferred:
+        return defer.maybeDeferred(self.secret_store.close)
+
+    def check(self, username, secret, otp, claim) -> ((bool, (str or None)) or defer.Deferred):
+        """
+        Check the OTP of the user, claiming its step or counter through `claim`, `claim()` or `claim_async()` of the
+        secret store. Returns the verification result, or a Deferred firing it if the claim returned a Deferred.
+        """
+        if secret is None:
+            return False, 'No OTP enrolled for this user'
+        if len(otp) != self.digits or not otp.isdigit():
+            return False, f'Expected a {self.digits} digits OTP'
+
+        username = str.lower(username)
+        if self.mode == 'totp':
+            return self.check_totp(username, pyotp.TOTP(secret, digits=self.digits, digest=self.digest), otp, claim)
+        return self.check_hotp(username, pyotp.HOTP(secret, digits=self.digits, digest=self.digest), otp, claim)
+
+    def check_totp(self, username, generator: pyotp.TOTP, otp, claim):
+        current = int(self.clock()) // self.period
+        for step in range(current - self.drift, current + self.drift + 1):
+            if hmac.compare_digest(generator.generate_otp(step), otp):
+                break
+        else:
+            return False, 'Invalid OTP'
+        if self.replay_guard.used(username, step):
+            return False, 'OTP already used'
+
+        def claimed(claimed_step):
+            if claimed_step is None:
+                # used through another gateway process
+                return False, 'OTP already used'
+            self.replay_guard.use(username, step, current - self.drift)
+            return True, None
+
+        return then(claim(username, lambda last_used: step if last_used is None or step > last_used else None),
+                    claimed)
+
+    def check_hotp(self, username, generator: pyotp.HOTP, otp, claim):
+        def select(last_used):
+            # may run in a database thread
+            counter = 0 if last_used is None else last_used + 1
+            for candidate in range(counter, counter + self.drift + 1):
+                if hmac.compare_digest(generator.generate_otp(candidate), otp):
+                    return candidate
+            return None
+
+        def claimed(counter):
+            if counter is None:
+                return False, 'Invalid OTP'
+            return True, None
+
+        return then(claim(username, select), claimed)
+
+
+def then(result, callback):
+    """
+    `callback(result)`, once fired if `result` is a Deferred.
+    """
+    if isinstance(result, defer.Deferred):
+        return result.addCallback(callback)
+    return callback(result)
@@ -1,3 +1,8 @@
 class BaseOTPExtractor(object):
     def extract(self, request) -> [str, str, str]:
         raise NotImplementedError("Please implement")
+
+    def close(self):
+        """
+        Release the resources of the extractor once replaced by a configuration reload. May return a Deferred.
+        """
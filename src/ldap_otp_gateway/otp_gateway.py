@@ -1,102 +1,399 @@
 import logging
+import time
+from functools import partial
 
 import ldaptor.protocols.pureldap
-from ldaptor.protocols import pureldap
-from ldaptor.protocols.ldap import ldaperrors
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.ldap import ldaperrors, ldapserver
 from ldaptor.protocols.ldap.proxybase import ProxyBase
-from twisted.internet import defer
+from twisted.internet import defer, protocol
 
-from .gateway_filter.base_gateway_filter import BaseGatewayFilter
-from .otp_backend.base_otp_backend import BaseOtpBackend
-from .otp_extractor.base_otp_extractor import BaseOTPExtractor
+from . import ber, metrics
+from .components import Components, ComponentsHolder
+from .logs import Loggable
+from .otp_backend.base_otp_backend import OtpBackendUnavailable
+from .rate_limit import LOCKOUT
+from .search_cache import written_dns
+
+logger = logging.getLogger(__name__)
 
-OTP_REQUEST_ATTR = "otp"
-GATEWAY_PASS_THROUGH_ATTR = "pass_through"
 GATEWAY_PASS_THROUGH_FORWARD_VALUE = b"forward"
 GATEWAY_PASS_THROUGH_FILTER_VALUE = b"filter"
 
+# When the OTP of a filtered bind is verified:
+# - sequential: once the backend accepted the password, the bind taking both round trips
+# - parallel: along the backend bind, the bind taking the slowest of both round trips
+# - otp_first: before forwarding the bind to the backend, sparing it the binds with a wrong OTP
+SEQUENTIAL = 'sequential'
+PARALLEL = 'parallel'
+OTP_FIRST = 'otp_first'
+VERIFY_ORDERS = [SEQUENTIAL, PARALLEL, OTP_FIRST]
+
+
+class BindContext:
+    """
+    State of a bind request along its handling, from its reception to its response.
+    """
+    __slots__ = ('received_at', 'forwarded_at', 'pass_through', 'otp', 'components', 'otp_verification', 'audit')
+
+    def __init__(self, received_at):
+        # time.perf_counter() values of the bind request reception and forwarding to the backend
+        self.received_at = received_at
+        self.forwarded_at = None
+        # GATEWAY_PASS_THROUGH_FORWARD_VALUE or GATEWAY_PASS_THROUGH_FILTER_VALUE
+        self.pass_through = None
+        # OTP extracted from the password of a filtered bind
+        self.otp = None
+        # Components the bind started with, verifying its OTP even if a configuration reload replaced them meanwhile
+        self.components = None
+        # Deferred verification of the OTP started before the backend bind answered, see VERIFY_ORDERS
+        self.otp_verification = None
+        # audit record of the bind, completed along its handling
+        self.audit = None
+
 
 class OtpGateway(ProxyBase):
+    # LDAPClientPool the backend connection is checked out from, if any
+    backend_pool = None
+    # whether a bind request has been forwarded on the backend connection
+    backend_bound = False
+    # whether to open the backend connection on the first request to forward rather than on connection
+    lazy_backend = False
+    # whether the backend connection was requested, always once connected unless lazy
+    backend_requested = False
+    # whether to relay the operations other than binds without decoding them, once bound
+    relay = False
+    # whether the operations other than binds are currently relayed
+    relaying = False
+    # when the OTP of the filtered binds is verified, one of VERIFY_ORDERS
+    verify_order = SEQUENTIAL
+    # BindLimiter shared by the connections of the process, if any
+    rate_limiter = None
+    # client IP address, the key of the rate limits by address
+    peer_address = None
+    # SearchCache shared by the connections of the process, if any
+    search_cache = None
+    # DN the backend connection is bound with, keying the cached searches of the connection
+    bound_dn = b''
+    # AuditLog shared by the connections of the process, if any
+    audit_log = None
+    # (request, BindContext or PendingSearch) of the requests being forwarded, by request identity: ProxyBase hands
+    # the request objects, not their message IDs, to the hooks. Created by the first request needing it
+    in_flight = None
 
-    def __init__(self, otp_backend, otp_extractor, gateway_filter=None):
+    def __init__(self, otp_backend, otp_extractor, gateway_filter=None, components: ComponentsHolder = None):
         super().__init__()
 
-        assert otp_backend is not None and isinstance(otp_backend, BaseOtpBackend)
-        assert otp_extractor is not None and isinstance(otp_extractor, BaseOTPExtractor)
-        assert gateway_filter is None or isinstance(gateway_filter, BaseGatewayFilter)
+        # the holder shared by all the connections of the process if given, swapped on configuration reload
+        self.components = components if components is not None else ComponentsHolder(
+            Components(otp_backend, otp_extractor, gateway_filter))
+        # the attributes assigned along the connection are declared upfront: the instances then share their
+        # attribute names instead of each holding a full __dict__ once the later ones are assigned
+        self.factory = None
+        self.transport = None
+        self.client = None
+        self.unbound = False
+        self.peer_address = None
+        self.backend_requested = False
+        self.backend_bound = False
+        self.relaying = False
+        self.bound_dn = b''
+        self.in_flight = None
 
-        self.otp_backend = otp_backend
-        self.otp_extractor = otp_extractor
-        self.gateway_filter = gateway_filter
+    def connectionMade(self):
+        self.peer_address = getattr(self.transport.getPeer(), 'host', None)
+        if isinstance(self.factory, OtpGatewayFactory):
+            self.factory.connection_made(self)
+        if self.lazy_backend:
+            # requests are queued by ProxyBase until connected to the backend
+            ldapserver.BaseLDAPServer.connectionMade(self)
+        else:
+            self.backend_requested = True
+            super().connectionMade()
+
+    def _forwardRequestToProxiedServer(self, request, controls, reply):
+        if not self.backend_requested:
+            self.backend_requested = True
+            d = self.clientConnector()
+            d.addCallback(self._connectedToProxiedServer)
+            d.addErrback(self._failedToConnectToProxiedServer)
+        super()._forwardRequestToProxiedServer(request, controls, reply)
 
     def connectionLost(self, reason):
+        if isinstance(self.factory, OtpGatewayFactory):
+            self.factory.connection_lost(self)
+        if self.backend_pool is not None and self.client is not None:
+            # give the backend connection back instead of unbinding it
+            client, self.client = self.client, None
+            self.backend_pool.release(client, bound=self.backend_bound)
         super().connectionLost(reason)
 
+    def dataReceived(self, data):
+        if not self.relaying:
+            return super().dataReceived(data)
+
+        relayed = ber.RELAYABLE_REQUEST_TAGS if self.search_cache is None else ber.UNCACHED_RELAYABLE_REQUEST_TAGS
+        self.buffer += data
+        offset = 0
+        try:
+            while True:
+                envelope = ber.peek_message(self.buffer, offset)
+                if envelope is None:
+                    break
+                message_id, tag, operation, end = envelope
+                if tag in relayed and self.client is not None and self.client.connected:
+                    self.client.relay(self.buffer, operation, end, partial(self.relay_response, message_id))
+                else:
+                    # binds, unbinds, abandons and extended operations are still handled by the proxy
+                    message, _ = pureber.berDecodeObject(self.berdecoder, self.buffer[offset:end])
+                    if message is not None:
+                        self.handle(message)
+                offset = end
+        except ValueError:
+            # not an LDAPMessage, leave it to the LDAP server
+            self.buffer = self.buffer[offset:]
+            return super().dataReceived(b'')
+        self.buffer = self.buffer[offset:]
+
+    def relay_response(self, message_id, buffer, operation, end):
+        if self.connected:
+            self.transport.write(ber.with_message_id(buffer, operation, end, message_id))
+
+    def start_relaying(self, response):
+        if isinstance(response, pureldap.LDAPBindResponse) and response.resultCode == ldaperrors.Success.resultCode:
+            self.relaying = True
+        return response
+
+    def handle_LDAPUnbindRequest(self, request, controls, reply):
+        if self.backend_pool is None and self.backend_requested:
+            return super().handle_LDAPUnbindRequest(request, controls, reply)
+        # the pooled backend connection outlives the frontend one, and a lazy one may not even be opened: don't
+        # forward the unbind
+        self.unbound = True
+        self.transport.loseConnection()
+
+    def _gotResponseFromProxiedServer(self, response, reply, request, controls, dseq):
+        super()._gotResponseFromProxiedServer(response, reply, request, controls, dseq)
+        # ProxyBase only considers bind responses and search done as final, leaving the other
+        # operations forever on the backend client wire
+        return not isinstance(response, (pureldap.LDAPSearchResultEntry, pureldap.LDAPSearchResultReference))
+
     def handleProxiedResponse(self, response, request, controls):
-        logging.info("Front end request => " + repr(request))
-        logging.info("Backend response => " + repr(response))
+        # every proxied operation goes through here, don't even build the log arguments when not needed
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Front end request => %s", Loggable(request))
+            logger.debug("Backend response => %s", Loggable(response))
 
-        r = response
+        d = defer.succeed(response)
         if isinstance(request, ldaptor.protocols.pureldap.LDAPBindRequest):
-
-            pass_through = None
-            try:
-                pass_through = getattr(request, GATEWAY_PASS_THROUGH_ATTR)
-            except AttributeError:
+            # a bind gets a single response
+            context = self.tracked(request, done=True)
+            if context is None:
                 error = ("Something really bad happened while trying to load the pass through behaviour after"
                          "passing the request to the backend")
-                logging.error(error)
-                r = pureldap.LDAPBindResponse(
-                    ldaperrors.LDAPUnknownError.resultCode,
-                    errorMessage=error)
+                logger.error(error)
+                return defer.succeed(pureldap.LDAPBindResponse(ldaperrors.LDAPOther.resultCode, errorMessage=error))
+
+            record = context.audit
+            if context.forwarded_at is not None:
+                if record is None:
+                    metrics.STAGE_BACKEND.time(context.forwarded_at)
+                else:
+                    record['timings']['backend'] = backend = time.perf_counter() - context.forwarded_at
+                    metrics.STAGE_BACKEND.observe(backend)
 
-            if pass_through == GATEWAY_PASS_THROUGH_FILTER_VALUE:
+            if self.search_cache is not None:
+                # from the backend response: a bind accepted by the backend but whose OTP is rejected still leaves
+                # the backend connection bound as its DN
+                self.bind_identity(response, request.dn)
+
+            if context.pass_through == GATEWAY_PASS_THROUGH_FILTER_VALUE:
                 if not isinstance(response, ldaptor.protocols.pureldap.LDAPBindResponse):
                     error = f"Unknown LDAP response type to initial LDAPBindRequest request: {response.__class__}"
-                    logging.error(error)
-                    r = pureldap.LDAPBindResponse(
-                        ldaperrors.LDAPUnknownError.resultCode,
-                        errorMessage=error)
+                    logger.error(error)
+                    d = defer.succeed(pureldap.LDAPBindResponse(
+                        ldaperrors.LDAPOther.resultCode,
+                        errorMessage=error))
+                elif response.resultCode == 0:
+                    d = self.otp_bind(request, response, context)
 
-                if response.resultCode == 0:
-                    r = self.otp_bind(request, response)
+            if context.components is not None:
+                d.addBoth(self.release_components, context.components)
 
-        if r != response:
-            logging.info("Gateway modified response => " + repr(r))
+            if self.rate_limiter is not None:
+                d.addCallback(self.bind_answered, request.dn)
 
-        return defer.succeed(r)
+            if self.relay and not self.relaying:
+                d.addCallback(self.start_relaying)
 
-    def otp_bind(self, request: ldaptor.protocols.pureldap.LDAPBindRequest, response):
-        user = request.dn.decode()
-        password = request.auth.decode()
-        try:
-            otp = getattr(request, OTP_REQUEST_ATTR).decode()
-        except AttributeError:
-            error = ("Something really bad happened. OTP couldn't be loaded back by the gateway"
-                     "from request after forwarding it to the backend")
-            logging.error(error)
-            return pureldap.LDAPBindResponse(ldaperrors.LDAPUnknownError.resultCode,
-                                             errorMessage=error)
+            if record is not None:
+                d.addCallback(self.audited, context)
 
-        logging.debug(f"otp_bind user:{user}")
+            if d.called:
+                # spare a callback when the response is already known, e.g. pass through or cached binds
+                metrics.STAGE_TOTAL.time(context.received_at)
+            else:
+                d.addCallback(self.observe_total, context.received_at)
 
-        try:
-            access, error = self.otp_backend.verify(user, password, otp)
-            if access:
-                if response is not None:
-                    logging.info("Successful OTP verification, forwarding backend response")
-                    return response
+        elif self.search_cache is not None:
+            pending = self.tracked(request)
+            if pending is not None:
+                self.search_cache.collect(pending, response)
+                if pending.responses is None:
+                    # stored or not cacheable, the following responses are left alone
+                    self.tracked(request, done=True)
+            else:
+                for rdns in written_dns(request):
+                    self.search_cache.invalidate(rdns)
+
+        if not debug:
+            return d
+
+        def log_modified(r):
+            if r != response:
+                logger.debug("Gateway modified response => %s", Loggable(r))
+            return r
+
+        d.addCallback(log_modified)
+        return d
+
+    @staticmethod
+    def observe_total(response, received_at):
+        metrics.STAGE_TOTAL.time(received_at)
+        return response
+
+    @staticmethod
+    def release_components(result, components: Components):
+        components.release()
+        return result
+
+    def bind_answered(self, response, dn: bytes):
+        """
+        Count the failed binds towards the lockout of their DN and address.
+        """
+        if self.rate_limiter is not None and isinstance(response, pureldap.LDAPBindResponse):
+            if response.resultCode == ldaperrors.LDAPInvalidCredentials.resultCode:
+                self.rate_limiter.failed(dn, self.peer_address)
+            elif response.resultCode == ldaperrors.Success.resultCode:
+                self.rate_limiter.succeeded(dn)
+        return response
+
+    def audit_record(self, request) -> dict:
+        return {'time': time.time(), 'dn': request.dn.decode(errors='replace'), 'peer': self.peer_address,
+                'mode': None, 'result_code': None, 'message': None, 'otp': None, 'timings': {}}
 
-                logging.info("Successful OTP verification but no backend response to forward. "
-                             "Generating an empty success response instead")
-                return pureldap.LDAPBindResponse(ldaperrors.Success.resultCode)
+    def audited(self, response, context: BindContext):
+        """
+        Queue the audit record of an answered bind, if any. The record of a bind answered while its OTP is still
+        being verified, e.g. rejected by the backend in the `parallel` order, is queued once the verification
+        completes it: the audit writer thread must not read a record still being modified.
+        """
+        record = context.audit
+        if record is not None and isinstance(response, pureldap.LDAPBindResponse):
+            record['result_code'] = response.resultCode
+            if response.errorMessage:
+                record['message'] = response.errorMessage.decode(errors='replace') \
+                    if isinstance(response.errorMessage, bytes) else response.errorMessage
+            record['timings']['total'] = time.perf_counter() - context.received_at
+            verification = context.otp_verification
+            if verification is None or verification.called:
+                self.audit_log.record(record)
             else:
-                logging.warning(f"Failed OTP verification: {error}")
-                return pureldap.LDAPBindResponse(ldaperrors.LDAPInvalidCredentials.resultCode, errorMessage=error)
-        except Exception as e:
-            logging.error("Error while performing OTP verification.")
-            logging.error(e)
-            return pureldap.LDAPBindResponse(ldaperrors.LDAPUnknownError.resultCode, errorMessage="")
+                verification.addBoth(self.audit_verified, record)
+        return response
+
+    def audit_verified(self, result, record: dict):
+        self.audit_log.record(record)
+        return result
+
+    def bind_identity(self, response, dn: bytes):
+        if isinstance(response, pureldap.LDAPBindResponse):
+            # a bind failed by the backend leaves its connection anonymous
+            self.bound_dn = dn if response.resultCode == ldaperrors.Success.resultCode else b''
+
+    def otp_bind(self, request: ldaptor.protocols.pureldap.LDAPBindRequest, response,
+                 context: BindContext) -> defer.Deferred:
+        """
+        Complete a bind request accepted by the backend with the verification of its OTP, the one started along
+        the backend bind if any, or a new one. Returns a Deferred firing the LDAP bind response to send back to
+        the client.
+        """
+        d = context.otp_verification
+        if d is None:
+            if context.otp is None:
+                error = ("Something really bad happened. OTP couldn't be loaded back by the gateway"
+                         "from request after forwarding it to the backend")
+                logger.error(error)
+                return defer.succeed(pureldap.LDAPBindResponse(ldaperrors.LDAPOther.resultCode,
+                                                               errorMessage=error))
+            components = context.components or self.components.current
+            d = self.verify_otp(components, request.dn.decode(), request.auth.decode(), context.otp.decode(),
+                                context.audit)
+
+        d.addCallback(self.otp_verified, response)
+        return d
+
+    @staticmethod
+    def otp_verified(rejection, response):
+        if rejection is not None:
+            return rejection
+        if response is not None:
+            logger.info("Successful OTP verification, forwarding backend response")
+            return response
+
+        logger.info("Successful OTP verification but no backend response to forward. "
+                    "Generating an empty success response instead")
+        return pureldap.LDAPBindResponse(ldaperrors.Success.resultCode)
+
+    def verify_otp(self, components: Components, user, password, otp, record=None) -> defer.Deferred:
+        """
+        Verify an OTP against the OTP backend of `components` without blocking the reactor, completing the audit
+        `record` of the bind if any.
+        Returns a Deferred firing None if the OTP is valid, or else the LDAP bind response rejecting the bind.
+        """
+        logger.debug("verify_otp user:%s", user)
+
+        verify_started_at = time.perf_counter()
+
+        def audit(result):
+            if record is not None:
+                record['otp'] = result
+                record['timings']['otp_verify'] = time.perf_counter() - verify_started_at
+
+        def verified(result):
+            metrics.STAGE_OTP_VERIFY.time(verify_started_at)
+            access, error = result
+            if access:
+                metrics.OTP_VERIFICATIONS_SUCCESS.inc()
+                audit('success')
+                return None
+            metrics.OTP_VERIFICATIONS_FAILURE.inc()
+            audit('failure')
+            logger.warning(f"Failed OTP verification: {error}")
+            return pureldap.LDAPBindResponse(ldaperrors.LDAPInvalidCredentials.resultCode, errorMessage=error)
+
+        def failed(failure):
+            metrics.STAGE_OTP_VERIFY.time(verify_started_at)
+            if failure.check(OtpBackendUnavailable):
+                metrics.OTP_VERIFICATIONS_UNAVAILABLE.inc()
+                audit('unavailable')
+                logger.warning(f"OTP verification not performed: {failure.value}")
+                return pureldap.LDAPBindResponse(ldaperrors.LDAPUnavailable.resultCode,
+                                                 errorMessage=str(failure.value))
+            metrics.OTP_VERIFICATIONS_ERROR.inc()
+            audit('error')
+            logger.error("Error while performing OTP verification.")
+            logger.error(failure.value)
+            return pureldap.LDAPBindResponse(ldaperrors.LDAPOther.resultCode, errorMessage="")
+
+        # held until verified, even if the bind is answered before, e.g. rejected by the backend meanwhile
+        components.acquire()
+        d = defer.maybeDeferred(components.otp_backend.verify_async, user, password, otp)
+        d.addCallback(verified)
+        d.addErrback(failed)
+        d.addBoth(self.release_components, components)
+        return d
 
     def handleBeforeForwardRequest(self, request, controls, reply):
         """
@@ -107,21 +404,173 @@ class OtpGateway(ProxyBase):
         client via `reply(response)`.
         """
         if isinstance(request, ldaptor.protocols.pureldap.LDAPBindRequest):
-            if self.gateway_filter is not None and self.gateway_filter.ignore(request):
-                setattr(request, GATEWAY_PASS_THROUGH_ATTR, GATEWAY_PASS_THROUGH_FORWARD_VALUE)
+            received_at = time.perf_counter()
+            context = BindContext(received_at)
+
+            record = None
+            if self.audit_log is not None:
+                if not self.audit_log.accepting:
+                    # failing closed, no bind is handled without being audited
+                    metrics.AUDIT_BINDS_REFUSED.inc()
+                    metrics.STAGE_BEFORE_FORWARD.time(received_at)
+                    metrics.STAGE_TOTAL.time(received_at)
+                    reply(pureldap.LDAPBindResponse(ldaperrors.LDAPUnavailable.resultCode,
+                                                    errorMessage="Audit log unavailable"))
+                    return None
+                record = context.audit = self.audit_record(request)
+
+            if self.rate_limiter is not None:
+                key, reason = self.rate_limiter.check(request.dn, self.peer_address)
+                if reason is not None:
+                    logger.debug("Bind of %r from %s rejected by the %s %s limit", request.dn, self.peer_address, key,
+                                 reason)
+                    metrics.STAGE_BEFORE_FORWARD.time(received_at)
+                    metrics.STAGE_TOTAL.time(received_at)
+                    if record is not None:
+                        record['mode'] = 'rate_limited'
+                    if reason == LOCKOUT:
+                        reply(self.audited(pureldap.LDAPBindResponse(
+                            ldaperrors.LDAPUnwillingToPerform.resultCode,
+                            errorMessage=f"Too many failed binds, {key} locked out"), context))
+                    else:
+                        reply(self.audited(pureldap.LDAPBindResponse(
+                            ldaperrors.LDAPBusy.resultCode, errorMessage=f"Too many binds per {key}"), context))
+                    return None
+
+            components = self.components.current
+            if components.gateway_filter is not None and components.gateway_filter.ignore(request):
+                metrics.BINDS_PASS_THROUGH.inc()
+                context.pass_through = GATEWAY_PASS_THROUGH_FORWARD_VALUE
+                if record is not None:
+                    record['mode'] = 'pass_through'
             else:
+                metrics.BINDS_FILTERED.inc()
+                if record is not None:
+                    record['mode'] = 'filtered'
 
                 try:
-                    [password, otp] = self.otp_extractor.extract(request)
+                    [password, otp] = components.otp_extractor.extract(request)
                 except Exception as e:
                     # Return an "Invalid credentials" response if the extraction failed
-                    logging.warning(e)
-                    reply(pureldap.LDAPBindResponse(ldaperrors.LDAPInvalidCredentials.resultCode,
-                                                    errorMessage=str(e)))
+                    logger.warning(e)
+                    metrics.OTP_EXTRACTION_FAILURES.inc()
+                    metrics.STAGE_BEFORE_FORWARD.time(received_at)
+                    metrics.STAGE_TOTAL.time(received_at)
+                    reply(self.audited(self.bind_answered(pureldap.LDAPBindResponse(
+                        ldaperrors.LDAPInvalidCredentials.resultCode, errorMessage=str(e)), request.dn), context))
                     return None
 
-                setattr(request, GATEWAY_PASS_THROUGH_ATTR, GATEWAY_PASS_THROUGH_FILTER_VALUE)
-                setattr(request, OTP_REQUEST_ATTR, otp)
+                context.pass_through = GATEWAY_PASS_THROUGH_FILTER_VALUE
+                context.otp = otp
+                context.components = components.acquire()
                 request.auth = password
 
+                if self.verify_order != SEQUENTIAL:
+                    verification = self.verify_otp(components, request.dn.decode(), password.decode(), otp.decode(),
+                                                   record)
+                    if self.verify_order == OTP_FIRST:
+                        verification.addCallback(self.forward_verified, request, controls, reply, context)
+                        return verification
+                    context.otp_verification = verification
+
+            self.forwarding(request, context)
+
+        elif self.search_cache is not None and isinstance(request, pureldap.LDAPSearchRequest) and not controls:
+            responses, pending = self.search_cache.start(self.bound_dn, request)
+            if responses is not None:
+                for response in responses:
+                    reply(response)
+                return None
+            if pending is not None:
+                self.track(request, pending)
+
         return defer.succeed((request, controls))
+
+    def track(self, request, state):
+        if self.in_flight is None:
+            self.in_flight = {}
+        # the request is held as well, its id not being reused while in flight
+        self.in_flight[id(request)] = (request, state)
+
+    def tracked(self, request, done=False):
+        """
+        State of a request being forwarded, forgotten once `done`. None if untracked.
+        """
+        if not self.in_flight:
+            return None
+        entry = self.in_flight.pop(id(request), None) if done else self.in_flight.get(id(request))
+        return None if entry is None else entry[1]
+
+    def forwarding(self, request, context: BindContext):
+        self.backend_bound = True
+        self.track(request, context)
+        context.forwarded_at = time.perf_counter()
+        before_forward = context.forwarded_at - context.received_at
+        metrics.STAGE_BEFORE_FORWARD.observe(before_forward)
+        if context.audit is not None:
+            context.audit['timings']['before_forward'] = before_forward
+
+    def forward_verified(self, rejection, request, controls, reply, context: BindContext):
+        """
+        Forward a bind request to the backend once its OTP is verified, or reject it right away.
+        """
+        if rejection is not None or not self.connected or self.client is None:
+            context.components.release()
+            if rejection is not None:
+                metrics.STAGE_TOTAL.time(context.received_at)
+                reply(self.audited(self.bind_answered(rejection, request.dn), context))
+            return None
+
+        context.otp_verification = defer.succeed(None)
+        self.forwarding(request, context)
+        return request, controls
+
+
+class OtpGatewayFactory(protocol.ServerFactory):
+    """
+    Server factory keeping track of its open gateway connections, so that they can be drained on shutdown.
+    """
+
+    def __init__(self, build_protocol, reactor=None, name='unsecure'):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.protocol = build_protocol
+        self.reactor = reactor
+        self.connections = set()
+        self.drain_waiters = []
+        self.connections_gauge = metrics.FRONTEND_CONNECTIONS.labels(name)
+
+    def connection_made(self, proto):
+        self.connections.add(proto)
+        self.connections_gauge.inc()
+
+    def connection_lost(self, proto):
+        if proto in self.connections:
+            self.connections.discard(proto)
+            self.connections_gauge.dec()
+        if not self.connections:
+            waiters, self.drain_waiters = self.drain_waiters, []
+            for waiter in waiters:
+                if not waiter.called:
+                    waiter.callback(None)
+
+    def drain(self, timeout) -> defer.Deferred:
+        """
+        Fires once all the open connections are closed by their clients, or closes the remaining
+        ones after `timeout` seconds. The listening ports are expected to be stopped already.
+        """
+        if not self.connections:
+            return defer.succeed(None)
+
+        logger.info(f"Draining {len(self.connections)} open connection(s)")
+        waiter = defer.Deferred()
+
+        def timed_out(result, timeout):
+            logger.warning(f"Closing {len(self.connections)} connection(s) still open after {timeout} seconds")
+            for proto in list(self.connections):
+                proto.transport.loseConnection()
+
+        waiter.addTimeout(timeout, self.reactor, onTimeoutCancel=timed_out)
+        self.drain_waiters.append(waiter)
+        return waiter
@@ -0,0 +1,175 @@
+"""
+Bind rate limiting and failed bind lockout, per bind DN and per client address.
+
+Each DN and each address has a token bucket, refilled at `rate` binds per second up to `burst` binds, and a sliding
+window of its failed binds: `failure_threshold` failures within `failure_window` seconds lock it out for
+`lockout_duration` seconds. The binds exceeding the rate are rejected with `busy`, the binds of a locked out DN or
+address with `unwillingToPerform`, before reaching the backend LDAP server or the OTP backend.
+
+The state is kept in memory by each gateway process, for at most `max_keys` DNs and as many addresses: the least
+recently seen ones are forgotten first.
+"""
+import logging
+from collections import OrderedDict, deque
+
+from . import metrics
+from .dn import normalize_dn
+
+logger = logging.getLogger(__name__)
+
+# why a bind is rejected
+RATE = 'rate'
+LOCKOUT = 'lockout'
+
+
+class LimiterEntry:
+    __slots__ = ('tokens', 'updated_at', 'failures', 'locked_until')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        # times of the last failed binds, up to the failure threshold
+        self.failures = None
+        self.locked_until = 0.0
+
+
+class KeyLimiter:
+    """
+    Token buckets and failure windows of one kind of key, DNs or addresses. A `rate` of 0 disables the token
+    buckets, and a `failure_threshold` of 0 the lockouts.
+    """
+
+    def __init__(self, name, rate=0.0, burst=1, failure_threshold=0, failure_window=300.0, lockout_duration=900.0,
+                 max_keys=100000):
+        if rate > 0 and burst < 1:
+            raise ValueError(f'{name} rate limit burst must be at least 1. found {burst} instead')
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.lockout_duration = lockout_duration
+        self.max_keys = max_keys
+        # key => LimiterEntry, least recently seen first
+        self.entries = OrderedDict()
+        metrics.RATE_LIMIT_KEYS.labels(name).set_function(lambda: len(self.entries))
+        self.rate_limited = metrics.RATE_LIMITED_BINDS.labels(name, RATE)
+        self.locked_out = metrics.RATE_LIMITED_BINDS.labels(name, LOCKOUT)
+        self.lockouts = metrics.LOCKOUTS.labels(name)
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 or self.failure_threshold > 0
+
+    def entry(self, key, now) -> LimiterEntry:
+        """
+        Entry of `key` with its tokens refilled up to `now`, created when unknown.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = LimiterEntry(self.burst, now)
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+            if self.rate > 0:
+                entry.tokens = min(self.burst, entry.tokens + (now - entry.updated_at) * self.rate)
+            entry.updated_at = now
+        return entry
+
+    def failed(self, key, now):
+        if self.failure_threshold <= 0:
+            return
+        entry = self.entry(key, now)
+        if entry.failures is None:
+            entry.failures = deque(maxlen=self.failure_threshold)
+        entry.failures.append(now)
+        if len(entry.failures) == self.failure_threshold and now - entry.failures[0] <= self.failure_window:
+            entry.failures.clear()
+            entry.locked_until = now + self.lockout_duration
+            self.lockouts.inc()
+            logger.warning(f"Locking out {self.name} {key} for {self.lockout_duration} seconds after "
+                           f"{self.failure_threshold} failed binds")
+
+    def succeeded(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry.failures = None
+
+
+class BindLimiter:
+    """
+    Rate limits and lockouts of the bind requests, by bind DN and by client address, shared by all the
+    connections of a gateway process.
+    """
+
+    def __init__(self, dn_limiter: KeyLimiter, address_limiter: KeyLimiter, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.dn_limiter = dn_limiter
+        self.address_limiter = address_limiter
+        self.reactor = reactor
+
+    def keys(self, dn: bytes, address) -> list:
+        # anonymous binds are only limited by address
+        dn = normalize_dn(dn.decode(errors='replace'))
+        return [(self.dn_limiter, dn or None), (self.address_limiter, address)]
+
+    def check(self, dn: bytes, address) -> (str or None, str or None):
+        """
+        Take a token for the bind of `dn` from `address`. Returns (None, None) when the bind may proceed, or else
+        the kind of key limiting it, `dn` or `address`, and the reason, RATE or LOCKOUT.
+        """
+        now = self.reactor.seconds()
+        entries = [(limiter, limiter.entry(key, now)) for limiter, key in self.keys(dn, address)
+                   if key is not None and limiter.enabled]
+        for limiter, entry in entries:
+            if entry.locked_until > now:
+                limiter.locked_out.inc()
+                return limiter.name, LOCKOUT
+        for limiter, entry in entries:
+            if limiter.rate > 0 and entry.tokens < 1:
+                limiter.rate_limited.inc()
+                return limiter.name, RATE
+        for limiter, entry in entries:
+            if limiter.rate > 0:
+                entry.tokens -= 1
+        return None, None
+
+    def failed(self, dn: bytes, address):
+        now = self.reactor.seconds()
+        for limiter, key in self.keys(dn, address):
+            if key is not None:
+                limiter.failed(key, now)
+
+    def succeeded(self, dn: bytes):
+        # failures from the same address may still be credential stuffing, only the DN ones are forgotten
+        [(limiter, key), _] = self.keys(dn, None)
+        if key is not None:
+            limiter.succeeded(key)
+
+
+def build_limiter(settings) -> BindLimiter or None:
+    """
+    Bind limiter from the LDAP_GATEWAY_RATE_LIMIT_* and LDAP_GATEWAY_LOCKOUT_* settings, None when all of them are
+    disabled.
+    """
+    common = dict(failure_window=settings.LDAP_GATEWAY_LOCKOUT_WINDOW,
+                  lockout_duration=settings.LDAP_GATEWAY_LOCKOUT_DURATION,
+                  max_keys=settings.LDAP_GATEWAY_RATE_LIMIT_MAX_KEYS)
+    dn_limiter = KeyLimiter('dn', rate=settings.LDAP_GATEWAY_RATE_LIMIT_DN_RATE,
+                            burst=settings.LDAP_GATEWAY_RATE_LIMIT_DN_BURST,
+                            failure_threshold=settings.LDAP_GATEWAY_LOCKOUT_DN_FAILURES, **common)
+    address_limiter = KeyLimiter('address', rate=settings.LDAP_GATEWAY_RATE_LIMIT_ADDRESS_RATE,
+                                 burst=settings.LDAP_GATEWAY_RATE_LIMIT_ADDRESS_BURST,
+                                 failure_threshold=settings.LDAP_GATEWAY_LOCKOUT_ADDRESS_FAILURES, **common)
+    if not dn_limiter.enabled and not address_limiter.enabled:
+        return None
+    for limiter in (dn_limiter, address_limiter):
+        if limiter.rate > 0:
+            logger.info(f"- limiting the binds per {limiter.name} to {limiter.rate}/s, bursts of {limiter.burst}")
+        if limiter.failure_threshold > 0:
+            logger.info(f"- locking out a {limiter.name} for {limiter.lockout_duration} seconds after "
+                        f"{limiter.failure_threshold} failed binds within {limiter.failure_window} seconds")
+    return BindLimiter(dn_limiter, address_limiter)
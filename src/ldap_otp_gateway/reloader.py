@@ -0,0 +1,90 @@
+"""
+Configuration reload without restart, on SIGHUP or when a watched file is modified.
+
+The settings are read again from the environment, and handed to the process: gateway processes build new OTP
+backend, OTP extractor and gateway filter instances and swap them in, the binds in flight completing with the
+previous ones, while supervisors forward the reload to their workers. Open connections, backend connection
+pools and listening sockets are kept: the other settings require a restart.
+"""
+import logging
+import os
+import signal
+
+from twisted.internet import task
+
+from . import logs, metrics
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class Reloader:
+    """
+    Calls `apply(settings)` with new settings on every reload, after `load_environment()` refreshed the
+    process environment if given. A failing reload is logged, and the current configuration kept.
+    """
+
+    def __init__(self, settings, apply, load_environment=None, watch_path='', watch_interval=5.0, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.settings = settings
+        self.apply = apply
+        self.load_environment = load_environment
+        self.watch_path = watch_path
+        self.watch_interval = watch_interval
+        self.reactor = reactor
+        self.watcher = None
+        self.modified_at = None
+
+    def start(self):
+        signal.signal(signal.SIGHUP, self.signaled)
+        if self.watch_path and self.watch_interval > 0:
+            logger.info(f"- reloading configuration when {self.watch_path} is modified")
+            self.modified_at = self.modification_time()
+            self.watcher = task.LoopingCall(self.check)
+            self.watcher.clock = self.reactor
+            self.watcher.start(self.watch_interval, now=False)
+
+    def stop(self):
+        if self.watcher is not None and self.watcher.running:
+            self.watcher.stop()
+
+    def signaled(self, signum, frame):
+        # signal handlers may run at any point of the reactor loop
+        self.reactor.callFromThread(self.reload)
+
+    def modification_time(self) -> (float or None):
+        try:
+            return os.stat(self.watch_path).st_mtime
+        except OSError:
+            return None
+
+    def check(self):
+        modified_at = self.modification_time()
+        if modified_at != self.modified_at:
+            self.modified_at = modified_at
+            logger.info(f"{self.watch_path} modified")
+            self.reload()
+
+    def reload(self) -> bool:
+        logger.info("Reloading configuration ...")
+        try:
+            if self.load_environment is not None:
+                self.load_environment()
+            logs.configure()
+            settings = Settings(reload_plugins=True)
+            self.apply(settings)
+        except Exception as e:
+            metrics.CONFIG_RELOADS_FAILURE.inc()
+            logger.error(f"Configuration reload failed, keeping the current one: {e}")
+            return False
+
+        restart = [name for name in self.settings.changes(settings)
+                   if not name.startswith(Settings.RELOADABLE_PREFIXES) or name in Settings.RESTART_ONLY]
+        if restart:
+            logger.warning(f"Changed settings only applied on restart: {', '.join(restart)}")
+        self.settings = settings
+        metrics.CONFIG_RELOADS_SUCCESS.inc()
+        logger.info("Configuration reloaded")
+        return True
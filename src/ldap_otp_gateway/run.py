@@ -1,99 +1,298 @@
 import argparse
 import logging
 import os
+import signal
+import socket
+import sys
 from functools import partial
 
-from ldaptor.protocols import pureldap
-from ldaptor.protocols.ldap.ldapclient import LDAPClient
-from ldaptor.protocols.ldap.ldapconnector import connectToLDAPEndpoint
-from twisted.internet import protocol, reactor, ssl
+from ldap_otp_gateway import logs
 
-from ldap_otp_gateway import OtpGateway
+logger = logging.getLogger(__name__)
 
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logging.basicConfig()
 
+def load_dotenv(override=False):
+    try:
+        # noinspection PyUnresolvedReferences
+        import dotenv
+    except ModuleNotFoundError:
+        raise Exception("python-dotenv package not found. It's not part of the package dependency and you need "
+                        "to install it manually before using --load-dotenv argument.")
 
-def ldapBindRequestRepr(self):
-    l = []
-    l.append('version={0}'.format(self.version))
-    l.append('dn={0}'.format(repr(self.dn)))
-    l.append('auth=****')
-    if self.tag != self.__class__.tag:
-        l.append('tag={0}'.format(self.tag))
-    l.append('sasl={0}'.format(repr(self.sasl)))
-    return self.__class__.__name__ + '(' + ', '.join(l) + ')'
+    dotenv_path = os.path.join(os.getcwd(), '.env')
+    logger.info(f"Loading environment from {dotenv_path} ...")
+    dotenv.load_dotenv(dotenv_path, override=override)
 
 
-pureldap.LDAPBindRequest.__repr__ = ldapBindRequestRepr
+def build_reloader(args, settings, apply):
+    """
+    Reload the configuration on SIGHUP, and when RELOAD_WATCH_PATH is modified. The workers leave the watch to
+    their supervisor, which forwards them the reloads.
+    """
+    from twisted.internet import reactor
+
+    from ldap_otp_gateway.reloader import Reloader
+
+    reloader = Reloader(
+        settings, apply,
+        load_environment=partial(load_dotenv, override=True) if args.load_dotenv else None,
+        watch_path='' if args.worker_fds else settings.RELOAD_WATCH_PATH,
+        watch_interval=settings.RELOAD_WATCH_INTERVAL)
+
+    def start():
+        reloader.start()
+        if args.worker_ready_fd is not None:
+            # the supervisor holds the reloads back until the SIGHUP handler is installed
+            try:
+                os.write(args.worker_ready_fd, b'ready')
+                os.close(args.worker_ready_fd)
+            except OSError as e:
+                logger.warning(f"Couldn't tell the supervisor the worker is ready: {e}")
+
+    reactor.callWhenRunning(start)
+    reactor.addSystemEventTrigger('before', 'shutdown', reloader.stop)
+    return reloader
+
+
+def supervise(args, settings):
+    """
+    Listen on the frontend ports, and leave the connections to `args.workers` gateway processes
+    inheriting the listening sockets.
+    """
+    from twisted.internet import reactor
+
+    from ldap_otp_gateway.workers import WorkerSupervisor, listen_socket
+
+    workers = args.workers
+
+    logger.info(f"- sharing unsecure frontend port :{settings.LDAP_GATEWAY_PORT} with {workers} workers")
+    sock = listen_socket(settings.LDAP_GATEWAY_PORT)
+    logger.info(f"- sharing SSL frontend port :{settings.LDAP_GATEWAY_SSL_PORT} with {workers} workers")
+    sock_ssl = listen_socket(settings.LDAP_GATEWAY_SSL_PORT)
+
+    # leave the workers the time to drain their connections before killing them
+    supervisor = WorkerSupervisor(workers, [sock.fileno(), sock_ssl.fileno()],
+                                  shutdown_timeout=settings.LDAP_GATEWAY_SHUTDOWN_TIMEOUT + 5,
+                                  extra_args=['--load-dotenv'] if args.load_dotenv else [])
+    reactor.callWhenRunning(supervisor.start)
+    build_reloader(args, settings, lambda _: supervisor.reload())
+    logger.info(f"RUN !")
+    reactor.run()
+    if supervisor.failed:
+        # the workers keep dying, let the service manager know
+        sys.exit(1)
+
+
+def gen_certs(parser, args, settings):
+    """
+    Generate the self signed certificate of the SSL frontend, out of the gateway startup.
+    """
+    from ldap_otp_gateway import certs
+
+    key_path = os.path.abspath(args.key) if args.key else settings.LDAP_GATEWAY_SSL_KEY_PATH
+    cert_path = os.path.abspath(args.cert) if args.cert else settings.LDAP_GATEWAY_SSL_CERT_PATH
+    if not args.force and (os.path.exists(key_path) or os.path.exists(cert_path)):
+        parser.error(f"{key_path} or {cert_path} already exists, use --force to replace them")
+    certs.generate(key_path, cert_path, common_name=args.common_name, days=args.days)
+    print(f"Generated {key_path} and {cert_path}")
 
 
 def run():
     parser = argparse.ArgumentParser(description='Run the LDAP OTP gateway.')
     parser.add_argument('--load-dotenv', action='store_true',
                         help='use python-dotenv to load environment variables. ')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of gateway processes sharing the frontend ports. Defaults to 1, '
+                             'a single process without supervisor.')
+    # listening socket file descriptors inherited from the supervisor, for internal use only
+    parser.add_argument('--worker-fds', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-index', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-ready-fd', type=int, help=argparse.SUPPRESS)
+
+    commands = parser.add_subparsers(dest='command', title='commands', help='runs the gateway when omitted')
+    gen_certs_parser = commands.add_parser(
+        'gen-certs', help='generate the self signed certificate of the SSL frontend',
+        description='Generate an ECDSA P-256 key and its self signed certificate, to the paths given by '
+                    'LDAP_GATEWAY_SSL_KEY_PATH and LDAP_GATEWAY_SSL_CERT_PATH by default.')
+    gen_certs_parser.add_argument('--key', help='private key path')
+    gen_certs_parser.add_argument('--cert', help='certificate path')
+    gen_certs_parser.add_argument('--common-name', default='localhost', help='certificate subject common name')
+    gen_certs_parser.add_argument('--days', type=int, default=10 * 365, help='certificate validity, in days')
+    gen_certs_parser.add_argument('--force', action='store_true', help='replace the existing files')
 
     args = parser.parse_args()
+    # a SIGHUP would terminate the process until the reloader handles it
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logs.configure()
     if args.load_dotenv:
-        try:
-            # noinspection PyUnresolvedReferences
-            import dotenv
-        except ModuleNotFoundError:
-            raise Exception("python-dotenv package not found. It's not part of the package dependency and you need "
-                            "to install it manually before using --load-dotenv argument.")
+        load_dotenv()
+        logs.configure()
 
-        dotenv_path = os.path.join(os.getcwd(), '.env')
-        logger.info(f"Loading environment from {dotenv_path} ...")
-        dotenv.load_dotenv(dotenv_path)
+    from ldap_otp_gateway.config import Settings
+
+    settings = Settings()
+    if args.command == 'gen-certs':
+        gen_certs(gen_certs_parser, args, settings)
+        return
 
     logger.info("Start run configuration")
 
-    from ldap_otp_gateway import config
-
-    logger.info("Now starting LDAP OTP gateway ...")
-
-    backend_connection_string = f'tcp:{config.LDAP_HOST}:{config.LDAP_PORT}'
-    logging.info(f"- using unsecure backend: {backend_connection_string}")
-    backend_connector = partial(
-        connectToLDAPEndpoint,
-        reactor,
-        backend_connection_string,
-        LDAPClient)
-
-    backend_connection_string_ssl = f'ssl:{config.LDAP_HOST}:{config.LDAP_SSL_PORT}'
-    logging.info(f"- using SSL backend: {backend_connection_string_ssl}")
-    backend_connector_ssl = partial(
-        connectToLDAPEndpoint,
-        reactor,
-        backend_connection_string_ssl,
-        LDAPClient)
-
-    def build_protocol():
-        proto = OtpGateway(config.OTP_BACKEND, otp_extractor=config.OTP_EXTRACTOR, gateway_filter=config.GATEWAY_FILTER)
-        proto.clientConnector = backend_connector
-        proto.use_tls = False
-        return proto
+    if not args.worker_fds:
+        from ldap_otp_gateway import certs
+
+        # once, before the workers start
+        certs.ensure(settings.LDAP_GATEWAY_SSL_KEY_PATH, settings.LDAP_GATEWAY_SSL_CERT_PATH)
 
-    def build_protocol_ssl():
-        proto = OtpGateway(config.OTP_BACKEND, otp_extractor=config.OTP_EXTRACTOR, gateway_filter=config.GATEWAY_FILTER)
-        proto.clientConnector = backend_connector_ssl
+    if args.workers > 1 and not args.worker_fds:
+        logger.info(f"Now starting LDAP OTP gateway supervisor of {args.workers} workers ...")
+        supervise(args, settings)
+        return
+
+    serve(args, settings)
+
+
+def serve(args, settings):
+    """
+    Run a gateway process, listening on the frontend ports or on the ones inherited from the supervisor.
+    """
+    from twisted.internet import defer, reactor
+    from twisted.protocols.tls import TLSMemoryBIOFactory
+
+    from ldap_otp_gateway import OtpGateway, OtpGatewayFactory, tls
+    from ldap_otp_gateway.audit import build_audit_log
+    from ldap_otp_gateway.backend_pool import LDAPClientPool
+    from ldap_otp_gateway.components import Components, ComponentsHolder
+    from ldap_otp_gateway.ldap_client import build_connector
+    from ldap_otp_gateway.otp_gateway import VERIFY_ORDERS
+    from ldap_otp_gateway.rate_limit import build_limiter
+    from ldap_otp_gateway.search_cache import build_cache
+    from ldap_otp_gateway.upstreams import Upstream, UpstreamSet
+
+    logger.info(f"Now starting LDAP OTP gateway (pid {os.getpid()}) ...")
+
+    def build_pool(connector, name):
+        pool = LDAPClientPool(
+            connector,
+            max_size=settings.LDAP_BACKEND_POOL_SIZE,
+            idle_timeout=settings.LDAP_BACKEND_POOL_IDLE_TIMEOUT,
+            max_lifetime=settings.LDAP_BACKEND_POOL_MAX_LIFETIME,
+            health_check_interval=settings.LDAP_BACKEND_POOL_HEALTH_CHECK_INTERVAL,
+            acquire_timeout=settings.LDAP_BACKEND_POOL_ACQUIRE_TIMEOUT,
+            bind_policy=settings.LDAP_BACKEND_POOL_BIND_POLICY,
+            bind_dn=settings.LDAP_BACKEND_POOL_BIND_DN,
+            bind_password=settings.LDAP_BACKEND_POOL_BIND_PASSWORD,
+            name=name)
+        reactor.callWhenRunning(pool.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', pool.stop)
+        logger.info(f"  with a pool of up to {settings.LDAP_BACKEND_POOL_SIZE} connections")
+        return pool
+
+    def build_upstreams(scheme, port_index, name):
+        upstreams = []
+        for upstream in settings.LDAP_UPSTREAMS:
+            host, port, weight = upstream[0], upstream[port_index], upstream[3]
+            connection_string = f'{scheme}:{host}:{port}'
+            logger.info(f"- using {name} backend: {connection_string}")
+            upstreams.append(Upstream(
+                f'{host}:{port}',
+                build_connector(reactor, connection_string),
+                weight=weight))
+        upstream_set = UpstreamSet(
+            upstreams,
+            policy=settings.LDAP_BALANCER,
+            health_check_interval=settings.LDAP_HEALTH_CHECK_INTERVAL,
+            health_check_timeout=settings.LDAP_HEALTH_CHECK_TIMEOUT,
+            ejection_time=settings.LDAP_EJECTION_TIME,
+            name=name)
+        if len(upstreams) > 1:
+            logger.info(f"  balanced by {settings.LDAP_BALANCER}")
+        reactor.callWhenRunning(upstream_set.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', upstream_set.stop)
+        return upstream_set
+
+    backend_connector = build_upstreams('tcp', 1, 'unsecure').connect
+    backend_pool = build_pool(backend_connector, 'unsecure') if settings.LDAP_BACKEND_POOL_SIZE > 0 else None
+
+    backend_connector_ssl = build_upstreams('ssl', 2, 'SSL').connect
+    backend_pool_ssl = build_pool(backend_connector_ssl, 'SSL') if settings.LDAP_BACKEND_POOL_SIZE > 0 else None
+
+    if settings.LDAP_GATEWAY_VERIFY_ORDER not in VERIFY_ORDERS:
+        raise ValueError(f'LDAP_GATEWAY_VERIFY_ORDER must be one of {VERIFY_ORDERS}. '
+                         f'found {settings.LDAP_GATEWAY_VERIFY_ORDER} instead')
+    logger.info(f"- verifying the OTP of the filtered binds: {settings.LDAP_GATEWAY_VERIFY_ORDER}")
+    # shared by both frontends, a client being limited whatever the endpoint it binds on
+    rate_limiter = build_limiter(settings)
+    search_cache = build_cache(settings)
+    audit_log = build_audit_log(settings, args.worker_index if args.worker_fds else None)
+    if audit_log is not None:
+        reactor.callWhenRunning(audit_log.start)
+
+    # the plugins are loaded before accepting connections, failing early if misconfigured
+    components = ComponentsHolder(Components(settings.OTP_BACKEND, settings.OTP_EXTRACTOR, settings.GATEWAY_FILTER))
+    reactor.callWhenRunning(components.current.start)
+
+    def reload_components(new_settings):
+        # the binds in flight complete with the previous components, closed once they are done
+        new_components = Components(new_settings.OTP_BACKEND, new_settings.OTP_EXTRACTOR, new_settings.GATEWAY_FILTER)
+        components.swap(new_components, timeout=settings.LDAP_GATEWAY_SHUTDOWN_TIMEOUT)
+
+    build_reloader(args, settings, reload_components)
+
+    def build_protocol(connector, pool):
+        current = components.current
+        proto = OtpGateway(current.otp_backend, current.otp_extractor, current.gateway_filter, components=components)
+        proto.clientConnector = connector if pool is None else pool.acquire
+        proto.backend_pool = pool
         proto.use_tls = False
+        proto.lazy_backend = settings.LDAP_GATEWAY_LAZY_BACKEND_CONNECTION
+        proto.relay = settings.LDAP_GATEWAY_RELAY_OPERATIONS
+        proto.verify_order = settings.LDAP_GATEWAY_VERIFY_ORDER
+        proto.rate_limiter = rate_limiter
+        proto.search_cache = search_cache
+        proto.audit_log = audit_log
         return proto
 
-    factory = protocol.ServerFactory()
-    factory_ssl = protocol.ServerFactory()
-
-    factory.protocol = build_protocol
-    factory_ssl.protocol = build_protocol_ssl
-    logging.info(f"- prepare unsecure frontend listening on port :{config.LDAP_GATEWAY_PORT}")
-    reactor.listenTCP(config.LDAP_GATEWAY_PORT, factory)
-    logging.info(f"- prepare SSL frontend listening on port :{config.LDAP_GATEWAY_SSL_PORT}")
-    reactor.listenSSL(config.LDAP_GATEWAY_SSL_PORT, factory_ssl,
-                      ssl.DefaultOpenSSLContextFactory(
-                          config.LDAP_GATEWAY_SSL_KEY_PATH, config.LDAP_GATEWAY_SSL_CERT_PATH)
-                      )
-    logging.info(f"RUN !")
+    factory = OtpGatewayFactory(partial(build_protocol, backend_connector, backend_pool), name='unsecure')
+    factory_ssl = OtpGatewayFactory(partial(build_protocol, backend_connector_ssl, backend_pool_ssl), name='SSL')
+    context_factory = tls.build_options(settings)
+
+    if args.worker_fds:
+        fd, fd_ssl = (int(fd) for fd in args.worker_fds.split(','))
+        logger.info(f"- adopt unsecure frontend listening on port :{settings.LDAP_GATEWAY_PORT}")
+        port = reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+        logger.info(f"- adopt SSL frontend listening on port :{settings.LDAP_GATEWAY_SSL_PORT}")
+        port_ssl = reactor.adoptStreamPort(fd_ssl, socket.AF_INET,
+                                           TLSMemoryBIOFactory(context_factory, False, factory_ssl))
+        # the adopted ports hold their own copies of the sockets
+        os.close(fd)
+        os.close(fd_ssl)
+    else:
+        logger.info(f"- prepare unsecure frontend listening on port :{settings.LDAP_GATEWAY_PORT}")
+        port = reactor.listenTCP(settings.LDAP_GATEWAY_PORT, factory)
+        logger.info(f"- prepare SSL frontend listening on port :{settings.LDAP_GATEWAY_SSL_PORT}")
+        port_ssl = reactor.listenSSL(settings.LDAP_GATEWAY_SSL_PORT, factory_ssl, context_factory)
+
+    if settings.METRICS_PORT > 0:
+        from ldap_otp_gateway import metrics
+
+        # one endpoint per worker, each process having its own metrics
+        metrics.listen(settings.METRICS_PORT + args.worker_index, settings.METRICS_INTERFACE)
+
+    def shutdown():
+        # stop accepting connections, then let the open ones finish
+        d = defer.gatherResults([defer.maybeDeferred(port.stopListening),
+                                 defer.maybeDeferred(port_ssl.stopListening)])
+        d.addCallback(lambda _: defer.gatherResults([
+            factory.drain(settings.LDAP_GATEWAY_SHUTDOWN_TIMEOUT),
+            factory_ssl.drain(settings.LDAP_GATEWAY_SHUTDOWN_TIMEOUT)]))
+        # once the last binds are answered
+        d.addBoth(lambda _: components.current.close())
+        if audit_log is not None:
+            d.addBoth(lambda _: audit_log.stop())
+        return d
+
+    reactor.addSystemEventTrigger('before', 'shutdown', shutdown)
+    logger.info(f"RUN !")
     reactor.run()
 
 
@@ -0,0 +1,212 @@
+"""
+Cache of the results of the searches repeated by the clients once bound, such as the root DSE, schema or group
+membership lookups.
+
+Only the searches matching one of the allowed shapes are cached, for `ttl` seconds, by bound identity and search
+request (base DN, scope, filter, requested attributes, limits). The least recently used results are evicted beyond
+`max_size` searches, and the searches returning more than `max_results` entries are never cached.
+
+A write operation (add, delete, modify, modify DN) going through the gateway invalidates the cached searches whose
+base DN is, contains or is contained by the written DN. The writes made by other gateway processes or directly to
+the directory are only seen once the cached results expire.
+"""
+import logging
+from collections import OrderedDict
+
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+
+from . import metrics
+from .dn import normalize_dn, split_dn
+
+logger = logging.getLogger(__name__)
+
+SCOPES = {
+    'base': pureldap.LDAP_SCOPE_baseObject,
+    'one': pureldap.LDAP_SCOPE_singleLevel,
+    'sub': pureldap.LDAP_SCOPE_wholeSubtree,
+}
+
+
+def as_text(value) -> str:
+    return value.decode(errors='replace') if isinstance(value, bytes) else value
+
+
+def is_suffix(rdns: tuple, suffix: tuple) -> bool:
+    return len(rdns) >= len(suffix) and rdns[len(rdns) - len(suffix):] == suffix
+
+
+class SearchShape:
+    """
+    Searches of a given scope whose base DN is `base`, or any DN below it with `below`.
+    """
+
+    def __init__(self, scope, base: tuple, below=False):
+        self.scope = scope
+        self.base = base
+        self.below = below
+
+    def matches(self, scope, base: tuple) -> bool:
+        if scope != self.scope:
+            return False
+        if self.below:
+            return len(base) > len(self.base) and is_suffix(base, self.base)
+        return base == self.base
+
+    @classmethod
+    def parse(cls, value: str) -> 'SearchShape':
+        """
+        `<scope>:<base DN>`, scope being `base`, `one` or `sub`, and the base DN starting with `*,` to match the
+        DNs below it, or being `*` alone to match any DN but the root DSE. E.g. `base:` for the root DSE,
+        `base:*,ou=people,dc=example,dc=org` for the people entries.
+        """
+        scope, separator, base = value.strip().partition(':')
+        if not separator or scope not in SCOPES:
+            raise ValueError(f'LDAP_GATEWAY_SEARCH_CACHE_SHAPES entries must be <scope>:<base DN>, scope being one '
+                             f'of {list(SCOPES)}. found {value} instead')
+        base = base.strip()
+        if base == '*':
+            return cls(SCOPES[scope], (), below=True)
+        if base.startswith('*,'):
+            return cls(SCOPES[scope], split_dn(base[2:]), below=True)
+        return cls(SCOPES[scope], split_dn(base))
+
+
+def parse_shapes(value: str) -> list:
+    """
+    Search shapes separated by semicolons, DNs holding commas.
+    """
+    return [SearchShape.parse(shape) for shape in value.split(';') if shape.strip()]
+
+
+class PendingSearch:
+    """
+    Responses of a cacheable search being forwarded to the backend, stored once done unless the cache was
+    invalidated meanwhile.
+    """
+    __slots__ = ('key', 'base', 'scope', 'generation', 'responses')
+
+    def __init__(self, key, base, scope, generation):
+        self.key = key
+        self.base = base
+        self.scope = scope
+        self.generation = generation
+        # None once too many to be cached
+        self.responses = []
+
+
+class SearchCache:
+    """
+    Search results by bound identity and search request, shared by all the connections of a gateway process.
+    """
+
+    def __init__(self, shapes, ttl=60.0, max_size=10000, max_results=100, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.shapes = shapes
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_results = max_results
+        self.reactor = reactor
+        # (identity, encoded search request) => (expiration time, base RDNs, scope, responses), least recently
+        # used first
+        self.entries = OrderedDict()
+        # incremented by every invalidation, so that the searches started before aren't stored
+        self.generation = 0
+        metrics.SEARCH_CACHE_ENTRIES.set_function(lambda: len(self.entries))
+
+    def start(self, identity: bytes, request: pureldap.LDAPSearchRequest) -> (list or None, PendingSearch or None):
+        """
+        Cached responses of a search, the final LDAPSearchResultDone included. Otherwise, the pending search
+        collecting its responses if it is cacheable, or None.
+        """
+        base = split_dn(as_text(request.baseObject))
+        if not any(shape.matches(request.scope, base) for shape in self.shapes):
+            return None, None
+
+        key = (normalize_dn(as_text(identity)), request.toWire())
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > self.reactor.seconds():
+                self.entries.move_to_end(key)
+                metrics.SEARCH_CACHE_HITS.inc()
+                return entry[3], None
+            del self.entries[key]
+        metrics.SEARCH_CACHE_MISSES.inc()
+        return None, PendingSearch(key, base, request.scope, self.generation)
+
+    def collect(self, pending: PendingSearch, response):
+        """
+        Add a backend response to a pending search, storing it once done.
+        """
+        if pending.responses is None:
+            return
+        if isinstance(response, pureldap.LDAPSearchResultEntry):
+            if len(pending.responses) < self.max_results:
+                pending.responses.append(response)
+                return
+        elif (isinstance(response, pureldap.LDAPSearchResultDone)
+              and response.resultCode == ldaperrors.Success.resultCode and pending.generation == self.generation):
+            pending.responses.append(response)
+            self.entries[pending.key] = (self.reactor.seconds() + self.ttl, pending.base, pending.scope,
+                                         pending.responses)
+            self.entries.move_to_end(pending.key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        # stored, or not cacheable: too many entries, references, failed or invalidated meanwhile
+        pending.responses = None
+
+    def invalidate(self, rdns: tuple):
+        """
+        Forget the cached searches whose results may include the entry of the given RDNs or its former
+        subordinates.
+        """
+        self.generation += 1
+        stale = [key for key, (_, base, scope, _) in self.entries.items() if self.overlaps(base, scope, rdns)]
+        for key in stale:
+            del self.entries[key]
+        if stale:
+            metrics.SEARCH_CACHE_INVALIDATIONS.inc(len(stale))
+            logger.debug("Write to %s invalidated %d cached search(es)", ','.join(rdns), len(stale))
+
+    @staticmethod
+    def overlaps(base: tuple, scope, rdns: tuple) -> bool:
+        if is_suffix(rdns, base):
+            depth = len(rdns) - len(base)
+            return (scope == pureldap.LDAP_SCOPE_wholeSubtree or depth == 0
+                    or (depth == 1 and scope == pureldap.LDAP_SCOPE_singleLevel))
+        # renaming or deleting an entry moves or removes its subordinates
+        return is_suffix(base, rdns)
+
+
+def written_dns(request) -> list:
+    """
+    RDNs of the entries a write request changes, both the former and the new ones of a renamed entry. Empty for
+    the other requests.
+    """
+    if isinstance(request, pureldap.LDAPModifyRequest):
+        return [split_dn(as_text(request.object))]
+    if isinstance(request, pureldap.LDAPAddRequest):
+        return [split_dn(as_text(request.entry))]
+    if isinstance(request, pureldap.LDAPDelRequest):
+        return [split_dn(as_text(request.value))]
+    if isinstance(request, pureldap.LDAPModifyDNRequest):
+        entry = split_dn(as_text(request.entry))
+        superior = split_dn(as_text(request.newSuperior)) if request.newSuperior else entry[1:]
+        return [entry, split_dn(as_text(request.newrdn)) + superior]
+    return []
+
+
+def build_cache(settings) -> SearchCache or None:
+    """
+    Search cache from the LDAP_GATEWAY_SEARCH_CACHE_* settings, None when no search shape is allowed.
+    """
+    shapes = parse_shapes(settings.LDAP_GATEWAY_SEARCH_CACHE_SHAPES)
+    if not shapes or settings.LDAP_GATEWAY_SEARCH_CACHE_TTL <= 0:
+        return None
+    logger.info(f"- caching the results of {len(shapes)} search shape(s) for "
+                f"{settings.LDAP_GATEWAY_SEARCH_CACHE_TTL} seconds")
+    return SearchCache(shapes, ttl=settings.LDAP_GATEWAY_SEARCH_CACHE_TTL,
+                       max_size=settings.LDAP_GATEWAY_SEARCH_CACHE_MAX_SIZE,
+                       max_results=settings.LDAP_GATEWAY_SEARCH_CACHE_MAX_RESULTS)
@@ -0,0 +1,104 @@
+"""
+TLS context of the SSL frontend: protocol versions, ciphers and key exchange groups, and session resumption.
+
+LDAPS clients tend to open a new connection for every bind. A resumed handshake (session ID or session ticket)
+skips the certificate signature and verification of a full handshake, which dominates the CPU cost of a new
+connection. The handshakes are counted in the metrics, split into full and resumed ones.
+"""
+import logging
+import weakref
+
+from OpenSSL import SSL, crypto
+from OpenSSL._util import lib
+from twisted.internet import ssl
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+TLS_VERSIONS = {
+    '1.2': ssl.TLSVersion.TLSv1_2,
+    '1.3': ssl.TLSVersion.TLSv1_3,
+}
+
+
+def load_certificate(key_path, cert_path) -> (crypto.PKey, crypto.X509, list):
+    """
+    Private key (ECDSA, RSA or EdDSA), certificate, and the intermediate certificates following it in
+    `cert_path`, if any.
+    """
+    from cryptography import x509
+
+    with open(key_path, 'rb') as f:
+        key = crypto.load_privatekey(crypto.FILETYPE_PEM, f.read())
+    with open(cert_path, 'rb') as f:
+        chain = [crypto.X509.from_cryptography(cert) for cert in x509.load_pem_x509_certificates(f.read())]
+    return key, chain[0], chain[1:]
+
+
+class TLSOptions(ssl.CertificateOptions):
+    """
+    `CertificateOptions` of the SSL frontend, also setting the key exchange groups (e.g. `X25519:P-256`, the
+    OpenSSL defaults when empty) and the lifetime of the resumable sessions, and counting the handshakes.
+
+    Session IDs and tickets are only known to the process that issued them: with `--workers`, a client
+    reconnecting to another worker gets a full handshake.
+    """
+
+    def __init__(self, groups='', session_timeout=3600, **kwargs):
+        super().__init__(**kwargs)
+        self.groups = groups
+        self.session_timeout = session_timeout
+        self.context = None
+        # connections whose handshake was counted already, as TLS 1.3 session tickets end with another
+        # "handshake done" event
+        self.handshaken = weakref.WeakSet()
+
+    def getContext(self) -> SSL.Context:
+        if self.context is None:
+            context = super().getContext()
+            if self.groups and not lib.SSL_CTX_set1_curves_list(context._context, self.groups.encode()):
+                raise ValueError(f'LDAP_GATEWAY_TLS_GROUPS must be OpenSSL group names. found {self.groups} instead')
+            context.set_timeout(int(self.session_timeout))
+            context.set_info_callback(self.info)
+            self.context = context
+        return self.context
+
+    def info(self, connection, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_DONE and connection not in self.handshaken:
+            self.handshaken.add(connection)
+            if lib.SSL_session_reused(connection._ssl):
+                metrics.TLS_HANDSHAKES_RESUMED.inc()
+            else:
+                metrics.TLS_HANDSHAKES_FULL.inc()
+
+
+def build_options(settings) -> TLSOptions:
+    """
+    TLS options of the SSL frontend, from the LDAP_GATEWAY_SSL_* and LDAP_GATEWAY_TLS_* settings.
+    """
+    if settings.LDAP_GATEWAY_TLS_MIN_VERSION not in TLS_VERSIONS:
+        raise ValueError(f'LDAP_GATEWAY_TLS_MIN_VERSION must be one of {list(TLS_VERSIONS)}. '
+                         f'found {settings.LDAP_GATEWAY_TLS_MIN_VERSION} instead')
+    key, certificate, chain = load_certificate(settings.LDAP_GATEWAY_SSL_KEY_PATH,
+                                               settings.LDAP_GATEWAY_SSL_CERT_PATH)
+    ciphers = None
+    if settings.LDAP_GATEWAY_TLS_CIPHERS:
+        ciphers = ssl.AcceptableCiphers.fromOpenSSLCipherString(settings.LDAP_GATEWAY_TLS_CIPHERS)
+
+    options = TLSOptions(
+        groups=settings.LDAP_GATEWAY_TLS_GROUPS,
+        session_timeout=settings.LDAP_GATEWAY_TLS_SESSION_TIMEOUT,
+        privateKey=key,
+        certificate=certificate,
+        extraCertChain=chain or None,
+        raiseMinimumTo=TLS_VERSIONS[settings.LDAP_GATEWAY_TLS_MIN_VERSION],
+        acceptableCiphers=ciphers,
+        enableSessions=settings.LDAP_GATEWAY_TLS_SESSION_CACHE,
+        enableSessionTickets=settings.LDAP_GATEWAY_TLS_SESSION_TICKETS)
+    # fail on startup rather than on the first connection
+    options.getContext()
+    logger.info(f"  TLS {settings.LDAP_GATEWAY_TLS_MIN_VERSION}+, {certificate.get_signature_algorithm().decode()} "
+                f"certificate, session cache: {settings.LDAP_GATEWAY_TLS_SESSION_CACHE}, "
+                f"session tickets: {settings.LDAP_GATEWAY_TLS_SESSION_TICKETS}")
+    return options
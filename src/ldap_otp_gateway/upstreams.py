@@ -0,0 +1,176 @@
+import logging
+
+from twisted.internet import defer, task
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# How new backend connections are spread over the upstream LDAP servers:
+# - failover: always the first available one, in the configured order
+# - least_connections: the available one with the fewest open connections relative to its weight
+FAILOVER = 'failover'
+LEAST_CONNECTIONS = 'least_connections'
+POLICIES = [FAILOVER, LEAST_CONNECTIONS]
+
+
+class Upstream:
+    """
+    One of the replicated backend LDAP servers. `connector()` opens a connection to it,
+    firing with a connected GatewayLDAPClient.
+    """
+
+    def __init__(self, name, connector, weight=1):
+        if weight <= 0:
+            raise ValueError(f'upstream weight must be positive. found {weight} for {name} instead')
+        self.name = name
+        self.connector = connector
+        self.weight = weight
+        self.connections = 0
+        self.available = True
+        self.ejected_at = None
+        self.checking = False
+        metrics.LDAP_UPSTREAM_UP.labels(name).set_function(lambda: int(self.available))
+        metrics.LDAP_UPSTREAM_CONNECTIONS.labels(name).set_function(lambda: self.connections)
+
+    def __repr__(self):
+        return f'Upstream({self.name})'
+
+
+class UpstreamSet:
+    """
+    Connects to one of several replicated backend LDAP servers, used as the connector of the
+    gateway protocols or of the backend connection pool.
+
+    A server failing a connection attempt or a health check is ejected, and the connection attempt
+    fails over to the next one. Ejected servers are re-admitted by the next successful health check,
+    a root DSE search run every `health_check_interval` seconds, or after `ejection_time` seconds
+    when health checks are disabled. When every server is ejected, they are all tried anyway.
+    """
+
+    def __init__(self, upstreams, policy=FAILOVER, health_check_interval=10.0, health_check_timeout=5.0,
+                 ejection_time=30.0, name='', reactor=None):
+        if not upstreams:
+            raise ValueError('At least one upstream LDAP server is required')
+        if policy not in POLICIES:
+            raise ValueError(f'upstream balancing policy must be one of {POLICIES}. found {policy} instead')
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.upstreams = upstreams
+        self.policy = policy
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self.ejection_time = ejection_time
+        self.name = name
+        self.reactor = reactor
+        self.checker = None
+
+    def start(self):
+        # a single server is used whatever its health
+        if self.health_check_interval > 0 and len(self.upstreams) > 1:
+            self.checker = task.LoopingCall(self.check_all)
+            self.checker.clock = self.reactor
+            self.checker.start(self.health_check_interval, now=False)
+
+    def stop(self):
+        if self.checker is not None and self.checker.running:
+            self.checker.stop()
+
+    def candidates(self) -> list:
+        """
+        Servers to try connecting to, in order.
+        """
+        if self.checker is None and self.ejection_time > 0:
+            now = self.reactor.seconds()
+            for upstream in self.upstreams:
+                if not upstream.available and now - upstream.ejected_at >= self.ejection_time:
+                    self.readmit(upstream)
+
+        available = [upstream for upstream in self.upstreams if upstream.available]
+        unavailable = [upstream for upstream in self.upstreams if not upstream.available]
+        if self.policy == LEAST_CONNECTIONS:
+            # stable: the configured order breaks the ties
+            available.sort(key=lambda upstream: upstream.connections / upstream.weight)
+        return available + unavailable
+
+    def connect(self) -> defer.Deferred:
+        """
+        Open a connection to the best available server, failing over to the next ones.
+        Fires with a connected GatewayLDAPClient.
+        """
+        return self.try_connect(self.candidates(), None)
+
+    def try_connect(self, candidates, failure) -> defer.Deferred:
+        if not candidates:
+            return defer.fail(failure)
+        upstream, others = candidates[0], candidates[1:]
+        # counted right away, so that concurrent connections are spread too
+        upstream.connections += 1
+        d = defer.maybeDeferred(upstream.connector)
+
+        def connected(client):
+            client.notify_connection_lost(lambda _: self.disconnected(upstream))
+            return client
+
+        def failed(failure):
+            upstream.connections -= 1
+            logger.warning(f"LDAP upstream {self.name} {upstream.name}: connection failed: {failure.value}")
+            self.eject(upstream)
+            return self.try_connect(others, failure)
+
+        d.addCallbacks(connected, failed)
+        return d
+
+    def disconnected(self, upstream):
+        upstream.connections -= 1
+
+    def eject(self, upstream):
+        if not upstream.available:
+            return
+        upstream.available = False
+        upstream.ejected_at = self.reactor.seconds()
+        metrics.LDAP_UPSTREAM_EJECTIONS.labels(upstream.name).inc()
+        logger.warning(f"LDAP upstream {self.name} {upstream.name}: ejected")
+
+    def readmit(self, upstream):
+        if upstream.available:
+            return
+        upstream.available = True
+        logger.info(f"LDAP upstream {self.name} {upstream.name}: re-admitted")
+
+    def check_all(self):
+        for upstream in self.upstreams:
+            if not upstream.checking:
+                self.check(upstream)
+
+    def check(self, upstream) -> defer.Deferred:
+        """
+        Health check a server on a dedicated connection, with a root DSE search.
+        """
+        upstream.checking = True
+        clients = []
+        d = defer.maybeDeferred(upstream.connector)
+
+        def search(client):
+            clients.append(client)
+            return client.search_root_dse()
+
+        def healthy(_):
+            self.readmit(upstream)
+
+        def unhealthy(failure):
+            logger.warning(f"LDAP upstream {self.name} {upstream.name}: health check failed: {failure.value}")
+            self.eject(upstream)
+
+        def done(_):
+            upstream.checking = False
+            for client in clients:
+                if client.connected:
+                    client.transport.loseConnection()
+
+        d.addCallback(search)
+        d.addTimeout(self.health_check_timeout, self.reactor)
+        d.addCallbacks(healthy, unhealthy)
+        d.addBoth(done)
+        return d
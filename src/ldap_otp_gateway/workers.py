@@ -0,0 +1,163 @@
+import logging
+import os
+import signal
+import socket
+import sys
+
+from twisted.internet import defer, error, protocol
+
+logger = logging.getLogger(__name__)
+
+
+def listen_socket(port, interface='', backlog=128) -> socket.socket:
+    """
+    Listening TCP socket to be shared with the worker processes.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        # once its SIGHUP handler is installed, and whether a reload was requested meanwhile
+        self.ready = False
+        self.reload_pending = False
+
+    def childDataReceived(self, childFD, data):
+        if childFD == self.supervisor.ready_fd and not self.ready:
+            self.supervisor.worker_ready(self)
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+class WorkerSupervisor:
+    """
+    Spawns the gateway worker processes, sharing the listening sockets with them by file descriptor
+    inheritance. Restarts the workers that die, forwards them the configuration reloads, and stops them all
+    gracefully on shutdown. `extra_args` are appended to the command line of the workers.
+
+    A worker dying again and again, e.g. on a bad configuration, is restarted after a delay doubling from
+    `restart_delay` up to `max_restart_delay` seconds. Once a worker died `max_restarts` times in a row without
+    running `healthy_uptime` seconds, the supervisor gives up and stops the reactor, `failed` being set.
+    """
+
+    def __init__(self, workers, fds, restart_delay=1.0, shutdown_timeout=10.0, extra_args=(), max_restart_delay=60.0,
+                 max_restarts=10, healthy_uptime=60.0, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.workers = workers
+        self.fds = fds
+        self.extra_args = list(extra_args)
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_restarts = max_restarts
+        self.healthy_uptime = healthy_uptime
+        self.shutdown_timeout = shutdown_timeout
+        self.reactor = reactor
+        # the workers tell when they are ready on this file descriptor, following the listening sockets ones
+        self.ready_fd = max(fds) + 1
+        self.processes = {}
+        # per worker index: when its current process started, and how many times in a row it died early
+        self.started_at = {}
+        self.failures = {}
+        self.stopping = False
+        self.stopped = None
+        self.failed = False
+
+    def start(self):
+        for index in range(self.workers):
+            self.spawn(index)
+        self.reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        args = [sys.executable, '-m', 'ldap_otp_gateway.run', '--worker-fds', ','.join(map(str, self.fds)),
+                '--worker-index', str(index), '--worker-ready-fd', str(self.ready_fd)] + self.extra_args
+        child_fds = {0: 0, 1: 1, 2: 2, self.ready_fd: 'r'}
+        child_fds.update({fd: fd for fd in self.fds})
+        process = self.reactor.spawnProcess(
+            WorkerProcessProtocol(self, index), sys.executable, args, env=os.environ, childFDs=child_fds)
+        self.processes[index] = process
+        self.started_at[index] = self.reactor.seconds()
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def worker_ended(self, process_protocol, reason):
+        index = process_protocol.index
+        self.processes.pop(index, None)
+        if self.stopping:
+            logger.info(f"Worker {index} stopped")
+            if not self.processes and self.stopped is not None and not self.stopped.called:
+                self.stopped.callback(None)
+            return
+
+        if self.reactor.seconds() - self.started_at.get(index, 0) >= self.healthy_uptime:
+            self.failures[index] = 0
+        failures = self.failures[index] = self.failures.get(index, 0) + 1
+        if failures > self.max_restarts:
+            logger.critical(f"Worker {index} died ({reason.value}) {failures} times in a row, giving up")
+            self.failed = True
+            self.reactor.stop()
+            return
+
+        delay = min(self.restart_delay * 2 ** (failures - 1), self.max_restart_delay)
+        logger.error(f"Worker {index} died ({reason.value}), restarting it in {delay} seconds")
+        self.reactor.callLater(delay, self.spawn, index)
+
+    def worker_ready(self, process_protocol):
+        process_protocol.ready = True
+        if process_protocol.reload_pending and not self.stopping:
+            process_protocol.reload_pending = False
+            self.signal(process_protocol.transport, signal.SIGHUP)
+
+    def reload(self):
+        """
+        Ask the workers to reload their configuration. The restarted ones inherit the environment of the supervisor.
+        The workers still starting get the reload once ready: a SIGHUP before their handler is installed would
+        terminate them.
+        """
+        if self.stopping:
+            return
+        logger.info(f"Reloading the configuration of {len(self.processes)} workers")
+        for process in list(self.processes.values()):
+            if process.proto.ready:
+                self.signal(process, signal.SIGHUP)
+            else:
+                process.proto.reload_pending = True
+
+    def stop(self) -> defer.Deferred:
+        """
+        Ask the workers to terminate, and kill the ones still running after the shutdown timeout.
+        """
+        self.stopping = True
+        if not self.processes:
+            return defer.succeed(None)
+
+        self.stopped = defer.Deferred()
+        for process in list(self.processes.values()):
+            self.signal(process, signal.SIGTERM)
+
+        def kill(result, timeout):
+            logger.warning(f"Workers still running after {timeout} seconds, killing them")
+            for process in list(self.processes.values()):
+                self.signal(process, signal.SIGKILL)
+
+        self.stopped.addTimeout(self.shutdown_timeout, self.reactor, onTimeoutCancel=kill)
+        return self.stopped
+
+    @staticmethod
+    def signal(process, signum):
+        try:
+            process.signalProcess(signum)
+        except error.ProcessExitedAlready:
+            pass
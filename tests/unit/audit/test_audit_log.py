@@ -0,0 +1,127 @@
+import threading
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ldap_otp_gateway import metrics
+from ldap_otp_gateway.audit import DROP_OLDEST, FAIL_CLOSED, AuditLog, build_audit_log, worker_path
+from ldap_otp_gateway.audit.base_audit_sink import BaseAuditSink
+from ldap_otp_gateway.config import Settings
+
+
+class FakeSink(BaseAuditSink):
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.threads = set()
+        self.failures = failures
+        self.closed = False
+
+    def write(self, records):
+        self.threads.add(threading.current_thread().name)
+        if self.failures:
+            self.failures -= 1
+            raise OSError('disk full')
+        self.batches.append(records)
+
+    def close(self):
+        self.closed = True
+
+
+class TestAuditLog(unittest.TestCase):
+
+    def build(self, sink, **kwargs):
+        audit_log = AuditLog(sink, **kwargs)
+        audit_log.threadpool.start()
+        self.addCleanup(audit_log.threadpool.stop)
+        return audit_log
+
+    @defer.inlineCallbacks
+    def test_batches_written_off_reactor_thread(self):
+        sink = FakeSink()
+        audit_log = self.build(sink, batch_size=2)
+
+        for index in range(5):
+            audit_log.record({'index': index})
+        yield audit_log.drain()
+
+        self.assertEqual([[{'index': 0}, {'index': 1}], [{'index': 2}, {'index': 3}], [{'index': 4}]], sink.batches)
+        self.assertEqual(1, len(sink.threads))
+        self.assertNotIn(threading.current_thread().name, sink.threads)
+
+    @defer.inlineCallbacks
+    def test_failed_batch_retried(self):
+        retried = metrics.AUDIT_RECORDS_RETRIED.get()
+        sink = FakeSink(failures=1)
+        audit_log = self.build(sink, batch_size=10)
+        audit_log.record({'index': 0})
+
+        yield audit_log.flush()
+        self.assertEqual([{'index': 0}], list(audit_log.queue))
+        self.assertEqual(retried + 1, metrics.AUDIT_RECORDS_RETRIED.get())
+
+        audit_log.record({'index': 1})
+        yield audit_log.flush()
+        self.assertEqual([[{'index': 0}, {'index': 1}]], sink.batches)
+
+    def test_drop_newest(self):
+        dropped = metrics.AUDIT_RECORDS_DROPPED.get()
+        audit_log = AuditLog(FakeSink(), queue_size=2, batch_size=10)
+
+        for index in range(3):
+            audit_log.record({'index': index})
+
+        self.assertEqual([{'index': 0}, {'index': 1}], list(audit_log.queue))
+        self.assertEqual(dropped + 1, metrics.AUDIT_RECORDS_DROPPED.get())
+        self.assertTrue(audit_log.accepting)
+
+    def test_drop_oldest(self):
+        audit_log = AuditLog(FakeSink(), queue_size=2, batch_size=10, overflow=DROP_OLDEST)
+
+        for index in range(3):
+            audit_log.record({'index': index})
+
+        self.assertEqual([{'index': 1}, {'index': 2}], list(audit_log.queue))
+
+    def test_fail_closed(self):
+        audit_log = AuditLog(FakeSink(), queue_size=2, batch_size=10, overflow=FAIL_CLOSED)
+
+        audit_log.record({'index': 0})
+        self.assertTrue(audit_log.accepting)
+        audit_log.record({'index': 1})
+        self.assertFalse(audit_log.accepting)
+        # the binds in flight are still recorded
+        audit_log.record({'index': 2})
+        self.assertEqual(3, len(audit_log.queue))
+
+    @defer.inlineCallbacks
+    def test_stop_writes_queued_records(self):
+        sink = FakeSink()
+        audit_log = AuditLog(sink, batch_size=10)
+        audit_log.start()
+        audit_log.record({'index': 0})
+
+        yield audit_log.stop()
+
+        self.assertEqual([[{'index': 0}]], sink.batches)
+        self.assertTrue(sink.closed)
+
+    def test_invalid_overflow(self):
+        with self.assertRaises(ValueError):
+            AuditLog(FakeSink(), overflow='block')
+
+
+class TestBuildAuditLog(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(build_audit_log(Settings({})))
+
+    def test_worker_file(self):
+        audit_log = build_audit_log(Settings({'AUDIT_SINK': 'jsonl', 'AUDIT_FILE_PATH': '/var/log/audit.jsonl'}), 1)
+
+        self.assertEqual('/var/log/audit.1.jsonl', audit_log.sink.path)
+        self.assertEqual('/var/log/audit.0', worker_path('/var/log/audit', 0))
+
+    def test_invalid_sink(self):
+        with self.assertRaises(ValueError):
+            build_audit_log(Settings({'AUDIT_SINK': 'syslog'}))
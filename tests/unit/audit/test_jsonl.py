@@ -0,0 +1,45 @@
+import json
+import os
+import tempfile
+import unittest
+
+from ldap_otp_gateway.audit.jsonl import JsonLinesSink
+
+
+def record(index):
+    return {'time': 0.0, 'dn': f'cn=user{index}', 'peer': '10.0.0.1', 'mode': 'filtered', 'result_code': 0,
+            'message': None, 'otp': 'success', 'timings': {'total': 0.01}}
+
+
+class TestJsonLinesSink(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'audit.jsonl')
+
+    def read(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_write(self):
+        sink = JsonLinesSink(self.path)
+        self.addCleanup(sink.close)
+        sink.write([record(0), record(1)])
+        sink.write([record(2)])
+
+        lines = self.read(self.path)
+        self.assertEqual(['cn=user0', 'cn=user1', 'cn=user2'], [line['dn'] for line in lines])
+        self.assertEqual('1970-01-01T00:00:00+00:00', lines[0]['time'])
+        self.assertEqual({'total': 0.01}, lines[0]['timings'])
+
+    def test_rotation(self):
+        sink = JsonLinesSink(self.path, max_bytes=1, backup_count=2)
+        self.addCleanup(sink.close)
+        for index in range(4):
+            sink.write([record(index)])
+
+        self.assertEqual([], self.read(self.path))
+        self.assertEqual(['cn=user3'], [line['dn'] for line in self.read(f'{self.path}.1')])
+        self.assertEqual(['cn=user2'], [line['dn'] for line in self.read(f'{self.path}.2')])
+        self.assertFalse(os.path.exists(f'{self.path}.3'))
@@ -0,0 +1,55 @@
+import datetime
+import unittest
+from unittest.mock import MagicMock
+
+from ldap_otp_gateway.audit.postgres import PostgresSink
+
+
+class FakeCopy:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def write_row(self, row):
+        self.rows.append(row)
+
+
+class TestPostgresSink(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = []
+        self.connection = MagicMock(closed=False)
+        cursor = self.connection.cursor.return_value.__enter__.return_value
+        cursor.copy.side_effect = lambda statement: FakeCopy(self.rows)
+        self.connect = MagicMock(return_value=self.connection)
+
+    def test_copy(self):
+        sink = PostgresSink('dbname=audit', connect=self.connect)
+        sink.write([{'time': 0.0, 'dn': 'cn=user', 'peer': '10.0.0.1', 'mode': 'filtered', 'result_code': 49,
+                     'message': 'Invalid OTP', 'otp': 'failure', 'timings': {'total': 0.01}}])
+
+        [row] = self.rows
+        self.assertEqual((datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc), 'cn=user', '10.0.0.1',
+                          'filtered', 49, 'Invalid OTP', 'failure', '{"total": 0.01}'), row)
+        self.connection.commit.assert_called_once_with()
+        self.connect.assert_called_once_with('dbname=audit')
+
+    def test_reconnects_after_failure(self):
+        sink = PostgresSink('dbname=audit', connect=self.connect)
+        self.connection.commit.side_effect = [Exception('connection lost'), None]
+
+        with self.assertRaises(Exception):
+            sink.write([])
+        self.connection.close.assert_called_once_with()
+        sink.write([])
+        self.assertEqual(2, self.connect.call_count)
+
+    def test_dsn_required(self):
+        with self.assertRaises(ValueError):
+            PostgresSink('')
@@ -0,0 +1,70 @@
+"""
+Local in-memory LDAP directory, served by ldaptor, for tests and benchmarks.
+
+Counts the accepted TCP connections, and can inject latency in every response.
+"""
+from ldaptor.inmemory import ReadOnlyInMemoryLDAPEntry
+from ldaptor.interfaces import IConnectedLDAPEntry
+from ldaptor.protocols.ldap.ldapserver import LDAPServer
+from twisted.internet import protocol, task
+from twisted.internet import reactor as default_reactor
+from twisted.python.components import registerAdapter
+
+BASE_DN = 'dc=example,dc=com'
+USER_DN = f'cn=user,{BASE_DN}'
+USER_PASSWORD = 'password'
+
+
+def build_directory(users=1):
+    root = ReadOnlyInMemoryLDAPEntry(
+        dn=BASE_DN.encode(),
+        attributes={'objectClass': ['dcObject', 'organization'], 'dc': ['example'], 'o': ['Example']})
+    root.addChild('cn=user', {'objectClass': ['person'], 'cn': ['user'], 'sn': ['user'],
+                              'userPassword': [USER_PASSWORD]})
+    for i in range(1, users):
+        root.addChild(f'cn=user{i}', {'objectClass': ['person'], 'cn': [f'user{i}'], 'sn': [f'user{i}'],
+                                      'userPassword': [USER_PASSWORD]})
+    return root
+
+
+class FakeLDAPServer(LDAPServer):
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.factory.connections += 1
+        self.factory.open_connections += 1
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.factory.open_connections -= 1
+        super().connectionLost(reason)
+
+    def handle(self, msg):
+        self.factory.requests.append(msg.value)
+        if self.factory.latency <= 0:
+            return super().handle(msg)
+        return task.deferLater(self.factory.reactor, self.factory.latency, super().handle, msg)
+
+
+class FakeLDAPServerFactory(protocol.ServerFactory):
+    protocol = FakeLDAPServer
+    noisy = False
+
+    def __init__(self, root=None, latency=0.0, reactor=None):
+        self.root = root if root is not None else build_directory()
+        self.latency = latency
+        self.reactor = reactor if reactor is not None else default_reactor
+        self.connections = 0
+        self.open_connections = 0
+        self.requests = []
+
+
+registerAdapter(lambda factory: factory.root, FakeLDAPServerFactory, IConnectedLDAPEntry)
+
+
+def listen(factory, interface='127.0.0.1', reactor=None):
+    """
+    Listen on a random local port. Returns the listening port and its `tcp:` connection string.
+    """
+    reactor = reactor if reactor is not None else default_reactor
+    port = reactor.listenTCP(0, factory, interface=interface)
+    return port, f'tcp:{interface}:{port.getHost().port}'
@@ -0,0 +1,102 @@
+import os
+import tempfile
+from unittest.mock import MagicMock
+
+from twisted.trial import unittest
+
+from ldap_otp_gateway.gateway_filter.dn_index import DNIndex, GatewayFilter
+
+
+def bind_request(dn: str):
+    request = MagicMock()
+    request.dn = dn.encode()
+    return request
+
+
+class TestDNIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = DNIndex([
+            'cn=admin,dc=example,dc=com',
+            '*,ou=svc,dc=example,dc=com',
+        ])
+
+    def test_exact(self):
+        self.assertTrue(self.index.match('CN=Admin, DC=example,DC=com'))
+        self.assertFalse(self.index.match('cn=other,dc=example,dc=com'))
+
+    def test_subtree(self):
+        self.assertTrue(self.index.match('cn=backup,ou=svc,dc=example,dc=com'))
+        self.assertTrue(self.index.match('cn=backup,ou=eu,OU=Svc,dc=example,dc=com'))
+        self.assertFalse(self.index.match('cn=backup,ou=people,dc=example,dc=com'))
+
+    def test_subtree_base_not_matched(self):
+        self.assertFalse(self.index.match('ou=svc,dc=example,dc=com'))
+
+    def test_suffix_not_matched(self):
+        self.assertFalse(self.index.match('dc=com'))
+        self.assertFalse(self.index.match(''))
+
+    def test_len(self):
+        self.assertEqual(2, len(self.index))
+
+
+class TestDNIndexGatewayFilter(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.write('# service accounts\n\ncn=admin,dc=example,dc=com\n*,ou=svc,dc=example,dc=com\n')
+        self.now = 0.0
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def build_filter(self, reload_interval=5):
+        return GatewayFilter(self.path, reload_interval=reload_interval, clock=lambda: self.now)
+
+    def test_ignore(self):
+        gateway_filter = self.build_filter()
+        self.assertTrue(gateway_filter.ignore(bind_request('cn=admin,dc=example,dc=com')))
+        self.assertTrue(gateway_filter.ignore(bind_request('cn=app,ou=svc,dc=example,dc=com')))
+        self.assertFalse(gateway_filter.ignore(bind_request('cn=user,dc=example,dc=com')))
+
+    def test_reload_throttled(self):
+        gateway_filter = self.build_filter()
+        self.write('cn=user,dc=example,dc=com\n')
+        os.utime(self.path, ns=(gateway_filter.mtime + 1, gateway_filter.mtime + 1))
+
+        self.now = 4.0
+        gateway_filter.ignore(bind_request('cn=user,dc=example,dc=com'))
+        self.assertIsNone(gateway_filter.reloading)
+
+        self.now = 5.0
+        gateway_filter.ignore(bind_request('cn=user,dc=example,dc=com'))
+        d = gateway_filter.reloading
+        self.assertIsNotNone(d)
+
+        def reloaded(_):
+            self.assertTrue(gateway_filter.ignore(bind_request('cn=user,dc=example,dc=com')))
+            self.assertFalse(gateway_filter.ignore(bind_request('cn=admin,dc=example,dc=com')))
+
+        return d.addCallback(reloaded)
+
+    def test_not_reloaded_when_unchanged(self):
+        gateway_filter = self.build_filter()
+        self.now = 10.0
+        gateway_filter.ignore(bind_request('cn=user,dc=example,dc=com'))
+        self.assertIsNone(gateway_filter.reloading)
+
+    def test_missing_file_keeps_entries(self):
+        gateway_filter = self.build_filter()
+        os.rename(self.path, self.path + '.bak')
+        self.addCleanup(os.rename, self.path + '.bak', self.path)
+
+        self.now = 10.0
+        self.assertTrue(gateway_filter.ignore(bind_request('cn=admin,dc=example,dc=com')))
+
+    def test_path_required(self):
+        with self.assertRaises(ValueError):
+            GatewayFilter()
@@ -0,0 +1,101 @@
+"""
+Local fake of the RCDevs WebAdm SOAP service, in the spirit of `example/otp.py`, for tests and benchmarks.
+
+Accepts any `anyPassword` ending with the configured OTP, counts the accepted TCP connections
+to observe keep-alive reuse, and can inject latency on every request and on the first request
+of each new connection (to mimic the TCP/TLS handshake cost).
+"""
+import re
+
+from twisted.internet import reactor as default_reactor
+from twisted.web import resource, server
+
+RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ns1="urn:openotp">
+<SOAP-ENV:Body>
+<ns1:openotpSimpleLoginResponse>
+    <code>{code}</code>
+    <error/>
+    <message>{message}</message>
+    <data/>
+    <concat>8</concat>
+</ns1:openotpSimpleLoginResponse>
+</SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+"""
+
+ANY_PASSWORD_PATTERN = re.compile(rb'<m:anyPassword[^>]*>(.*)</m:anyPassword>')
+
+
+class FakeSoapResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, site):
+        super().__init__()
+        self.site = site
+
+    def render_POST(self, request):
+        self.site.requests += 1
+        body = request.content.read()
+        match = ANY_PASSWORD_PATTERN.search(body)
+        success = match is not None and match.group(1).endswith(self.site.otp.encode())
+        content = RESPONSE_TEMPLATE.format(
+            code=1 if success else 0,
+            message='Authentication success' if success else 'Wrong username or password').encode()
+        request.setHeader(b'Content-Type', b'text/xml')
+
+        latency = self.site.latency
+        if request.channel not in self.site.warm_channels:
+            self.site.warm_channels.add(request.channel)
+            latency += self.site.connect_latency
+        if latency <= 0:
+            return content
+
+        def respond():
+            self.site.delayed.discard(call)
+            request.write(content)
+            request.finish()
+
+        def disconnected(_):
+            self.site.delayed.discard(call)
+            if call.active():
+                call.cancel()
+
+        call = self.site.reactor.callLater(latency, respond)
+        self.site.delayed.add(call)
+        request.notifyFinish().addErrback(disconnected)
+        return server.NOT_DONE_YET
+
+
+class FakeSoapSite(server.Site):
+
+    def __init__(self, otp='123456', latency=0.0, connect_latency=0.0, reactor=None):
+        self.otp = otp
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.reactor = reactor if reactor is not None else default_reactor
+        self.connections = 0
+        self.requests = 0
+        self.warm_channels = set()
+        self.delayed = set()
+        super().__init__(FakeSoapResource(self))
+        self.noisy = False
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return super().buildProtocol(addr)
+
+    def cancel_delayed(self):
+        for call in self.delayed:
+            if call.active():
+                call.cancel()
+        self.delayed.clear()
+
+
+def listen(site, interface='127.0.0.1', reactor=None):
+    """
+    Listen on a random local port. Returns the listening port and the OTP endpoint URI.
+    """
+    reactor = reactor if reactor is not None else default_reactor
+    port = reactor.listenTCP(0, site, interface=interface)
+    return port, f'http://{interface}:{port.getHost().port}/openotp/'
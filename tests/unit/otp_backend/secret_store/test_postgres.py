@@ -0,0 +1,230 @@
+import pyotp
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ldap_otp_gateway.otp_backend.secret_store.postgres import SecretStore, INSERT_USED_STEP, LOCK_USER, \
+    PRUNE_USED_STEPS, SELECT_LAST_USED, SELECT_SECRET
+from ldap_otp_gateway.otp_backend.totp import OtpBackend
+
+SECRET = 'JBSWY3DPEHPK3PXP'
+USER = 'cn=user,dc=example,dc=com'
+
+
+class FakeCursor:
+    """
+    Stand-in of a cursor over the otp_used_steps table of the pool.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.row = None
+
+    def execute(self, query, params):
+        self.pool.executed.append(query)
+        if query == LOCK_USER:
+            self.row = (None,)
+        elif query == SELECT_LAST_USED:
+            steps = self.pool.used_steps.get(params[0], set())
+            self.row = (max(steps) if steps else None,)
+        elif query == INSERT_USED_STEP:
+            username, step = params
+            steps = self.pool.used_steps.setdefault(username, set())
+            self.row = None if step in steps else (step,)
+            steps.add(step)
+        else:
+            raise AssertionError(query)
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeConnection:
+    """
+    Stand-in of a psycopg connection for the blocking lookups and claims.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params):
+        assert query == SELECT_SECRET
+        secret = self.pool.secrets.get(params[0])
+        cursor = FakeCursor(self.pool)
+        cursor.row = None if secret is None else (secret,)
+        return cursor
+
+    def cursor(self):
+        return FakeCursor(self.pool)
+
+
+class FakePool:
+    """
+    Stand-in of an adbapi ConnectionPool over the otp_secrets and otp_used_steps tables.
+    Lookups stay pending until `answer()` is called.
+    """
+
+    def __init__(self, secrets, used_steps=None):
+        self.secrets = secrets
+        self.used_steps = used_steps or {}
+        self.queries = []
+        self.executed = []
+        self.closed = False
+
+    def runQuery(self, query, params):
+        assert query == SELECT_SECRET
+        d = defer.Deferred()
+        self.queries.append((params, d))
+        return d
+
+    def answer(self):
+        queries, self.queries = self.queries, []
+        for (username,), d in queries:
+            secret = self.secrets.get(username)
+            d.callback([] if secret is None else [(secret,)])
+
+    def runInteraction(self, interaction, *args):
+        return defer.maybeDeferred(interaction, FakeCursor(self), *args)
+
+    def runOperation(self, query):
+        self.executed.append(query)
+        return defer.succeed(None)
+
+    def close(self):
+        self.closed = True
+
+
+class TestPostgresSecretStore(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = FakePool({USER: SECRET}, {USER: {10}})
+        self.store = SecretStore(pool=self.pool, cache_ttl=60, miss_cache_ttl=5, cache_max_size=2,
+                                 prune_interval=3600, listen=False, reactor=self.clock)
+
+    def test_lookup_cached(self):
+        d = self.store.get_async(USER.upper())
+        self.pool.answer()
+        self.assertEqual(SECRET, self.successResultOf(d))
+
+        self.assertEqual(SECRET, self.successResultOf(self.store.get_async(USER)))
+        self.assertEqual([], self.pool.queries)
+        self.assertEqual(1, self.store.hits)
+
+    def test_unknown_user_cached(self):
+        d = self.store.get_async('cn=other')
+        self.pool.answer()
+        self.assertIsNone(self.successResultOf(d))
+
+        self.assertIsNone(self.successResultOf(self.store.get_async('cn=other')))
+        self.assertEqual([], self.pool.queries)
+
+        # shortly
+        self.clock.advance(5)
+        self.assertNoResult(self.store.get_async('cn=other'))
+        self.assertNotIn('cn=other', self.store.cache)
+
+    def test_cache_bounded(self):
+        for username in (USER, 'cn=a', USER, 'cn=b'):
+            self.store.get_async(username)
+            self.pool.answer()
+
+        # the least recently looked up user is evicted first
+        self.assertEqual([USER, 'cn=b'], list(self.store.cache))
+
+    def test_cache_expires(self):
+        self.store.get_async(USER)
+        self.pool.answer()
+        self.clock.advance(60)
+
+        self.assertNoResult(self.store.get_async(USER))
+        self.assertEqual(1, len(self.pool.queries))
+
+    def test_concurrent_lookups_share_the_query(self):
+        first, second = self.store.get_async(USER), self.store.get_async(USER)
+        self.assertEqual(1, len(self.pool.queries))
+        self.pool.answer()
+
+        self.assertEqual(SECRET, self.successResultOf(first))
+        self.assertEqual(SECRET, self.successResultOf(second))
+
+    def test_invalidate(self):
+        self.store.get_async(USER)
+        self.pool.answer()
+
+        self.store.invalidate(USER)
+        self.assertNoResult(self.store.get_async(USER))
+
+    def test_invalidate_all(self):
+        self.store.get_async(USER)
+        self.pool.answer()
+
+        self.store.invalidate(None)
+        self.assertEqual({}, self.store.cache)
+
+    def test_lookup_invalidated_while_pending_not_cached(self):
+        d = self.store.get_async(USER)
+        self.store.invalidate(USER)
+        self.pool.answer()
+
+        self.assertEqual(SECRET, self.successResultOf(d))
+        self.assertNotIn(USER, self.store.cache)
+
+    def test_claim_decided_by_the_database(self):
+        d = self.store.claim_async(USER.upper(), lambda last_used: 11 if last_used < 11 else None)
+        self.assertEqual(11, self.successResultOf(d))
+        self.assertEqual([LOCK_USER, SELECT_LAST_USED, INSERT_USED_STEP], self.pool.executed)
+        self.assertEqual({10, 11}, self.pool.used_steps[USER])
+
+        # e.g. claimed meanwhile by another gateway process
+        d = self.store.claim_async(USER, lambda last_used: 11 if last_used < 11 else None)
+        self.assertIsNone(self.successResultOf(d))
+
+    def test_claim_of_recorded_step_rejected(self):
+        d = self.store.claim_async(USER, lambda last_used: 10)
+        self.assertIsNone(self.successResultOf(d))
+
+    def test_blocking_lookup_and_claim(self):
+        self.store.connect = lambda: FakeConnection(self.pool)
+
+        self.assertEqual(SECRET, self.store.get(USER.upper()))
+        self.assertIsNone(self.store.get('cn=other'))
+        self.assertEqual(12, self.store.claim(USER, lambda last_used: last_used + 2))
+        self.assertIsNone(self.store.claim(USER, lambda last_used: 12))
+
+    def test_started_and_closed(self):
+        self.store.start()
+        self.clock.advance(3600)
+        self.assertEqual([PRUNE_USED_STEPS], self.pool.executed)
+
+        self.store.close()
+        self.assertTrue(self.pool.closed)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_totp_backend_rejects_step_used_by_another_process(self):
+        backend = OtpBackend(self.store, mode='totp', digits=6, period=30, digest='sha1', drift=1,
+                             clock=lambda: 30 * 10 + 1)
+        d = backend.verify_async(USER, 'password', pyotp.TOTP(SECRET).generate_otp(10))
+        self.pool.answer()
+        self.assertEqual((False, 'OTP already used'), self.successResultOf(d))
+
+        d = backend.verify_async(USER, 'password', pyotp.TOTP(SECRET).generate_otp(11))
+        self.assertEqual((True, None), self.successResultOf(d))
+        self.assertEqual({10, 11}, self.pool.used_steps[USER])
+
+    def test_totp_code_accepted_once_across_processes(self):
+        backends = [OtpBackend(self.store, mode='totp', digits=6, period=30, digest='sha1', drift=1,
+                               clock=lambda: 30 * 11 + 1) for _ in range(2)]
+        otp = pyotp.TOTP(SECRET).generate_otp(11)
+        d = backends[0].verify_async(USER, 'password', otp)
+        self.pool.answer()
+        self.assertEqual((True, None), self.successResultOf(d))
+
+        # the other process has the secret cached, and no local trace of the code
+        self.assertEqual((False, 'OTP already used'), self.successResultOf(backends[1].verify_async(USER, 'password',
+                                                                                                    otp)))
@@ -0,0 +1,31 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from ldap_otp_gateway.otp_backend.secret_store.static import SecretStore
+
+
+class TestStaticSecretStore(unittest.TestCase):
+
+    def test_case_insensitive(self):
+        store = SecretStore({'CN=User,DC=example': 'SECRET'})
+        self.assertEqual('SECRET', store.get('cn=user,dc=EXAMPLE'))
+        self.assertIsNone(store.get('cn=other'))
+
+    @patch.dict(os.environ, {'OTP_SECRETS': '{"cn=user": "SECRET"}'})
+    def test_from_env(self):
+        self.assertEqual('SECRET', SecretStore().get('cn=user'))
+
+    def test_from_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({'cn=user': 'SECRET'}, f)
+        self.addCleanup(os.remove, f.name)
+
+        with patch.dict(os.environ, {'OTP_SECRETS_FILE': f.name}):
+            self.assertEqual('SECRET', SecretStore().get('cn=user'))
+
+    def test_get_async(self):
+        d = SecretStore({'cn=user': 'SECRET'}).get_async('cn=user')
+        self.assertEqual('SECRET', d.result)
@@ -0,0 +1,89 @@
+import unittest
+
+from ldap_otp_gateway.otp_backend.balancer import EWMA, Balancer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestBalancer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_least_outstanding(self):
+        balancer = Balancer(['a', 'b', 'c'], clock=self.clock)
+        selected = [balancer.select() for _ in range(3)]
+
+        self.assertEqual(['a', 'b', 'c'], sorted(endpoint.uri for endpoint in selected))
+
+        balancer.done(selected[1], 0.01, True)
+        self.assertIs(selected[1], balancer.select())
+
+    def test_ewma(self):
+        balancer = Balancer(['slow', 'fast'], policy=EWMA, clock=self.clock)
+        slow, fast = balancer.endpoints
+        for endpoint, latency in ((slow, 0.45), (fast, 0.1)):
+            endpoint.outstanding += 1
+            balancer.done(endpoint, latency, True)
+
+        self.assertEqual(['fast'] * 4, [balancer.select().uri for _ in range(4)])
+        # until it has too many outstanding requests
+        self.assertEqual('slow', balancer.select().uri)
+
+    def test_ewma_smoothing(self):
+        balancer = Balancer(['a'], policy=EWMA, ewma_weight=0.5, clock=self.clock)
+        endpoint = balancer.endpoints[0]
+        for latency in (1.0, 0.0):
+            balancer.select()
+            balancer.done(endpoint, latency, True)
+
+        self.assertEqual(0.5, endpoint.ewma)
+
+    def test_ejection(self):
+        balancer = Balancer(['a', 'b'], ejection_failures=2, ejection_time=10, clock=self.clock)
+        a, b = balancer.endpoints
+        for _ in range(2):
+            a.outstanding += 1
+            balancer.done(a, 1.0, False)
+
+        self.assertEqual(['b'] * 3, [balancer.select().uri for _ in range(3)])
+
+        self.clock.now = 10
+        self.assertIs(a, balancer.select())
+
+    def test_all_ejected(self):
+        balancer = Balancer(['a', 'b'], ejection_failures=1, ejection_time=10, clock=self.clock)
+        a, b = balancer.endpoints
+        a.outstanding += 1
+        balancer.done(a, 1.0, False)
+        self.clock.now = 1
+        b.outstanding += 1
+        balancer.done(b, 1.0, False)
+
+        # the one back the soonest
+        self.assertIs(a, balancer.select())
+
+    def test_exclude(self):
+        balancer = Balancer(['a', 'b'], clock=self.clock)
+        a, b = balancer.endpoints
+
+        self.assertEqual(['b'] * 3, [balancer.select(exclude=a).uri for _ in range(3)])
+        single = Balancer(['a'], clock=self.clock)
+        self.assertIs(single.endpoints[0], single.select(exclude=single.endpoints[0]))
+
+    def test_cancelled(self):
+        balancer = Balancer(['a'], clock=self.clock)
+        endpoint = balancer.select()
+        balancer.cancelled(endpoint)
+
+        self.assertEqual((0, 0, 0.0), (endpoint.outstanding, endpoint.failures, endpoint.ewma))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            Balancer(['a'], policy='random')
@@ -0,0 +1,40 @@
+import threading
+
+from twisted.trial import unittest
+
+from ldap_otp_gateway.otp_backend.base_otp_backend import BaseOtpBackend, stop_thread_pool
+
+
+class ThreadRecordingOtpBackend(BaseOtpBackend):
+    def __init__(self):
+        self.thread = None
+
+    def verify(self, username, password, otp) -> (bool, (str or None)):
+        self.thread = threading.current_thread()
+        return otp == '123456', None
+
+
+class TestBaseOtpBackend(unittest.TestCase):
+
+    def tearDown(self):
+        # the reactor never shuts down under trial, stop the pool ourselves
+        stop_thread_pool()
+
+    def test_verify_not_implemented(self):
+        with self.assertRaises(NotImplementedError):
+            BaseOtpBackend().verify('user', 'password', '123456')
+
+    def test_verify_async_runs_in_thread_pool(self):
+        backend = ThreadRecordingOtpBackend()
+        d = backend.verify_async('user', 'password', '123456')
+
+        def check(result):
+            self.assertEqual(result, (True, None))
+            self.assertIsNot(backend.thread, threading.current_thread())
+
+        d.addCallback(check)
+        return d
+
+    def test_verify_async_propagates_errors(self):
+        d = BaseOtpBackend().verify_async('user', 'password', '123456')
+        return self.assertFailure(d, NotImplementedError)
@@ -0,0 +1,90 @@
+from unittest.mock import MagicMock
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ldap_otp_gateway.otp_backend.base_otp_backend import BaseOtpBackend
+from ldap_otp_gateway.otp_backend.cache import CachingOtpBackend
+
+
+def mock_backend(result=(True, None)):
+    backend = MagicMock(spec=BaseOtpBackend)
+    backend.verify.return_value = result
+    backend.verify_async.side_effect = lambda *args: defer.succeed(result)
+    return backend
+
+
+class TestCachingOtpBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_repeated_verification_served_from_cache(self):
+        backend = mock_backend()
+        cache = CachingOtpBackend(backend, ttl=10, reactor=self.clock)
+
+        self.assertEqual((True, None), self.successResultOf(cache.verify_async('user', 'password', '123456')))
+        self.assertEqual((True, None), self.successResultOf(cache.verify_async('user', 'password', '123456')))
+        self.assertEqual((True, None), cache.verify('user', 'password', '123456'))
+
+        backend.verify_async.assert_called_once_with('user', 'password', '123456')
+        backend.verify.assert_not_called()
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_other_credentials_not_served_from_cache(self):
+        backend = mock_backend()
+        cache = CachingOtpBackend(backend, ttl=10, reactor=self.clock)
+
+        self.successResultOf(cache.verify_async('user', 'password', '123456'))
+        self.successResultOf(cache.verify_async('user', 'password', '654321'))
+        self.successResultOf(cache.verify_async('user', 'other', '123456'))
+        self.successResultOf(cache.verify_async('other', 'password', '123456'))
+
+        self.assertEqual(4, backend.verify_async.call_count)
+        self.assertEqual(0, cache.hits)
+
+    def test_failures_not_cached(self):
+        backend = mock_backend((False, 'Wrong OTP'))
+        cache = CachingOtpBackend(backend, ttl=10, reactor=self.clock)
+
+        self.assertEqual((False, 'Wrong OTP'), self.successResultOf(cache.verify_async('user', 'password', '000000')))
+        self.assertEqual((False, 'Wrong OTP'), self.successResultOf(cache.verify_async('user', 'password', '000000')))
+
+        self.assertEqual(2, backend.verify_async.call_count)
+        self.assertEqual(0, len(cache.entries))
+
+    def test_entries_expire(self):
+        backend = mock_backend()
+        cache = CachingOtpBackend(backend, ttl=10, reactor=self.clock)
+
+        self.successResultOf(cache.verify_async('user', 'password', '123456'))
+        self.clock.advance(10)
+        self.successResultOf(cache.verify_async('user', 'password', '123456'))
+
+        self.assertEqual(2, backend.verify_async.call_count)
+
+    def test_ttl_capped_to_validity_window(self):
+        cache = CachingOtpBackend(mock_backend(), ttl=60, validity_window=30, reactor=self.clock)
+        self.assertEqual(30, cache.ttl)
+
+    def test_least_recently_used_evicted(self):
+        backend = mock_backend()
+        cache = CachingOtpBackend(backend, ttl=10, max_size=2, reactor=self.clock)
+
+        self.successResultOf(cache.verify_async('first', 'password', '123456'))
+        self.successResultOf(cache.verify_async('second', 'password', '123456'))
+        self.successResultOf(cache.verify_async('first', 'password', '123456'))
+        self.successResultOf(cache.verify_async('third', 'password', '123456'))
+
+        self.assertEqual(2, len(cache.entries))
+        self.assertIn(cache.key('first', 'password', '123456'), cache.entries)
+        self.assertNotIn(cache.key('second', 'password', '123456'), cache.entries)
+
+    def test_raw_secrets_not_kept(self):
+        cache = CachingOtpBackend(mock_backend(), ttl=10, reactor=self.clock)
+        self.successResultOf(cache.verify_async('user', 'password', '123456'))
+
+        [key] = cache.entries
+        self.assertNotIn(b'password', key)
+        self.assertNotEqual(key, CachingOtpBackend(mock_backend()).key('user', 'password', '123456'))
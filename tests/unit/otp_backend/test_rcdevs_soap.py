@@ -0,0 +1,289 @@
+import string
+import random
+import unittest
+from unittest.mock import MagicMock, patch, PropertyMock
+
+from twisted.internet import defer
+from twisted.trial import unittest as trial_unittest
+
+from ldap_otp_gateway import metrics
+
+from ldap_otp_gateway.otp_backend.rcdevs_soap import OtpBackend, check_response, SimpleLoginResponseParser, \
+    InvalidResponse
+
+from tests.unit.otp_backend.fake_soap_server import FakeSoapSite, listen
+
+
+SUCCESS_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ns1="urn:openotp">
+<SOAP-ENV:Body>
+<ns1:openotpSimpleLoginResponse>
+    <code>1</code>
+    <error/>
+    <message>Authentication success</message>
+    <data/>
+    <concat>8</concat>
+</ns1:openotpSimpleLoginResponse>
+</SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+"""
+
+
+class TestOtpBackend(unittest.TestCase):
+    @patch('requests.post')
+    def test_check_response(self, post_patch):
+        username = ''.join(random.sample(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=random.randint(6,12)))
+        password = ''.join(random.sample(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=random.randint(6,12)))
+        otp = ''.join(random.sample(string.ascii_uppercase + string.ascii_lowercase + string.digits, k=6))
+        post_return_mock = MagicMock()
+        response_text_mock = PropertyMock(return_value=SUCCESS_RESPONSE)
+        type(post_return_mock).text = response_text_mock
+        post_patch.return_value = post_return_mock
+        t = OtpBackend()
+        v, error = t.verify(username, password, otp)
+        self.assertTrue(v)
+        self.assertIsNone(error)
+        self.assertEqual(1, post_patch.call_count)
+        self.assertEqual(post_patch.call_args.args, ('http://localhost:8080/openotp/',))
+        self.assertIn('data', post_patch.call_args.kwargs)
+        self.assertEqual(post_patch.call_args.kwargs['data'], f'<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:xsi="http://www.w3.org/1999/XMLSchema-instance" xmlns:xsd="http://www.w3.org/1999/XMLSchema" SOAP-ENV:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><SOAP-ENV:Header/><SOAP-ENV:Body><m:openotpSimpleLogin xmlns:m="urn:openotp"><m:username xsi:type="xsd:string">{username}</m:username><m:domain xsi:type="xsd:string"/><m:anyPassword xsi:type="xsd:string">{password}{otp}</m:anyPassword><m:client xsi:type="xsd:string">ldapsearch</m:client><m:source xsi:type="xsd:string"/><m:settings xsi:type="xsd:string">ChallengeMode=No</m:settings><m:options xsi:type="xsd:string">NOVOICE,-U2F,LDAPDN</m:options><m:context xsi:type="xsd:string"/><m:retryId xsi:type="xsd:string"/></m:openotpSimpleLogin></SOAP-ENV:Body></SOAP-ENV:Envelope>')
+        self.assertEqual(1, response_text_mock.call_count)
+
+
+class TestCheckResponse(unittest.TestCase):
+
+    def test_success(self):
+        check_response(SUCCESS_RESPONSE)
+
+    def test_wrong_code(self):
+        with self.assertRaises(Exception) as e:
+            check_response("""<?xml version="1.0" encoding="UTF-8"?>
+                    <SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ns1="urn:openotp">
+                    <SOAP-ENV:Body>
+                    <ns1:openotpSimpleLoginResponse>
+                        <code>0</code>
+                        <error/>
+                        <message>Authentication success</message>
+                        <data/>
+                        <concat>8</concat>
+                    </ns1:openotpSimpleLoginResponse>
+                    </SOAP-ENV:Body>
+                    </SOAP-ENV:Envelope>
+                    """)
+        self.assertTrue(str(e.exception).startswith("Expected response code to be \"1\" but got 0 instead"))
+
+    def test_other_prefixes(self):
+        check_response(SUCCESS_RESPONSE.replace('SOAP-ENV:', 'soap:').replace('xmlns:SOAP-ENV', 'xmlns:soap')
+                       .replace('ns1:', 'otp:').replace('xmlns:ns1', 'xmlns:otp'))
+
+    def test_wrong_envelope_namespace(self):
+        with self.assertRaises(InvalidResponse) as e:
+            check_response(SUCCESS_RESPONSE.replace('http://schemas.xmlsoap.org/soap/envelope/', 'urn:other'))
+        self.assertTrue(str(e.exception).startswith('Expected root child node name to be'))
+
+    def test_header_in_envelope(self):
+        with self.assertRaises(InvalidResponse) as e:
+            check_response(SUCCESS_RESPONSE.replace('<SOAP-ENV:Body>', '<SOAP-ENV:Header/><SOAP-ENV:Body>'))
+        self.assertTrue(str(e.exception).startswith('Expected envelope child node name to be'))
+
+    def test_missing_field(self):
+        with self.assertRaises(InvalidResponse) as e:
+            check_response(SUCCESS_RESPONSE.replace('<concat>8</concat>', ''))
+        self.assertTrue(str(e.exception).startswith('Expected response size to be 5 but got 4 instead'))
+
+    def test_malformed(self):
+        with self.assertRaises(InvalidResponse) as e:
+            check_response(SUCCESS_RESPONSE[:-40])
+        self.assertTrue(str(e.exception).startswith('Malformed XML'))
+
+
+class TestSimpleLoginResponseParser(unittest.TestCase):
+
+    def test_byte_by_byte(self):
+        parser = SimpleLoginResponseParser()
+        for i in range(len(SUCCESS_RESPONSE)):
+            parser.feed(SUCCESS_RESPONSE[i:i + 1].encode())
+        self.assertEqual(parser.close(), {
+            'code': '1',
+            'error': '',
+            'message': 'Authentication success',
+            'data': '',
+            'concat': '8',
+        })
+
+    def test_fails_early(self):
+        parser = SimpleLoginResponseParser()
+        with self.assertRaises(InvalidResponse):
+            parser.feed(b'<html><body>')
+
+
+class TestOtpBackendTwistedTransport(trial_unittest.TestCase):
+
+    def start_server(self, **kwargs):
+        site = FakeSoapSite(**kwargs)
+        port, uri = listen(site)
+        self.addCleanup(port.stopListening)
+        self.addCleanup(site.cancel_delayed)
+        backend = OtpBackend(uri=uri, transport='twisted')
+        self.addCleanup(backend.close)
+        return site, backend
+
+    @defer.inlineCallbacks
+    def test_verify_async_success(self):
+        site, backend = self.start_server(otp='123456')
+        result = yield backend.verify_async('user', 'password', '123456')
+        self.assertEqual(result, (True, None))
+
+    @defer.inlineCallbacks
+    def test_verify_async_failure(self):
+        site, backend = self.start_server(otp='123456')
+        access, error = yield backend.verify_async('user', 'password', '654321')
+        self.assertFalse(access)
+        self.assertTrue(error.startswith('RCDevs OTP Backend replied: Expected response code to be "1" but got 0'))
+
+    @defer.inlineCallbacks
+    def test_verify_async_reuses_connection(self):
+        site, backend = self.start_server(otp='123456')
+        for _ in range(5):
+            result = yield backend.verify_async('user', 'password', '123456')
+            self.assertEqual(result, (True, None))
+        self.assertEqual(site.requests, 5)
+        self.assertEqual(site.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_verify_async_concurrent_connections(self):
+        site, backend = self.start_server(otp='123456', latency=0.05)
+        results = yield defer.gatherResults([
+            backend.verify_async('user', 'password', '123456') for _ in range(3)])
+        self.assertEqual(results, [(True, None)] * 3)
+        self.assertEqual(site.connections, 3)
+        # the connections are now cached in the pool and reused
+        yield backend.verify_async('user', 'password', '123456')
+        self.assertEqual(site.connections, 3)
+
+    @defer.inlineCallbacks
+    def test_verify_async_invalid_response(self):
+        site, backend = self.start_server(otp='123456')
+        site.resource.render_POST = lambda request: b'<html>Service Unavailable</html>'
+        access, error = yield backend.verify_async('user', 'password', '123456')
+        self.assertFalse(access)
+        self.assertTrue(error.startswith('RCDevs OTP Backend replied: Expected root child node name'))
+        # the body has been fully consumed, and the connection is reused
+        yield backend.verify_async('user', 'password', '123456')
+        self.assertEqual(site.connections, 1)
+
+    def test_verify_async_read_timeout(self):
+        site, backend = self.start_server(otp='123456', latency=5)
+        backend.read_timeout = 0.1
+        return self.assertFailure(backend.verify_async('user', 'password', '123456'), defer.TimeoutError)
+
+    def test_requests_transport_skips_agent(self):
+        backend = OtpBackend(uri='http://localhost:8080/openotp/', transport='requests')
+        self.assertIsNone(backend.agent)
+        self.assertIsNone(backend.pool)
+
+    def test_unknown_transport(self):
+        with self.assertRaises(ValueError):
+            OtpBackend(transport='curl')
+
+
+class TestOtpBackendEndpoints(trial_unittest.TestCase):
+
+    def start_servers(self, *sites, **kwargs):
+        uris = []
+        for site in sites:
+            port, uri = listen(site)
+            self.addCleanup(port.stopListening)
+            self.addCleanup(site.cancel_delayed)
+            uris.append(uri)
+        backend = OtpBackend(uris=uris, transport='twisted', **kwargs)
+        self.addCleanup(backend.close)
+        return backend
+
+    @defer.inlineCallbacks
+    def test_balanced(self):
+        sites = [FakeSoapSite(otp='123456', latency=0.02) for _ in range(2)]
+        backend = self.start_servers(*sites)
+        results = yield defer.gatherResults([
+            backend.verify_async('user', 'password', '123456') for _ in range(4)])
+        self.assertEqual(results, [(True, None)] * 4)
+        self.assertEqual([2, 2], [site.requests for site in sites])
+        self.assertEqual([0, 0], [endpoint.outstanding for endpoint in backend.balancer.endpoints])
+
+    @defer.inlineCallbacks
+    def test_failing_endpoint_ejected(self):
+        site = FakeSoapSite(otp='123456')
+        port, uri = listen(site)
+        self.addCleanup(port.stopListening)
+        # nothing listens on the port of the first endpoint
+        backend = OtpBackend(uris=['http://127.0.0.1:1/openotp/', uri], transport='twisted')
+        self.addCleanup(backend.close)
+        dead = backend.balancer.endpoints[0]
+        ejections = metrics.OTP_ENDPOINT_EJECTIONS.labels(dead.uri).get()
+
+        failures = 0
+        for _ in range(10):
+            try:
+                yield backend.verify_async('user', 'password', '123456')
+            except Exception:
+                failures += 1
+        self.assertEqual(backend.balancer.ejection_failures, failures)
+        self.assertEqual(10 - failures, site.requests)
+        self.assertEqual(ejections + 1, metrics.OTP_ENDPOINT_EJECTIONS.labels(dead.uri).get())
+
+    def test_hedge_requires_several_endpoints(self):
+        backend = OtpBackend(uri='http://localhost:8080/openotp/', transport='twisted', hedge=True)
+        self.addCleanup(backend.close)
+        self.assertFalse(backend.hedge)
+
+    @defer.inlineCallbacks
+    def test_hedged_request_wins(self):
+        slow, fast = FakeSoapSite(otp='123456', latency=5), FakeSoapSite(otp='123456')
+        backend = self.start_servers(slow, fast, hedge=True)
+        backend.latencies.value = 0.05
+        won = metrics.OTP_HEDGED_REQUESTS.labels('won').get()
+
+        result = yield backend.verify_async('user', 'password', '123456')
+        self.assertEqual(result, (True, None))
+        self.assertEqual((1, 1), (slow.requests, fast.requests))
+        self.assertEqual(won + 1, metrics.OTP_HEDGED_REQUESTS.labels('won').get())
+        # the slow request has been abandoned
+        self.assertEqual([0, 0], [endpoint.outstanding for endpoint in backend.balancer.endpoints])
+
+    @defer.inlineCallbacks
+    def test_hedged_rejection_held(self):
+        # the fast server rejects the OTP the slow one accepts, as it would when rejecting a replay
+        slow, fast = FakeSoapSite(otp='123456', latency=0.2), FakeSoapSite(otp='000000')
+        backend = self.start_servers(slow, fast, hedge=True)
+        backend.latencies.value = 0.05
+
+        result = yield backend.verify_async('user', 'password', '123456')
+        self.assertEqual(result, (True, None))
+        self.assertEqual((1, 1), (slow.requests, fast.requests))
+
+    @defer.inlineCallbacks
+    def test_hedged_rejection(self):
+        slow, fast = FakeSoapSite(otp='000000', latency=0.2), FakeSoapSite(otp='000000')
+        backend = self.start_servers(slow, fast, hedge=True)
+        backend.latencies.value = 0.05
+        won = metrics.OTP_HEDGED_REQUESTS.labels('won').get()
+
+        access, error = yield backend.verify_async('user', 'password', '123456')
+        self.assertFalse(access)
+        self.assertEqual((1, 1), (slow.requests, fast.requests))
+        # the hedge replied first, but with a rejection
+        self.assertEqual(won, metrics.OTP_HEDGED_REQUESTS.labels('won').get())
+
+    @defer.inlineCallbacks
+    def test_fast_reply_not_hedged(self):
+        first, second = FakeSoapSite(otp='000000'), FakeSoapSite(otp='000000')
+        backend = self.start_servers(first, second, hedge=True)
+        backend.latencies.value = 1
+
+        access, error = yield backend.verify_async('user', 'password', '123456')
+        self.assertFalse(access)
+        self.assertEqual(1, first.requests + second.requests)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ldap_otp_gateway import metrics
+from ldap_otp_gateway.otp_backend.base_otp_backend import OtpBackendUnavailable
+from ldap_otp_gateway.otp_backend.resilience import CLOSED, HALF_OPEN, OPEN, LatencyTracker, ResilientOtpBackend
+from tests.unit.otp_backend.test_single_flight import PendingOtpBackend
+
+
+class TestLatencyTracker(unittest.TestCase):
+
+    def test_percentile(self):
+        tracker = LatencyTracker(size=100, percentile=90, min_samples=10, refresh=10)
+        for i in range(9):
+            tracker.add(i / 100)
+        self.assertIsNone(tracker.value)
+
+        for i in range(9, 100):
+            tracker.add(i / 100)
+        self.assertEqual(0.9, tracker.value)
+
+
+class TestResilientOtpBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.backend = PendingOtpBackend()
+        self.resilient = ResilientOtpBackend(self.backend, min_timeout=0.1, max_timeout=5, max_concurrency=2,
+                                             queue_size=1, queue_timeout=1, failure_threshold=2, reset_timeout=10,
+                                             reactor=self.clock)
+
+    def verify(self):
+        return self.resilient.verify_async('user', 'password', '123456')
+
+    def test_success(self):
+        d = self.verify()
+        self.clock.advance(0.5)
+        self.backend.calls[0][1].callback((True, None))
+
+        self.assertEqual((True, None), self.successResultOf(d))
+        self.assertEqual(0, self.resilient.in_flight)
+        self.assertEqual([0.5], list(self.resilient.latencies.samples))
+
+    def test_deadline(self):
+        d = self.verify()
+        self.clock.advance(5)
+
+        self.failureResultOf(d, OtpBackendUnavailable)
+        self.assertEqual(1, self.resilient.failures)
+        # the backend call goes on, e.g. in a thread, and keeps its slot until it really finishes
+        self.assertEqual(1, self.resilient.in_flight)
+        self.backend.calls[0][1].callback((True, None))
+        self.assertEqual(0, self.resilient.in_flight)
+        self.assertEqual(1, self.resilient.failures)
+
+    def test_deadline_cancels_cancellable_backend(self):
+        self.backend.cancellable = True
+        d = self.verify()
+        self.clock.advance(5)
+
+        self.failureResultOf(d, OtpBackendUnavailable)
+        # the backend call has been cancelled, releasing its slot right away
+        self.assertTrue(self.backend.calls[0][1].called)
+        self.assertEqual(0, self.resilient.in_flight)
+
+    def test_late_backend_call_holds_its_slot(self):
+        self.resilient.failure_threshold = 10
+        first, second = self.verify(), self.verify()
+        self.clock.advance(5)
+        self.failureResultOf(first, OtpBackendUnavailable)
+        self.failureResultOf(second, OtpBackendUnavailable)
+        queued = self.verify()
+
+        # the queued verification only runs once a call past its deadline finishes
+        self.assertEqual(2, len(self.backend.calls))
+        self.backend.calls[0][1].errback(Exception('boom'))
+        self.assertEqual(3, len(self.backend.calls))
+        self.backend.calls[2][1].callback((True, None))
+        self.assertEqual((True, None), self.successResultOf(queued))
+
+    def test_adaptive_deadline(self):
+        self.assertEqual(5, self.resilient.deadline())
+        for _ in range(20):
+            d = self.verify()
+            self.clock.advance(0.2)
+            self.backend.calls[-1][1].callback((True, None))
+            self.successResultOf(d)
+
+        self.assertAlmostEqual(0.6, self.resilient.deadline())
+        self.assertAlmostEqual(0.6, metrics.OTP_BACKEND_DEADLINE.get())
+
+    def test_concurrency_limit(self):
+        first, second, queued = self.verify(), self.verify(), self.verify()
+        self.assertEqual(2, len(self.backend.calls))
+        self.assertEqual(1, metrics.OTP_BACKEND_QUEUED.get())
+
+        self.failureResultOf(self.verify(), OtpBackendUnavailable)
+
+        self.backend.calls[0][1].callback((True, None))
+        self.assertEqual(3, len(self.backend.calls))
+        self.assertEqual(2, self.resilient.in_flight)
+        self.backend.calls[2][1].callback((False, 'Invalid OTP'))
+        self.assertEqual((False, 'Invalid OTP'), self.successResultOf(queued))
+
+    def test_queue_timeout(self):
+        self.verify(), self.verify()
+        queued = self.verify()
+        self.clock.advance(1)
+
+        self.failureResultOf(queued, OtpBackendUnavailable)
+        self.assertEqual(0, len(self.resilient.queue))
+        self.assertEqual(2, len(self.backend.calls))
+
+    def test_circuit_breaker(self):
+        for _ in range(2):
+            d = self.verify()
+            self.backend.calls[-1][1].errback(Exception('boom'))
+            self.failureResultOf(d, Exception)
+        self.assertEqual(OPEN, self.resilient.state)
+        self.assertEqual(1, metrics.OTP_CIRCUIT_STATE.labels(OPEN).get())
+
+        # fails fast while open
+        self.failureResultOf(self.verify(), OtpBackendUnavailable)
+        self.assertEqual(2, len(self.backend.calls))
+
+        # a single trial call once the reset timeout elapsed
+        self.clock.advance(10)
+        trial = self.verify()
+        self.assertEqual(HALF_OPEN, self.resilient.state)
+        self.failureResultOf(self.verify(), OtpBackendUnavailable)
+        self.assertEqual(3, len(self.backend.calls))
+
+        self.backend.calls[-1][1].callback((True, None))
+        self.successResultOf(trial)
+        self.assertEqual(CLOSED, self.resilient.state)
+        self.assertEqual(0, metrics.OTP_CIRCUIT_STATE.labels(OPEN).get())
+
+    def test_failed_trial_opens_again(self):
+        self.resilient.state, self.resilient.opened_at = OPEN, 0
+        self.clock.advance(10)
+        trial = self.verify()
+        self.clock.advance(5)
+
+        self.failureResultOf(trial, OtpBackendUnavailable)
+        self.assertEqual(OPEN, self.resilient.state)
+        self.assertFalse(self.resilient.trial_pending)
+
+    def test_failed_verifications_are_not_errors(self):
+        for _ in range(3):
+            d = self.verify()
+            self.backend.calls[-1][1].callback((False, 'Invalid OTP'))
+            self.successResultOf(d)
+
+        self.assertEqual(CLOSED, self.resilient.state)
@@ -0,0 +1,71 @@
+from unittest.mock import MagicMock
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from ldap_otp_gateway.otp_backend.base_otp_backend import BaseOtpBackend
+from ldap_otp_gateway.otp_backend.single_flight import SingleFlightOtpBackend
+
+
+class PendingOtpBackend(BaseOtpBackend):
+    """
+    Backend whose verifications stay pending until fired by the test.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def verify_async(self, username, password, otp) -> defer.Deferred:
+        d = defer.Deferred()
+        self.calls.append(((username, password, otp), d))
+        return d
+
+
+class TestSingleFlightOtpBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = PendingOtpBackend()
+        self.single_flight = SingleFlightOtpBackend(self.backend)
+
+    def test_concurrent_identical_verifications_coalesced(self):
+        results = [self.single_flight.verify_async('user', 'password', '123456') for _ in range(3)]
+
+        self.assertEqual(1, len(self.backend.calls))
+        self.assertEqual(2, self.single_flight.coalesced)
+        self.backend.calls[0][1].callback((True, None))
+
+        for d in results:
+            self.assertEqual((True, None), self.successResultOf(d))
+        self.assertEqual({}, self.single_flight.pending)
+
+    def test_different_credentials_not_coalesced(self):
+        self.single_flight.verify_async('user', 'password', '123456')
+        self.single_flight.verify_async('user', 'password', '654321')
+        self.single_flight.verify_async('other', 'password', '123456')
+
+        self.assertEqual(3, len(self.backend.calls))
+
+    def test_sequential_verifications_not_coalesced(self):
+        self.single_flight.verify_async('user', 'password', '123456')
+        self.backend.calls[0][1].callback((False, 'Wrong OTP'))
+        d = self.single_flight.verify_async('user', 'password', '123456')
+
+        self.assertEqual(2, len(self.backend.calls))
+        self.assertNoResult(d)
+
+    def test_failure_shared(self):
+        results = [self.single_flight.verify_async('user', 'password', '123456') for _ in range(2)]
+        self.backend.calls[0][1].errback(RuntimeError('OTP server down'))
+
+        for d in results:
+            self.failureResultOf(d, RuntimeError)
+        self.assertEqual({}, self.single_flight.pending)
+
+    def test_synchronous_backend(self):
+        backend = MagicMock(spec=BaseOtpBackend)
+        backend.verify_async.side_effect = lambda *args: defer.succeed((True, None))
+        single_flight = SingleFlightOtpBackend(backend)
+
+        self.assertEqual((True, None), self.successResultOf(single_flight.verify_async('user', 'password', '123456')))
+        self.assertEqual((True, None), self.successResultOf(single_flight.verify_async('user', 'password', '123456')))
+        self.assertEqual(2, backend.verify_async.call_count)
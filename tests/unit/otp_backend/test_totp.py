@@ -0,0 +1,162 @@
+import unittest
+
+import pyotp
+
+from ldap_otp_gateway.otp_backend.secret_store.static import SecretStore
+from ldap_otp_gateway.otp_backend.totp import OtpBackend, ReplayGuard
+
+SECRET = 'JBSWY3DPEHPK3PXP'
+USER = 'cn=user,dc=example,dc=com'
+
+
+class Clock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class PersistentSecretStore(SecretStore):
+    """
+    Static secrets, with the claimed steps and counters kept in memory as a persistent store would.
+    """
+    persistent = True
+
+    def __init__(self, secrets):
+        super().__init__(secrets)
+        self.last_used = {}
+
+    def claim(self, username, select):
+        selected = select(self.last_used.get(username))
+        if selected is not None:
+            self.last_used[username] = selected
+        return selected
+
+
+class TestTotpBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.backend = OtpBackend(SecretStore({USER: SECRET}), mode='totp', digits=6, period=30, digest='sha1',
+                                  drift=1, replay_cache_size=100, clock=self.clock)
+        self.totp = pyotp.TOTP(SECRET)
+
+    def test_current_code(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now)))
+
+    def test_user_dn_case_insensitive(self):
+        self.assertEqual((True, None), self.backend.verify(USER.upper(), 'password', self.totp.at(self.clock.now)))
+
+    def test_drift(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now - 30)))
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now + 30)))
+
+    def test_beyond_drift(self):
+        access, error = self.backend.verify(USER, 'password', self.totp.at(self.clock.now - 60))
+        self.assertFalse(access)
+        self.assertEqual('Invalid OTP', error)
+
+    def test_replay_rejected(self):
+        otp = self.totp.at(self.clock.now)
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', otp))
+        self.assertEqual((False, 'OTP already used'), self.backend.verify(USER, 'password', otp))
+
+    def test_older_step_rejected_after_newer_one(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now)))
+        access, error = self.backend.verify(USER, 'password', self.totp.at(self.clock.now - 30))
+        self.assertFalse(access)
+
+    def test_next_step_accepted(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now)))
+        self.clock.now += 30
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now)))
+
+    def test_unknown_user(self):
+        access, error = self.backend.verify('cn=other', 'password', self.totp.at(self.clock.now))
+        self.assertFalse(access)
+
+    def test_wrong_format(self):
+        self.assertFalse(self.backend.verify(USER, 'password', '12345')[0])
+        self.assertFalse(self.backend.verify(USER, 'password', 'abcdef')[0])
+
+    def test_verify_async(self):
+        d = self.backend.verify_async(USER, 'password', self.totp.at(self.clock.now))
+        self.assertEqual((True, None), d.result)
+
+    def test_digits_and_digest(self):
+        backend = OtpBackend(SecretStore({USER: SECRET}), mode='totp', digits=8, period=60, digest='sha256',
+                             clock=self.clock)
+        totp = pyotp.TOTP(SECRET, digits=8, digest='sha256', interval=60)
+        self.assertEqual((True, None), backend.verify(USER, 'password', totp.at(self.clock.now)))
+
+    def test_replay_rejected_after_reload(self):
+        otp = self.totp.at(self.clock.now)
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', otp))
+
+        reloaded = OtpBackend(SecretStore({USER: SECRET}), mode='totp', period=30, clock=self.clock)
+        reloaded.take_over(self.backend)
+        self.assertEqual((False, 'OTP already used'), reloaded.verify(USER, 'password', otp))
+
+    def test_other_period_not_taken_over(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.totp.at(self.clock.now)))
+
+        reloaded = OtpBackend(SecretStore({USER: SECRET}), mode='totp', period=60, clock=self.clock)
+        reloaded.take_over(self.backend)
+        self.assertEqual({}, dict(reloaded.replay_guard.last_steps))
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            OtpBackend(SecretStore({}), mode='sms')
+
+
+class TestHotpBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.store = PersistentSecretStore({USER: SECRET})
+        self.backend = OtpBackend(self.store, mode='hotp', digits=6, digest='sha1', drift=3)
+        self.hotp = pyotp.HOTP(SECRET)
+
+    def test_counter_advances(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.hotp.at(0)))
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.hotp.at(1)))
+
+    def test_replay_rejected(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.hotp.at(0)))
+        self.assertFalse(self.backend.verify(USER, 'password', self.hotp.at(0))[0])
+
+    def test_look_ahead(self):
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.hotp.at(3)))
+        self.assertFalse(self.backend.verify(USER, 'password', self.hotp.at(2))[0])
+        self.assertFalse(self.backend.verify(USER, 'password', self.hotp.at(8))[0])
+
+    def test_counter_shared_between_backends(self):
+        other = OtpBackend(self.store, mode='hotp', digits=6, digest='sha1', drift=3)
+        self.assertEqual((True, None), self.backend.verify(USER, 'password', self.hotp.at(0)))
+        self.assertFalse(other.verify(USER, 'password', self.hotp.at(0))[0])
+        self.assertEqual((True, None), other.verify(USER, 'password', self.hotp.at(1)))
+
+    def test_requires_persistent_store(self):
+        with self.assertRaises(ValueError):
+            OtpBackend(SecretStore({USER: SECRET}), mode='hotp')
+
+
+class TestReplayGuard(unittest.TestCase):
+
+    def test_bounded(self):
+        guard = ReplayGuard(max_size=2)
+        for user in ['a', 'b', 'c']:
+            guard.use(user, 10, 9)
+        self.assertEqual(['b', 'c'], list(guard.last_steps))
+
+    def test_take_over_bounded(self):
+        guard = ReplayGuard(max_size=2)
+        guard.use('a', 10, 9)
+        guard.take_over({'b': 10, 'c': 10})
+        self.assertEqual(['b', 'c'], list(guard.last_steps))
+
+    def test_forgets_expired_steps(self):
+        guard = ReplayGuard(max_size=10)
+        guard.use('a', 10, 9)
+        guard.use('b', 12, 11)
+        self.assertEqual(['b'], list(guard.last_steps))
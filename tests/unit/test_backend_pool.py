@@ -0,0 +1,174 @@
+from ldaptor.protocols import pureldap
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from ldap_otp_gateway.backend_pool import LDAPClientPool, PoolExhausted
+from ldap_otp_gateway.ldap_client import build_connector
+from tests.unit.fake_ldap_server import FakeLDAPServerFactory, listen, USER_DN, USER_PASSWORD
+
+
+def connection_lost(client) -> defer.Deferred:
+    d = defer.Deferred()
+    client.notify_connection_lost(d.callback)
+    return d
+
+
+class TestLDAPClientPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeLDAPServerFactory()
+        port, self.endpoint = listen(self.server)
+        self.addCleanup(port.stopListening)
+        self.clock = task.Clock()
+
+    def build_pool(self, **kwargs):
+        kwargs.setdefault('reactor', self.clock)
+        pool = LDAPClientPool(build_connector(reactor, self.endpoint), **kwargs)
+        self.addCleanup(self.close_pool, pool)
+        return pool
+
+    def close_pool(self, pool):
+        clients = [c for c in pool.connections if c.connected]
+        pool.stop()
+        for client in clients:
+            client.transport.loseConnection()
+        return defer.gatherResults([connection_lost(c) for c in clients])
+
+    @defer.inlineCallbacks
+    def test_reuse_released_connection(self):
+        pool = self.build_pool()
+        client = yield pool.acquire()
+        pool.release(client)
+        self.assertEqual(pool.size, 1)
+        again = yield pool.acquire()
+        self.assertIs(again, client)
+        self.assertEqual(self.server.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_anonymous_bind_policy(self):
+        pool = self.build_pool(bind_policy='anonymous')
+        client = yield pool.acquire()
+        yield client.simple_bind(USER_DN.encode(), USER_PASSWORD.encode())
+        # let the client forget about the bind request, once its response is dispatched
+        yield task.deferLater(reactor, 0, lambda: None)
+        yield pool.release(client, bound=True)
+        again = yield pool.acquire()
+        self.assertIs(again, client)
+        last = self.server.requests[-1]
+        self.assertIsInstance(last, pureldap.LDAPBindRequest)
+        self.assertEqual(last.dn, b'')
+
+    @defer.inlineCallbacks
+    def test_service_bind_policy(self):
+        pool = self.build_pool(bind_policy='service', bind_dn=USER_DN, bind_password=USER_PASSWORD)
+        client = yield pool.acquire()
+        yield pool.release(client, bound=True)
+        again = yield pool.acquire()
+        self.assertIs(again, client)
+        self.assertEqual(self.server.requests[-1].dn, USER_DN.encode())
+
+    @defer.inlineCallbacks
+    def test_service_bind_failure_closes_connection(self):
+        pool = self.build_pool(bind_policy='service', bind_dn=USER_DN, bind_password='wrong')
+        client = yield pool.acquire()
+        lost = connection_lost(client)
+        pool.release(client, bound=True)
+        yield lost
+        self.assertEqual(pool.size, 0)
+
+    @defer.inlineCallbacks
+    def test_close_bind_policy(self):
+        pool = self.build_pool(bind_policy='close')
+        client = yield pool.acquire()
+        lost = connection_lost(client)
+        pool.release(client, bound=True)
+        yield lost
+        self.assertEqual(pool.size, 0)
+        again = yield pool.acquire()
+        self.assertIsNot(again, client)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_invalid_bind_policy(self):
+        with self.assertRaises(ValueError):
+            self.build_pool(bind_policy='whatever')
+        with self.assertRaises(ValueError):
+            self.build_pool(bind_policy='service')
+
+    @defer.inlineCallbacks
+    def test_waiter_served_on_release(self):
+        pool = self.build_pool(max_size=1)
+        client = yield pool.acquire()
+        waiter = pool.acquire()
+        self.assertFalse(waiter.called)
+        pool.release(client)
+        again = yield waiter
+        self.assertIs(again, client)
+
+    @defer.inlineCallbacks
+    def test_waiter_served_on_connection_lost(self):
+        pool = self.build_pool(max_size=1)
+        client = yield pool.acquire()
+        waiter = pool.acquire()
+        client.transport.loseConnection()
+        again = yield waiter
+        self.assertIsNot(again, client)
+        self.assertEqual(pool.size, 1)
+
+    @defer.inlineCallbacks
+    def test_acquire_timeout(self):
+        pool = self.build_pool(max_size=1, acquire_timeout=5)
+        yield pool.acquire()
+        waiter = pool.acquire()
+        self.clock.advance(6)
+        yield self.assertFailure(waiter, PoolExhausted)
+        self.assertEqual(len(pool.waiters), 0)
+
+    @defer.inlineCallbacks
+    def test_idle_eviction(self):
+        pool = self.build_pool(idle_timeout=60)
+        client = yield pool.acquire()
+        pool.release(client)
+        lost = connection_lost(client)
+        self.clock.advance(61)
+        pool.sweep()
+        yield lost
+        self.assertEqual(pool.size, 0)
+
+    @defer.inlineCallbacks
+    def test_max_lifetime(self):
+        pool = self.build_pool(max_lifetime=600)
+        client = yield pool.acquire()
+        self.clock.advance(601)
+        lost = connection_lost(client)
+        pool.release(client)
+        yield lost
+        self.assertEqual(pool.size, 0)
+
+    @defer.inlineCallbacks
+    def test_health_check(self):
+        pool = self.build_pool(idle_timeout=60)
+        client = yield pool.acquire()
+        pool.release(client)
+        self.clock.advance(30)
+        pool.sweep()
+        self.assertEqual(len(pool.idle), 0)
+        yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual(len(pool.idle), 1)
+        search = self.server.requests[-1]
+        self.assertIsInstance(search, pureldap.LDAPSearchRequest)
+        self.assertEqual(search.baseObject, b'')
+        # the health check doesn't reset the idle timer
+        lost = connection_lost(client)
+        self.clock.advance(31)
+        pool.sweep()
+        yield lost
+
+    @defer.inlineCallbacks
+    def test_pending_requests_closes_connection(self):
+        pool = self.build_pool()
+        client = yield pool.acquire()
+        client.search_root_dse().addErrback(lambda _: None)
+        lost = connection_lost(client)
+        pool.release(client)
+        yield lost
+        self.assertEqual(pool.size, 0)
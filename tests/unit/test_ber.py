@@ -0,0 +1,72 @@
+import unittest
+
+from ldaptor.protocols import pureber, pureldap
+
+from ldap_otp_gateway import ber
+
+
+def decode(data):
+    message, length = pureber.berDecodeObject(pureldap.LDAPBERDecoderContext_TopLevel(
+        inherit=pureldap.LDAPBERDecoderContext_LDAPMessage(
+            fallback=pureldap.LDAPBERDecoderContext(fallback=pureber.BERDecoderContext()),
+            inherit=pureldap.LDAPBERDecoderContext(fallback=pureber.BERDecoderContext()))), data)
+    assert length == len(data)
+    return message
+
+
+def search_request(message_id, controls=None):
+    return pureldap.LDAPMessage(pureldap.LDAPSearchRequest(baseObject=b'dc=example,dc=com'), id=message_id,
+                                controls=controls).toWire()
+
+
+class TestPeekMessage(unittest.TestCase):
+
+    def test_envelope(self):
+        data = search_request(7)
+        message_id, tag, operation, end = ber.peek_message(data)
+
+        self.assertEqual(7, message_id)
+        self.assertEqual(ber.SEARCH_REQUEST_TAG, tag)
+        self.assertEqual(5, operation)
+        self.assertEqual(len(data), end)
+
+    def test_offset(self):
+        first, second = search_request(1), search_request(300)
+        message_id, _, _, end = ber.peek_message(first + second, len(first))
+
+        self.assertEqual(300, message_id)
+        self.assertEqual(len(first + second), end)
+
+    def test_long_length(self):
+        entry = pureldap.LDAPMessage(pureldap.LDAPSearchResultEntry(
+            objectName=b'cn=user', attributes=[(b'description', [b'x' * 70000])]), id=2).toWire()
+        message_id, tag, _, end = ber.peek_message(entry)
+
+        self.assertEqual((2, ber.SEARCH_RESULT_ENTRY_TAG, len(entry)), (message_id, tag, end))
+
+    def test_incomplete(self):
+        data = search_request(7)
+        for length in range(len(data)):
+            self.assertIsNone(ber.peek_message(data[:length]))
+
+    def test_not_a_message(self):
+        with self.assertRaises(ValueError):
+            ber.peek_message(b'\x04\x03abc')
+
+
+class TestWithMessageId(unittest.TestCase):
+
+    def test_rewrite(self):
+        controls = [(b'1.2.840.113556.1.4.319', True, b'\x30\x05\x02\x01\x0a\x04\x00')]
+        data = search_request(7, controls)
+        _, _, operation, end = ber.peek_message(data)
+
+        for message_id in (1, 127, 128, 70000, 2 ** 31 - 1):
+            message = decode(ber.with_message_id(data, operation, end, message_id))
+            self.assertEqual(message_id, message.id)
+            self.assertEqual(b'dc=example,dc=com', message.value.baseObject)
+            self.assertEqual(decode(data).controls, message.controls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+from ldap_otp_gateway import certs
+
+
+class TestCerts(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.key_path = os.path.join(directory.name, 'certs', 'server.key.pem')
+        self.cert_path = os.path.join(directory.name, 'certs', 'server.crt.pem')
+
+    def test_generate(self):
+        certs.generate(self.key_path, self.cert_path, common_name='gateway.example')
+        with open(self.key_path, 'rb') as f:
+            key = load_pem_private_key(f.read(), password=None)
+        with open(self.cert_path, 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+        self.assertIsInstance(key, ec.EllipticCurvePrivateKey)
+        self.assertEqual(key.public_key(), cert.public_key())
+        self.assertEqual('CN=gateway.example', cert.subject.rfc4514_string())
+        self.assertEqual(0o600, os.stat(self.key_path).st_mode & 0o777)
+
+    def test_ensure(self):
+        certs.ensure(self.key_path, self.cert_path)
+        self.assertTrue(certs.check(self.key_path, self.cert_path))
+        with open(self.cert_path, 'rb') as f:
+            cert = f.read()
+        # kept as is once generated
+        certs.ensure(self.key_path, self.cert_path)
+        with open(self.cert_path, 'rb') as f:
+            self.assertEqual(cert, f.read())
+
+    def test_only_one_file(self):
+        certs.generate(self.key_path, self.cert_path)
+        os.remove(self.cert_path)
+        with self.assertRaises(Exception):
+            certs.check(self.key_path, self.cert_path)
+        self.assertFalse(certs.check(self.key_path + '.missing', self.cert_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+from unittest.mock import MagicMock
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from ldap_otp_gateway.components import Components, ComponentsHolder, innermost_backend
+from ldap_otp_gateway.otp_backend.dummy_static import OtpBackend as DummyStaticOtp
+from ldap_otp_gateway.otp_extractor.suffix import OtpExtractor as SuffixOtpExtractor
+
+
+def components():
+    backend = DummyStaticOtp()
+    backend.start = MagicMock()
+    backend.take_over = MagicMock()
+    backend.close = MagicMock(return_value=defer.succeed(None))
+    return Components(backend, SuffixOtpExtractor())
+
+
+class TestComponents(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def test_wrong_types(self):
+        with self.assertRaises(AssertionError):
+            Components(object(), SuffixOtpExtractor())
+        with self.assertRaises(AssertionError):
+            Components(DummyStaticOtp(), None)
+
+    def test_idle_components_closed_when_retired(self):
+        retired = components()
+        d = retired.retire(10, self.clock)
+
+        self.assertTrue(d.called)
+        retired.otp_backend.close.assert_called_once()
+
+    def test_closed_after_last_bind(self):
+        retired = components()
+        retired.acquire()
+        retired.acquire()
+        d = retired.retire(10, self.clock)
+
+        retired.release()
+        self.assertFalse(d.called)
+        retired.release()
+        self.assertTrue(d.called)
+        retired.otp_backend.close.assert_called_once()
+
+    def test_closed_after_timeout(self):
+        retired = components()
+        retired.acquire()
+        d = retired.retire(10, self.clock)
+
+        self.clock.advance(10)
+        self.assertTrue(d.called)
+        retired.otp_backend.close.assert_called_once()
+        # the late bind doesn't fail
+        retired.release()
+
+    def test_close_failure_logged(self):
+        retired = components()
+        retired.otp_backend.close = MagicMock(side_effect=Exception('boom'))
+        d = retired.close()
+
+        self.assertTrue(d.called)
+        self.assertIsNone(self.successResultOf(d))
+
+
+class TestComponentsHolder(unittest.TestCase):
+
+    def test_swap(self):
+        clock = task.Clock()
+        previous, new = components(), components()
+        holder = ComponentsHolder(previous)
+        held = holder.current.acquire()
+
+        d = holder.swap(new, timeout=10, reactor=clock)
+
+        self.assertIs(new, holder.current)
+        new.otp_backend.take_over.assert_called_once_with(previous.otp_backend)
+        new.otp_backend.start.assert_called_once()
+        self.assertFalse(d.called)
+        held.release()
+        self.assertTrue(d.called)
+        previous.otp_backend.close.assert_called_once()
+        new.otp_backend.close.assert_not_called()
+
+    def test_innermost_backend(self):
+        from ldap_otp_gateway.otp_backend.cache import CachingOtpBackend
+        from ldap_otp_gateway.otp_backend.single_flight import SingleFlightOtpBackend
+
+        backend = DummyStaticOtp()
+        self.assertIs(backend, innermost_backend(CachingOtpBackend(SingleFlightOtpBackend(backend), ttl=10)))
+        self.assertIs(backend, innermost_backend(backend))
@@ -0,0 +1,78 @@
+import unittest
+
+from ldap_otp_gateway.config import Settings, parse_upstreams
+
+
+class TestSettings(unittest.TestCase):
+
+    def test_defaults(self):
+        settings = Settings({})
+        self.assertEqual(389, settings.LDAP_PORT)
+        self.assertEqual(10389, settings.LDAP_GATEWAY_PORT)
+        self.assertFalse(settings.LDAP_GATEWAY_RELAY_OPERATIONS)
+        self.assertFalse(settings.LDAP_GATEWAY_LAZY_BACKEND_CONNECTION)
+        self.assertEqual([('localhost', 389, 636, 1)], settings.LDAP_UPSTREAMS)
+        self.assertEqual('127.0.0.1', settings.METRICS_INTERFACE)
+        self.assertEqual(10, settings.OTP_BACKEND_THREAD_POOL_SIZE)
+
+    def test_relative_cert_paths(self):
+        settings = Settings({'LDAP_GATEWAY_SSL_KEY_PATH': './certs/key.pem', 'LDAP_GATEWAY_SSL_CERT_PATH': '/c.pem'})
+        self.assertTrue(settings.LDAP_GATEWAY_SSL_KEY_PATH.endswith('/certs/key.pem'))
+        self.assertNotIn('/./', settings.LDAP_GATEWAY_SSL_KEY_PATH)
+        self.assertEqual('/c.pem', settings.LDAP_GATEWAY_SSL_CERT_PATH)
+
+    def test_invalid_values(self):
+        for name, value in (('LDAP_GATEWAY_PORT', 'abc'), ('LDAP_PORT', '70000'), ('OTP_CACHE_TTL', 'soon'),
+                            ('OTP_SINGLE_FLIGHT', 'yes'), ('LDAP_HOSTS', 'ldap1:abc'),
+                            ('OTP_BACKEND_THREAD_POOL_SIZE', 'many')):
+            with self.subTest(name=name), self.assertRaises(ValueError) as raised:
+                Settings({name: value})
+            self.assertIn(name, str(raised.exception))
+
+    def test_plugins_loaded_on_first_use(self):
+        settings = Settings({'OTP_BACKEND_MODULE_NAME': 'ldap_otp_gateway.otp_backend.missing'})
+        self.assertIsNone(settings.GATEWAY_FILTER)
+        self.assertIs(settings.OTP_EXTRACTOR, settings.OTP_EXTRACTOR)
+        with self.assertRaises(ModuleNotFoundError):
+            settings.OTP_BACKEND
+
+    def test_otp_backend_wrappers(self):
+        from ldap_otp_gateway.otp_backend.cache import CachingOtpBackend
+        from ldap_otp_gateway.otp_backend.single_flight import SingleFlightOtpBackend
+
+        backend = Settings({'OTP_CACHE_TTL': '10'}).OTP_BACKEND
+        self.assertIsInstance(backend, CachingOtpBackend)
+        self.assertIsInstance(backend.backend, SingleFlightOtpBackend)
+
+    def test_changes(self):
+        settings = Settings({})
+        self.assertEqual([], settings.changes(Settings({})))
+        self.assertEqual(['LDAP_PORT', 'LDAP_UPSTREAMS', 'OTP_CACHE_TTL'],
+                         settings.changes(Settings({'LDAP_PORT': '1389', 'OTP_CACHE_TTL': '10'})))
+
+    def test_plugins_reloaded(self):
+        from ldap_otp_gateway.otp_extractor.suffix import OtpExtractor
+
+        extractor = Settings({}, reload_plugins=True).OTP_EXTRACTOR
+        # a new execution of the module, defining a new class
+        self.assertIsNot(OtpExtractor, extractor.__class__)
+
+
+class TestParseUpstreams(unittest.TestCase):
+
+    def test_ports(self):
+        self.assertEqual([('ldap1', 389, 636, 1), ('ldap2', 1389, 636, 1), ('ldap3', 1389, 1636, 1)],
+                         parse_upstreams('ldap1, ldap2:1389,ldap3:1389:1636', '', 389, 636))
+
+    def test_weights(self):
+        self.assertEqual([('ldap1', 389, 636, 3), ('ldap2', 389, 636, 1)],
+                         parse_upstreams('ldap1,ldap2', '3,1', 389, 636))
+
+    def test_invalid(self):
+        for hosts, weights in (('ldap1,,ldap2', ''), ('ldap1:1:2:3', ''), ('ldap1,ldap2', '1'), ('ldap1', 'x')):
+            with self.subTest(hosts=hosts, weights=weights), self.assertRaises(ValueError):
+                parse_upstreams(hosts, weights, 389, 636)
+
+
+if __name__ == '__main__':
+    unittest.main()
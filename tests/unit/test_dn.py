@@ -0,0 +1,28 @@
+import unittest
+
+from ldap_otp_gateway.dn import normalize_dn, split_dn
+
+
+class TestDn(unittest.TestCase):
+
+    def test_case_and_spaces_insensitive(self):
+        self.assertEqual('cn=john smith,ou=people,dc=example,dc=com',
+                         normalize_dn(' CN = John   Smith , OU=People,dc=Example, DC=com '))
+
+    def test_split(self):
+        self.assertEqual(('cn=user', 'dc=example', 'dc=com'), split_dn('cn=user,dc=example,dc=com'))
+
+    def test_empty(self):
+        self.assertEqual((), split_dn(''))
+        self.assertEqual('', normalize_dn('  '))
+
+    def test_escaped_separators(self):
+        self.assertEqual(('cn=smith\\, john', 'dc=com'), split_dn('cn=Smith\\, John,dc=com'))
+        self.assertEqual(('cn=a\\+b', 'dc=com'), split_dn('cn=a\\+b,dc=com'))
+
+    def test_multi_valued_rdn_order_insignificant(self):
+        self.assertEqual(normalize_dn('uid=john+cn=John,dc=com'), normalize_dn('cn=john + uid=john,dc=com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import logging
+import os
+import unittest
+from unittest.mock import patch
+
+from ldaptor.protocols import pureber, pureldap
+
+from ldap_otp_gateway import logs
+from ldap_otp_gateway.logs import Loggable, redact, truncate
+from ldap_otp_gateway.otp_backend.rcdevs_soap import OtpBackend as RcdevsOtpBackend
+
+
+class CountingRepr:
+    def __init__(self):
+        self.calls = 0
+
+    def __repr__(self):
+        self.calls += 1
+        return 'CountingRepr()'
+
+
+class TestRedact(unittest.TestCase):
+
+    def test_bind_request(self):
+        text = redact(pureldap.LDAPBindRequest(dn=b'cn=user', auth=b'password123456'))
+        self.assertEqual("LDAPBindRequest(version=3, dn=b'cn=user', auth=****, sasl=False)", text)
+
+    def test_add_request_password(self):
+        request = pureldap.LDAPAddRequest(entry=b'cn=user', attributes=[
+            (pureldap.LDAPAttributeDescription(b'cn'), pureber.BERSet([pureldap.LDAPAttributeValue(b'user')])),
+            (pureldap.LDAPAttributeDescription(b'userPassword'),
+             pureber.BERSet([pureldap.LDAPAttributeValue(b'secret')])),
+        ])
+        text = redact(request)
+        self.assertNotIn('secret', text)
+        self.assertIn("b'user'", text)
+
+    def test_soap_password(self):
+        data = RcdevsOtpBackend(uri='http://localhost/', transport='requests').request_data('user', 'secret', '123456')
+        text = redact(data)
+        self.assertNotIn('secret', text)
+        self.assertNotIn('123456', text)
+        self.assertIn('<m:username xsi:type="xsd:string">user</m:username>', text)
+
+    def test_other_values(self):
+        self.assertEqual("b'value'", redact(b'value'))
+        self.assertEqual('text', redact('text'))
+
+
+class TestTruncate(unittest.TestCase):
+
+    def test_long(self):
+        self.assertEqual('abc... (3 more characters)', truncate('abcdef', 3))
+
+    def test_short(self):
+        self.assertEqual('abc', truncate('abc', 3))
+
+    def test_no_limit(self):
+        self.assertEqual('abcdef', truncate('abcdef', 0))
+
+
+class TestLoggable(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('tests.unit.test_logs')
+
+    def test_not_formatted_when_disabled(self):
+        value = CountingRepr()
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+        self.logger.debug('value => %s', Loggable(value))
+        self.assertEqual(0, value.calls)
+
+    def test_formatted_when_enabled(self):
+        with self.assertLogs(self.logger, logging.DEBUG) as captured:
+            self.logger.debug('request => %s', Loggable(pureldap.LDAPBindRequest(dn=b'cn=user', auth=b'secret')))
+        self.assertNotIn('secret', captured.output[0])
+        self.assertIn('auth=****', captured.output[0])
+
+    def test_rcdevs_request_not_leaking_password(self):
+        backend = RcdevsOtpBackend(uri='http://localhost/', transport='requests')
+        with self.assertLogs('ldap_otp_gateway.otp_backend.rcdevs_soap', logging.DEBUG) as captured:
+            backend.request_data('user', 'secret', '123456')
+        self.assertNotIn('secret', ''.join(captured.output))
+
+
+class TestConfigure(unittest.TestCase):
+
+    def setUp(self):
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+        self.addCleanup(logging.getLogger('ldap_otp_gateway.backend_pool').setLevel, logging.NOTSET)
+        self.addCleanup(setattr, logs, 'LOG_MAX_LENGTH', logs.LOG_MAX_LENGTH)
+
+    def test_levels(self):
+        logs.configure(level='warning', levels='ldap_otp_gateway.backend_pool=debug', max_length=10)
+
+        self.assertEqual(logging.WARNING, logging.getLogger().level)
+        self.assertEqual(logging.DEBUG, logging.getLogger('ldap_otp_gateway.backend_pool').level)
+        self.assertEqual(10, logs.LOG_MAX_LENGTH)
+
+    @patch.dict(os.environ, {'LOG_MAX_LENGTH': 'long'})
+    def test_invalid_max_length(self):
+        with self.assertRaises(ValueError) as raised:
+            logs.configure(level='info', levels='')
+        self.assertIn('LOG_MAX_LENGTH', str(raised.exception))
+
+    def test_invalid_levels(self):
+        with self.assertRaises(ValueError):
+            logs.configure(level='info', levels='ldap_otp_gateway.backend_pool')
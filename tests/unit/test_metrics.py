@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import MagicMock
+
+from ldap_otp_gateway.metrics import Counter, Gauge, Histogram, MetricsResource, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = Counter('requests_total', 'Requests', ['result'], registry=self.registry)
+        counter.labels('success').inc()
+        counter.labels('success').inc(2)
+        counter.labels('fail"ure').inc()
+
+        self.assertEqual(3, counter.labels('success').get())
+        self.assertEqual(b'# HELP requests_total Requests\n'
+                         b'# TYPE requests_total counter\n'
+                         b'requests_total{result="fail\\"ure"} 1\n'
+                         b'requests_total{result="success"} 3\n', self.registry.render())
+
+    def test_unlabelled_gauge(self):
+        gauge = Gauge('connections', 'Connections', registry=self.registry)
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertIn(b'\nconnections 1\n', self.registry.render())
+
+        gauge.set_function(lambda: 42)
+        self.assertIn(b'\nconnections 42\n', self.registry.render())
+
+    def test_histogram(self):
+        histogram = Histogram('duration_seconds', 'Duration', ['stage'], buckets=(0.1, 1), registry=self.registry)
+        child = histogram.labels('total')
+        for value in (0.05, 0.1, 0.5, 5):
+            child.observe(value)
+
+        lines = self.registry.render().decode().splitlines()
+        self.assertEqual(['duration_seconds_bucket{stage="total",le="0.1"} 2',
+                          'duration_seconds_bucket{stage="total",le="1"} 3',
+                          'duration_seconds_bucket{stage="total",le="+Inf"} 4',
+                          'duration_seconds_sum{stage="total"} 5.65',
+                          'duration_seconds_count{stage="total"} 4'], lines[2:])
+
+    def test_wrong_labels(self):
+        counter = Counter('requests_total', 'Requests', ['result'], registry=self.registry)
+        with self.assertRaises(ValueError):
+            counter.labels('success', 'extra')
+
+    def test_duplicate_name(self):
+        Counter('requests_total', 'Requests', registry=self.registry)
+        with self.assertRaises(ValueError):
+            Gauge('requests_total', 'Requests', registry=self.registry)
+
+    def test_resource(self):
+        Counter('requests_total', 'Requests', registry=self.registry).inc()
+        request = MagicMock()
+
+        body = MetricsResource(self.registry).render_GET(request)
+
+        self.assertIn(b'requests_total 1', body)
+        request.setHeader.assert_called_once_with(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+
+
+if __name__ == '__main__':
+    unittest.main()
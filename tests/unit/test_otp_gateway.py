@@ -1,18 +1,40 @@
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
 from ldaptor.protocols.ldap import ldaperrors
-from ldaptor.protocols.pureldap import LDAPBindRequest, LDAPBindResponse
+from ldaptor.protocols import pureber, pureldap
+from ldaptor.protocols.pureldap import LDAPBindRequest, LDAPBindResponse, LDAPUnbindRequest
+from twisted.internet import task
+from twisted.internet.testing import StringTransport
 from twisted.internet.defer import Deferred
 
-from ldap_otp_gateway import OtpGateway
-from ldap_otp_gateway.otp_backend.base_otp_backend import BaseOtpBackend
+from ldap_otp_gateway import OtpGateway, OtpGatewayFactory, metrics
+from ldap_otp_gateway.audit import FAIL_CLOSED, AuditLog
+from ldap_otp_gateway.components import Components
+from ldap_otp_gateway.ldap_client import GatewayLDAPClient
+from ldap_otp_gateway.otp_backend.base_otp_backend import BaseOtpBackend, OtpBackendUnavailable
 from ldap_otp_gateway.otp_backend.dummy_static import OtpBackend as DummyStaticOtp
 from ldap_otp_gateway.gateway_filter.base_gateway_filter import BaseGatewayFilter
 from ldap_otp_gateway.otp_extractor.base_otp_extractor import BaseOTPExtractor
 from ldap_otp_gateway.otp_extractor.suffix import OtpExtractor as SuffixOtpExtractor
+from ldap_otp_gateway.rate_limit import BindLimiter, KeyLimiter
+from ldap_otp_gateway.search_cache import SearchCache, parse_shapes
 
-from ldap_otp_gateway.otp_gateway import OTP_REQUEST_ATTR, GATEWAY_PASS_THROUGH_FORWARD_VALUE, GATEWAY_PASS_THROUGH_ATTR
+from ldap_otp_gateway.otp_gateway import GATEWAY_PASS_THROUGH_FORWARD_VALUE, GATEWAY_PASS_THROUGH_FILTER_VALUE, \
+    OTP_FIRST, PARALLEL, BindContext
+
+
+def filtered_bind_request(proxy, dn=b'cn=user', password=b'password', otp=b'123456'):
+    """
+    Bind request forwarded by `proxy` to the backend, as if handled by handleBeforeForwardRequest.
+    """
+    request = LDAPBindRequest(dn=dn, auth=password)
+    context = BindContext(time.perf_counter())
+    context.pass_through = GATEWAY_PASS_THROUGH_FILTER_VALUE
+    context.otp = otp
+    proxy.track(request, context)
+    return request
 
 
 class TestOtpGateway(unittest.TestCase):
@@ -69,7 +91,7 @@ class TestOtpGateway(unittest.TestCase):
         extractor.extract.assert_called_once_with(request)
         reply.assert_not_called()
         self.assertEqual(request.auth, password)
-        self.assertEqual(getattr(request, OTP_REQUEST_ATTR), otp)
+        self.assertEqual(proxy.tracked(request).otp, otp)
         self.assertIsInstance(r, Deferred)
         self.assertEqual(r.result, (request, controls))
 
@@ -95,10 +117,8 @@ class TestOtpGateway(unittest.TestCase):
 
         # Assert extractor called once
         otp_extractor.extract.assert_called_once_with(request)
-        # Assert no OTP set
-        self.assertEqual(hasattr(request, OTP_REQUEST_ATTR), False)
-        # Assert no pass through set
-        self.assertEqual(hasattr(request, GATEWAY_PASS_THROUGH_ATTR), False)
+        # Assert not forwarded
+        self.assertIsNone(proxy.tracked(request))
         # Assert password unchanged
         self.assertEqual(request.auth, password)
         # assert return is None
@@ -109,7 +129,6 @@ class TestOtpGateway(unittest.TestCase):
         self.assertIsInstance(reply_arg, LDAPBindResponse)
         self.assertEqual(reply_arg.resultCode, ldaperrors.LDAPInvalidCredentials.resultCode)
         self.assertEqual(request.auth, password)
-        self.assertEqual(hasattr(request, OTP_REQUEST_ATTR), False)
 
     @patch('ldap_otp_gateway.otp_backend.base_otp_backend.BaseOtpBackend')
     @patch('ldap_otp_gateway.otp_extractor.base_otp_extractor.BaseOTPExtractor')
@@ -134,15 +153,604 @@ class TestOtpGateway(unittest.TestCase):
         # Assert password unchanged
         self.assertEqual(request.auth, password)
         # Assert no OTP set
-        self.assertEqual(hasattr(request, OTP_REQUEST_ATTR), False)
+        self.assertIsNone(proxy.tracked(request).otp)
         # Assert pass through set to forward value
-        self.assertEqual(getattr(request, GATEWAY_PASS_THROUGH_ATTR), GATEWAY_PASS_THROUGH_FORWARD_VALUE)
+        self.assertEqual(proxy.tracked(request).pass_through, GATEWAY_PASS_THROUGH_FORWARD_VALUE)
         # Assert no reply
         reply.assert_not_called()
         # but a return value
         self.assertIsInstance(r, Deferred)
         self.assertEqual(r.result, (request, controls))
 
+    def test_handleProxiedResponse_otp_success(self):
+        proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(response, filtered_bind_request(proxy), None)
+
+        self.assertIsInstance(r, Deferred)
+        self.assertIs(r.result, response)
+
+    def test_handleProxiedResponse_otp_failure(self):
+        proxy = OtpGateway(DummyStaticOtp('654321'), SuffixOtpExtractor())
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(response, filtered_bind_request(proxy), None)
+
+        self.assertIsInstance(r.result, LDAPBindResponse)
+        self.assertEqual(r.result.resultCode, ldaperrors.LDAPInvalidCredentials.resultCode)
+
+    def test_handleProxiedResponse_waits_for_pending_verification(self):
+        otp_backend = BaseOtpBackend()
+        pending = Deferred()
+        otp_backend.verify_async = MagicMock(return_value=pending)
+        proxy = OtpGateway(otp_backend, SuffixOtpExtractor())
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(response, filtered_bind_request(proxy), None)
+
+        otp_backend.verify_async.assert_called_once_with('cn=user', 'password', '123456')
+        self.assertFalse(r.called)
+        pending.callback((True, None))
+        self.assertIs(r.result, response)
+
+    def test_handleProxiedResponse_verification_error(self):
+        otp_backend = BaseOtpBackend()
+        otp_backend.verify_async = MagicMock(side_effect=Exception('boom'))
+        proxy = OtpGateway(otp_backend, SuffixOtpExtractor())
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(response, filtered_bind_request(proxy), None)
+
+        self.assertEqual(r.result.resultCode, ldaperrors.LDAPOther.resultCode)
+
+    def test_handleProxiedResponse_otp_backend_unavailable(self):
+        otp_backend = BaseOtpBackend()
+        otp_backend.verify_async = MagicMock(side_effect=OtpBackendUnavailable('OTP backend unavailable'))
+        proxy = OtpGateway(otp_backend, SuffixOtpExtractor())
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(response, filtered_bind_request(proxy), None)
+
+        self.assertEqual(r.result.resultCode, ldaperrors.LDAPUnavailable.resultCode)
+
+    def test_handleProxiedResponse_bind_context_forgotten(self):
+        proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        request = filtered_bind_request(proxy)
+        proxy.handleProxiedResponse(LDAPBindResponse(ldaperrors.Success.resultCode), request, None)
+
+        self.assertIsNone(proxy.tracked(request))
+        r = proxy.handleProxiedResponse(LDAPBindResponse(ldaperrors.Success.resultCode), request, None)
+        self.assertEqual(r.result.resultCode, ldaperrors.LDAPOther.resultCode)
+
+    def test_handleProxiedResponse_pipelined_binds(self):
+        proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        first = filtered_bind_request(proxy, otp=b'654321')
+        second = filtered_bind_request(proxy)
+
+        r = proxy.handleProxiedResponse(LDAPBindResponse(ldaperrors.Success.resultCode), second, None)
+        self.assertEqual(r.result.resultCode, ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(LDAPBindResponse(ldaperrors.Success.resultCode), first, None)
+        self.assertEqual(r.result.resultCode, ldaperrors.LDAPInvalidCredentials.resultCode)
+
+    def test_handleProxiedResponse_backend_bind_failure(self):
+        otp_backend = BaseOtpBackend()
+        otp_backend.verify_async = MagicMock()
+        proxy = OtpGateway(otp_backend, SuffixOtpExtractor())
+        response = LDAPBindResponse(ldaperrors.LDAPInvalidCredentials.resultCode)
+        r = proxy.handleProxiedResponse(response, filtered_bind_request(proxy), None)
+
+        otp_backend.verify_async.assert_not_called()
+        self.assertIs(r.result, response)
+
+    def test_bind_metrics(self):
+        filtered = metrics.BINDS_FILTERED.get()
+        successes = metrics.OTP_VERIFICATIONS_SUCCESS.get()
+        totals = sum(metrics.STAGE_TOTAL.counts)
+        proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        request = LDAPBindRequest(dn=b'cn=user', auth=b'password123456')
+
+        proxy.handleBeforeForwardRequest(request, None, MagicMock())
+        proxy.handleProxiedResponse(LDAPBindResponse(ldaperrors.Success.resultCode), request, None)
+
+        self.assertEqual(filtered + 1, metrics.BINDS_FILTERED.get())
+        self.assertEqual(successes + 1, metrics.OTP_VERIFICATIONS_SUCCESS.get())
+        self.assertEqual(totals + 1, sum(metrics.STAGE_TOTAL.counts))
+
+    def test_extraction_failure_metrics(self):
+        failures = metrics.OTP_EXTRACTION_FAILURES.get()
+        proxy = OtpGateway(DummyStaticOtp(), SuffixOtpExtractor())
+
+        proxy.handleBeforeForwardRequest(LDAPBindRequest(dn=b'cn=user', auth=b'12'), None, MagicMock())
+
+        self.assertEqual(failures + 1, metrics.OTP_EXTRACTION_FAILURES.get())
+
+    def test_connectionLost_releases_pooled_connection(self):
+        proxy = OtpGateway(DummyStaticOtp(), SuffixOtpExtractor())
+        proxy.backend_pool = MagicMock()
+        client = MagicMock()
+        proxy.client = client
+        proxy.handleBeforeForwardRequest(LDAPBindRequest(dn=b'cn=user', auth=b'password123456'), None, MagicMock())
+        proxy.connectionLost(None)
+
+        proxy.backend_pool.release.assert_called_once_with(client, bound=True)
+        client.unbind.assert_not_called()
+        self.assertIsNone(proxy.client)
+
+    def test_bind_completes_with_components_it_started_with(self):
+        proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        previous = proxy.components.current
+        request = LDAPBindRequest(dn=b'cn=user', auth=b'password123456')
+        proxy.handleBeforeForwardRequest(request, None, MagicMock())
+        self.assertEqual(1, previous.in_flight)
+
+        # a configuration reload replaces the OTP backend meanwhile
+        d = proxy.components.swap(Components(DummyStaticOtp('654321'), SuffixOtpExtractor()),
+                                  reactor=task.Clock())
+        self.assertFalse(d.called)
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        r = proxy.handleProxiedResponse(response, request, None)
+
+        self.assertIs(r.result, response)
+        self.assertEqual(0, previous.in_flight)
+        self.assertTrue(d.called)
+
+    def test_unbind_not_forwarded_to_pooled_connection(self):
+        proxy = OtpGateway(DummyStaticOtp(), SuffixOtpExtractor())
+        proxy.backend_pool = MagicMock()
+        proxy.client = MagicMock()
+        proxy.transport = MagicMock()
+        proxy.handle_LDAPUnbindRequest(LDAPUnbindRequest(), None, MagicMock())
+
+        proxy.client.send_noResponse.assert_not_called()
+        proxy.transport.loseConnection.assert_called_once()
+
+
+class TestOtpGatewayVerifyOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.otp_backend = BaseOtpBackend()
+        self.pending = Deferred()
+        self.otp_backend.verify_async = MagicMock(return_value=self.pending)
+        self.proxy = OtpGateway(self.otp_backend, SuffixOtpExtractor())
+        self.proxy.connected = True
+        self.proxy.client = MagicMock()
+        self.request = LDAPBindRequest(dn=b'cn=user', auth=b'password123456')
+        self.reply = MagicMock()
+
+    def test_parallel(self):
+        self.proxy.verify_order = PARALLEL
+        r = self.proxy.handleBeforeForwardRequest(self.request, None, self.reply)
+
+        # verifying along the backend bind
+        self.otp_backend.verify_async.assert_called_once_with('cn=user', 'password', '123456')
+        self.assertEqual((self.request, None), r.result)
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        d = self.proxy.handleProxiedResponse(response, self.request, None)
+        self.assertFalse(d.called)
+        self.pending.callback((True, None))
+        self.assertIs(response, d.result)
+        self.assertEqual(0, self.proxy.components.current.in_flight)
+
+    def test_parallel_backend_rejection(self):
+        self.proxy.verify_order = PARALLEL
+        self.proxy.handleBeforeForwardRequest(self.request, None, self.reply)
+
+        # answered without waiting for the OTP verification
+        response = LDAPBindResponse(ldaperrors.LDAPInvalidCredentials.resultCode)
+        d = self.proxy.handleProxiedResponse(response, self.request, None)
+        self.assertIs(response, d.result)
+        self.assertEqual(1, self.proxy.components.current.in_flight)
+        self.pending.callback((True, None))
+        self.assertEqual(0, self.proxy.components.current.in_flight)
+
+    def test_otp_first(self):
+        self.proxy.verify_order = OTP_FIRST
+        r = self.proxy.handleBeforeForwardRequest(self.request, None, self.reply)
+
+        self.assertFalse(r.called)
+        self.assertFalse(self.proxy.backend_bound)
+        self.pending.callback((True, None))
+        self.assertEqual((self.request, None), r.result)
+        self.assertTrue(self.proxy.backend_bound)
+
+        response = LDAPBindResponse(ldaperrors.Success.resultCode)
+        d = self.proxy.handleProxiedResponse(response, self.request, None)
+        self.assertIs(response, d.result)
+        self.otp_backend.verify_async.assert_called_once()
+        self.reply.assert_not_called()
+
+    def test_otp_first_rejection_not_forwarded(self):
+        self.proxy.verify_order = OTP_FIRST
+        r = self.proxy.handleBeforeForwardRequest(self.request, None, self.reply)
+        self.pending.callback((False, 'Invalid OTP'))
+
+        self.assertIsNone(r.result)
+        self.assertFalse(self.proxy.backend_bound)
+        [[rejection], _] = self.reply.call_args
+        self.assertEqual(ldaperrors.LDAPInvalidCredentials.resultCode, rejection.resultCode)
+        self.assertEqual(0, self.proxy.components.current.in_flight)
+
+
+class TestOtpGatewayRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        self.proxy.rate_limiter = BindLimiter(KeyLimiter('dn', rate=1, burst=1, failure_threshold=2),
+                                              KeyLimiter('address'), reactor=self.clock)
+        self.proxy.clientConnector = Deferred
+        self.proxy.makeConnection(StringTransport())
+        self.reply = MagicMock()
+
+    def bind(self, auth=b'password123456', result_code=ldaperrors.Success.resultCode):
+        request = LDAPBindRequest(dn=b'cn=user', auth=auth)
+        r = self.proxy.handleBeforeForwardRequest(request, None, self.reply)
+        if r is not None:
+            r = self.proxy.handleProxiedResponse(LDAPBindResponse(result_code), request, None)
+        return r
+
+    def test_peer_address(self):
+        self.assertEqual('192.168.1.1', self.proxy.peer_address)
+
+    def test_rate_limited(self):
+        rate_limited = metrics.RATE_LIMITED_BINDS.labels('dn', 'rate').get()
+        self.assertEqual(ldaperrors.Success.resultCode, self.bind().result.resultCode)
+
+        self.assertIsNone(self.bind())
+        [[response], _] = self.reply.call_args
+        self.assertEqual(ldaperrors.LDAPBusy.resultCode, response.resultCode)
+        self.assertEqual(rate_limited + 1, metrics.RATE_LIMITED_BINDS.labels('dn', 'rate').get())
+
+    def test_locked_out_after_failed_binds(self):
+        self.bind(result_code=ldaperrors.LDAPInvalidCredentials.resultCode)
+        self.clock.advance(1)
+        # wrong OTP
+        self.bind(auth=b'password654321')
+        self.clock.advance(1)
+
+        self.assertIsNone(self.bind())
+        [[response], _] = self.reply.call_args
+        self.assertEqual(ldaperrors.LDAPUnwillingToPerform.resultCode, response.resultCode)
+
+    def test_extraction_failure_counted(self):
+        self.bind(auth=b'12')
+        self.clock.advance(1)
+        self.bind(auth=b'34')
+        self.clock.advance(1)
+
+        self.bind()
+        [[response], _] = self.reply.call_args
+        self.assertEqual(ldaperrors.LDAPUnwillingToPerform.resultCode, response.resultCode)
+
+
+class TestOtpGatewayAudit(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        self.proxy.audit_log = AuditLog(MagicMock(), queue_size=2, batch_size=10, overflow=FAIL_CLOSED)
+        self.proxy.clientConnector = Deferred
+        self.proxy.makeConnection(StringTransport())
+        self.reply = MagicMock()
+
+    def bind(self, auth=b'password123456', result_code=ldaperrors.Success.resultCode):
+        request = LDAPBindRequest(dn=b'cn=user', auth=auth)
+        r = self.proxy.handleBeforeForwardRequest(request, None, self.reply)
+        if r is not None:
+            r = self.proxy.handleProxiedResponse(LDAPBindResponse(result_code), request, None)
+        return r
+
+    def test_filtered_bind_recorded(self):
+        self.bind()
+
+        [record] = self.proxy.audit_log.queue
+        self.assertEqual('cn=user', record['dn'])
+        self.assertEqual('192.168.1.1', record['peer'])
+        self.assertEqual('filtered', record['mode'])
+        self.assertEqual('success', record['otp'])
+        self.assertEqual(ldaperrors.Success.resultCode, record['result_code'])
+        self.assertEqual({'before_forward', 'otp_verify', 'backend', 'total'}, set(record['timings']))
+
+    def test_rejected_bind_recorded(self):
+        self.bind(auth=b'password654321')
+
+        [record] = self.proxy.audit_log.queue
+        self.assertEqual('failure', record['otp'])
+        self.assertEqual(ldaperrors.LDAPInvalidCredentials.resultCode, record['result_code'])
+
+    def test_parallel_backend_rejection_recorded_once_verified(self):
+        otp_backend = BaseOtpBackend()
+        pending = Deferred()
+        otp_backend.verify_async = MagicMock(return_value=pending)
+        self.proxy.components.current.otp_backend = otp_backend
+        self.proxy.verify_order = PARALLEL
+        self.bind(result_code=ldaperrors.LDAPInvalidCredentials.resultCode)
+
+        # the writer thread would otherwise serialize the record while the verification completes it
+        self.assertEqual(0, len(self.proxy.audit_log.queue))
+        pending.callback((True, None))
+        [record] = self.proxy.audit_log.queue
+        self.assertEqual('success', record['otp'])
+        self.assertEqual(ldaperrors.LDAPInvalidCredentials.resultCode, record['result_code'])
+        self.assertEqual({'before_forward', 'otp_verify', 'backend', 'total'}, set(record['timings']))
+
+    def test_fail_closed_refuses_binds(self):
+        refused = metrics.AUDIT_BINDS_REFUSED.get()
+        self.bind()
+        self.bind()
+
+        self.assertIsNone(self.bind())
+        [[response], _] = self.reply.call_args
+        self.assertEqual(ldaperrors.LDAPUnavailable.resultCode, response.resultCode)
+        self.assertEqual(2, len(self.proxy.audit_log.queue))
+        self.assertEqual(refused + 1, metrics.AUDIT_BINDS_REFUSED.get())
+
+
+class TestOtpGatewayLazyBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        self.proxy.lazy_backend = True
+        self.connected = Deferred()
+        self.proxy.clientConnector = MagicMock(return_value=self.connected)
+        self.proxy.makeConnection(StringTransport())
+        self.client = GatewayLDAPClient()
+        self.client.makeConnection(StringTransport())
+
+    def test_connected_by_first_request(self):
+        self.proxy.clientConnector.assert_not_called()
+
+        self.proxy.dataReceived(pureldap.LDAPMessage(LDAPBindRequest(dn=b'cn=user', auth=b'password123456'),
+                                                     id=1).toWire())
+        self.proxy.dataReceived(pureldap.LDAPMessage(pureldap.LDAPSearchRequest(baseObject=b''), id=2).toWire())
+        self.proxy.clientConnector.assert_called_once_with()
+        self.assertEqual(2, len(self.proxy.queuedRequests))
+
+        self.connected.callback(self.client)
+        self.assertEqual([], self.proxy.queuedRequests)
+        self.assertEqual(2, len(self.client.onwire))
+
+    def test_unbind_without_backend_connection(self):
+        self.proxy.dataReceived(pureldap.LDAPMessage(LDAPUnbindRequest(), id=1).toWire())
+
+        self.proxy.clientConnector.assert_not_called()
+        self.assertTrue(self.proxy.transport.disconnecting)
+
+    def test_backend_unavailable(self):
+        self.proxy.dataReceived(pureldap.LDAPMessage(LDAPBindRequest(dn=b'cn=user', auth=b'password123456'),
+                                                     id=1).toWire())
+        self.connected.errback(ConnectionRefusedError())
+
+        [response] = pureber.berDecodeObject(self.client.berdecoder, self.proxy.transport.value())[:1]
+        self.assertEqual(ldaperrors.LDAPUnavailable.resultCode, response.value.resultCode)
+        self.assertTrue(self.proxy.transport.disconnecting)
+
+
+class TestOtpGatewayRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        self.proxy.relay = True
+        self.proxy.clientConnector = Deferred
+        self.proxy.makeConnection(StringTransport())
+        self.client = GatewayLDAPClient()
+        self.client.makeConnection(StringTransport())
+        self.proxy.client = self.client
+
+    def sent(self, transport):
+        data = transport.value()
+        transport.clear()
+        messages = []
+        while data:
+            message, length = pureber.berDecodeObject(self.client.berdecoder, data)
+            messages.append(message)
+            data = data[length:]
+        return messages
+
+    def bind(self):
+        self.proxy.dataReceived(pureldap.LDAPMessage(LDAPBindRequest(dn=b'cn=user', auth=b'password123456'),
+                                                     id=1).toWire())
+        [bind] = self.sent(self.client.transport)
+        self.client.dataReceived(pureldap.LDAPMessage(LDAPBindResponse(ldaperrors.Success.resultCode),
+                                                      id=bind.id).toWire())
+        [response] = self.sent(self.proxy.transport)
+        self.assertEqual((1, ldaperrors.Success.resultCode), (response.id, response.value.resultCode))
+
+    def test_relaying_once_bound(self):
+        self.assertFalse(self.proxy.relaying)
+        self.bind()
+        self.assertTrue(self.proxy.relaying)
+
+    def test_not_relaying_without_configuration(self):
+        self.proxy.relay = False
+        self.bind()
+        self.assertFalse(self.proxy.relaying)
+
+    def test_search_relayed(self):
+        self.bind()
+        search = pureldap.LDAPMessage(pureldap.LDAPSearchRequest(baseObject=b'dc=example,dc=com'), id=7).toWire()
+        # split over several reads
+        self.proxy.dataReceived(search[:3])
+        self.proxy.dataReceived(search[3:])
+
+        [request] = self.sent(self.client.transport)
+        self.assertNotEqual(7, request.id)
+        self.assertEqual(b'dc=example,dc=com', request.value.baseObject)
+        self.assertIn(request.id, self.client.relay_handlers)
+
+        self.client.dataReceived(
+            pureldap.LDAPMessage(pureldap.LDAPSearchResultEntry(objectName=b'cn=user,dc=example,dc=com',
+                                                                attributes=[(b'cn', [b'user'])]),
+                                 id=request.id).toWire()
+            + pureldap.LDAPMessage(pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode),
+                                   id=request.id).toWire())
+
+        entry, done = self.sent(self.proxy.transport)
+        self.assertEqual((7, b'cn=user,dc=example,dc=com'), (entry.id, entry.value.objectName))
+        self.assertEqual(7, done.id)
+        self.assertIsInstance(done.value, pureldap.LDAPSearchResultDone)
+        self.assertEqual({}, self.client.relay_handlers)
+        self.assertFalse(self.client.busy)
+
+    def test_bind_still_decoded(self):
+        self.bind()
+        self.bind()
+
+    def test_response_dropped_once_disconnected(self):
+        self.bind()
+        self.proxy.dataReceived(pureldap.LDAPMessage(pureldap.LDAPDelRequest(entry=b'cn=user'), id=7).toWire())
+        [request] = self.sent(self.client.transport)
+        self.proxy.connected = 0
+
+        self.client.dataReceived(pureldap.LDAPMessage(pureldap.LDAPDelResponse(ldaperrors.Success.resultCode),
+                                                      id=request.id).toWire())
+
+        self.assertEqual(b'', self.proxy.transport.value())
+        self.assertEqual({}, self.client.relay_handlers)
+
+
+class TestOtpGatewaySearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.proxy = OtpGateway(DummyStaticOtp('123456'), SuffixOtpExtractor())
+        self.proxy.relay = True
+        self.proxy.search_cache = SearchCache(parse_shapes('sub:dc=example,dc=com'), reactor=task.Clock())
+        self.proxy.clientConnector = Deferred
+        self.proxy.makeConnection(StringTransport())
+        self.client = GatewayLDAPClient()
+        self.client.makeConnection(StringTransport())
+        self.proxy.client = self.client
+        self.search_request = pureldap.LDAPSearchRequest(baseObject=b'dc=example,dc=com',
+                                                         filter=pureldap.LDAPFilter_present('member'))
+
+    def sent(self, transport):
+        data = transport.value()
+        transport.clear()
+        messages = []
+        while data:
+            message, length = pureber.berDecodeObject(self.client.berdecoder, data)
+            messages.append(message)
+            data = data[length:]
+        return messages
+
+    def respond(self, request, *responses):
+        self.client.dataReceived(b''.join(pureldap.LDAPMessage(response, id=request.id).toWire()
+                                          for response in responses))
+        return self.sent(self.proxy.transport)
+
+    def bind(self, dn=b'cn=user'):
+        self.proxy.dataReceived(pureldap.LDAPMessage(LDAPBindRequest(dn=dn, auth=b'password123456'), id=1).toWire())
+        [bind] = self.sent(self.client.transport)
+        self.respond(bind, LDAPBindResponse(ldaperrors.Success.resultCode))
+
+    def search(self, message_id):
+        self.proxy.dataReceived(pureldap.LDAPMessage(self.search_request, id=message_id).toWire())
+        return self.sent(self.client.transport)
+
+    def test_search_replayed_from_cache(self):
+        self.bind()
+        [request] = self.search(7)
+        self.respond(request, pureldap.LDAPSearchResultEntry(objectName=b'cn=group,dc=example,dc=com',
+                                                             attributes=[(b'member', [b'cn=user'])]),
+                     pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode))
+        # neither the bind nor the search state outlives its response
+        self.assertEqual({}, self.proxy.in_flight)
+
+        self.assertEqual([], self.search(8))
+        entry, done = self.sent(self.proxy.transport)
+        self.assertEqual((8, b'cn=group,dc=example,dc=com'), (entry.id, entry.value.objectName))
+        self.assertEqual(8, done.id)
+        self.assertIsInstance(done.value, pureldap.LDAPSearchResultDone)
+
+    def test_cached_by_bound_identity(self):
+        self.bind()
+        [request] = self.search(7)
+        self.respond(request, pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode))
+
+        self.bind(b'cn=other')
+        self.assertEqual(1, len(self.search(8)))
+
+    def test_cached_by_backend_identity_when_otp_rejected(self):
+        self.proxy.dataReceived(pureldap.LDAPMessage(LDAPBindRequest(dn=b'cn=admin', auth=b'password000000'),
+                                                     id=1).toWire())
+        [bind] = self.sent(self.client.transport)
+        [response] = self.respond(bind, LDAPBindResponse(ldaperrors.Success.resultCode))
+        self.assertEqual(ldaperrors.LDAPInvalidCredentials.resultCode, response.value.resultCode)
+        self.assertEqual(b'cn=admin', self.proxy.bound_dn)
+
+        [request] = self.search(7)
+        self.respond(request, pureldap.LDAPSearchResultEntry(objectName=b'cn=secret,dc=example,dc=com',
+                                                             attributes=[]),
+                     pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode))
+
+        # the admin results are not replayed to the anonymous connections
+        responses, _ = self.proxy.search_cache.start(b'', self.search_request)
+        self.assertIsNone(responses)
+        responses, _ = self.proxy.search_cache.start(b'cn=admin', self.search_request)
+        self.assertEqual(2, len(responses))
+
+    def test_write_invalidates(self):
+        self.bind()
+        [request] = self.search(7)
+        self.respond(request, pureldap.LDAPSearchResultDone(ldaperrors.Success.resultCode))
+
+        self.proxy.dataReceived(pureldap.LDAPMessage(pureldap.LDAPDelRequest(entry=b'cn=group,dc=example,dc=com'),
+                                                     id=8).toWire())
+        [delete] = self.sent(self.client.transport)
+        self.assertNotIn(delete.id, self.client.relay_handlers)
+        [response] = self.respond(delete, pureldap.LDAPDelResponse(ldaperrors.Success.resultCode))
+        self.assertEqual(8, response.id)
+
+        self.assertEqual(1, len(self.search(9)))
+
+
+class TestOtpGatewayFactory(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = OtpGatewayFactory(lambda: OtpGateway(DummyStaticOtp(), SuffixOtpExtractor()), reactor=self.clock)
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.clientConnector = Deferred
+        proto.transport = MagicMock()
+        proto.connectionMade()
+        return proto
+
+    def test_tracks_connections(self):
+        proto = self.connect()
+        self.assertEqual({proto}, self.factory.connections)
+
+        proto.connectionLost(None)
+        self.assertEqual(set(), self.factory.connections)
+
+    def test_connections_gauge(self):
+        gauge = metrics.FRONTEND_CONNECTIONS.labels('unsecure')
+        opened = gauge.get()
+        proto = self.connect()
+        self.assertEqual(opened + 1, gauge.get())
+
+        proto.connectionLost(None)
+        proto.connectionLost(None)
+        self.assertEqual(opened, gauge.get())
+
+    def test_drain_without_connections(self):
+        self.assertTrue(self.factory.drain(10).called)
+
+    def test_drain_waits_for_connections(self):
+        first, second = self.connect(), self.connect()
+        d = self.factory.drain(10)
+
+        first.connectionLost(None)
+        self.assertFalse(d.called)
+        second.connectionLost(None)
+        self.assertTrue(d.called)
+        second.transport.loseConnection.assert_not_called()
+
+    def test_drain_closes_connections_after_timeout(self):
+        proto = self.connect()
+        d = self.factory.drain(10)
+
+        self.clock.advance(10)
+
+        self.assertTrue(d.called)
+        proto.transport.loseConnection.assert_called_once()
+
 
 if __name__ == '__main__':
     unittest.main()
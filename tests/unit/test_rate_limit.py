@@ -0,0 +1,112 @@
+import unittest
+
+from twisted.internet import task
+
+from ldap_otp_gateway import metrics
+from ldap_otp_gateway.config import Settings
+from ldap_otp_gateway.rate_limit import LOCKOUT, RATE, BindLimiter, KeyLimiter, build_limiter
+
+
+class TestBindLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def limiter(self, dn=None, address=None):
+        return BindLimiter(KeyLimiter('dn', **(dn or {})), KeyLimiter('address', **(address or {})),
+                           reactor=self.clock)
+
+    def test_token_bucket(self):
+        limiter = self.limiter(dn=dict(rate=1, burst=2))
+
+        self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.1'))
+        self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.1'))
+        self.assertEqual(('dn', RATE), limiter.check(b'cn=user', '10.0.0.1'))
+        # other DNs have their own bucket
+        self.assertEqual((None, None), limiter.check(b'cn=other', '10.0.0.1'))
+
+        self.clock.advance(1)
+        self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.1'))
+        self.assertEqual(('dn', RATE), limiter.check(b'cn=user', '10.0.0.1'))
+
+    def test_normalized_dn(self):
+        limiter = self.limiter(dn=dict(rate=1, burst=1))
+
+        limiter.check(b'cn=User, dc=example', '10.0.0.1')
+        self.assertEqual(('dn', RATE), limiter.check(b'CN=user,DC=Example', '10.0.0.2'))
+
+    def test_address_bucket(self):
+        limiter = self.limiter(dn=dict(rate=1, burst=1), address=dict(rate=1, burst=2))
+
+        limiter.check(b'cn=user1', '10.0.0.1')
+        limiter.check(b'cn=user2', '10.0.0.1')
+        self.assertEqual(('address', RATE), limiter.check(b'cn=user3', '10.0.0.1'))
+        # the DN token isn't taken when the address is limited
+        self.assertEqual((None, None), limiter.check(b'cn=user3', '10.0.0.2'))
+
+    def test_anonymous_binds_limited_by_address(self):
+        limiter = self.limiter(dn=dict(rate=1, burst=1), address=dict(rate=1, burst=2))
+
+        self.assertEqual((None, None), limiter.check(b'', '10.0.0.1'))
+        self.assertEqual((None, None), limiter.check(b'', '10.0.0.1'))
+        self.assertEqual(('address', RATE), limiter.check(b'', '10.0.0.1'))
+
+    def test_lockout(self):
+        lockouts = metrics.LOCKOUTS.labels('dn').get()
+        limiter = self.limiter(dn=dict(failure_threshold=3, failure_window=60, lockout_duration=300))
+
+        for _ in range(3):
+            self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.1'))
+            limiter.failed(b'cn=user', '10.0.0.1')
+        self.assertEqual(('dn', LOCKOUT), limiter.check(b'cn=user', '10.0.0.2'))
+        self.assertEqual(lockouts + 1, metrics.LOCKOUTS.labels('dn').get())
+
+        self.clock.advance(300)
+        self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.1'))
+
+    def test_failures_slide_out_of_window(self):
+        limiter = self.limiter(dn=dict(failure_threshold=3, failure_window=60))
+
+        for _ in range(5):
+            limiter.failed(b'cn=user', '10.0.0.1')
+            self.clock.advance(31)
+        self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.1'))
+
+    def test_success_forgets_dn_failures(self):
+        limiter = self.limiter(dn=dict(failure_threshold=2), address=dict(failure_threshold=2))
+
+        limiter.failed(b'cn=user', '10.0.0.1')
+        limiter.succeeded(b'cn=user')
+        limiter.failed(b'cn=user', '10.0.0.1')
+        self.assertEqual(('address', LOCKOUT), limiter.check(b'cn=user', '10.0.0.1'))
+        self.assertEqual((None, None), limiter.check(b'cn=user', '10.0.0.2'))
+
+    def test_bounded_keys(self):
+        limiter = self.limiter(dn=dict(rate=1, burst=1, max_keys=2))
+
+        for dn in (b'cn=user1', b'cn=user2', b'cn=user3'):
+            limiter.check(dn, '10.0.0.1')
+
+        self.assertEqual(['cn=user2', 'cn=user3'], list(limiter.dn_limiter.entries))
+        self.assertEqual(2, metrics.RATE_LIMIT_KEYS.labels('dn').get())
+        # the least recently seen DN was forgotten, with its bucket
+        self.assertEqual((None, None), limiter.check(b'cn=user1', '10.0.0.1'))
+
+
+class TestBuildLimiter(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(build_limiter(Settings({})))
+
+    def test_settings(self):
+        limiter = build_limiter(Settings({'LDAP_GATEWAY_RATE_LIMIT_ADDRESS_RATE': '5',
+                                          'LDAP_GATEWAY_LOCKOUT_DN_FAILURES': '3'}))
+
+        self.assertEqual(5, limiter.address_limiter.rate)
+        self.assertEqual(100, limiter.address_limiter.burst)
+        self.assertEqual(0, limiter.dn_limiter.rate)
+        self.assertEqual(3, limiter.dn_limiter.failure_threshold)
+
+    def test_invalid_burst(self):
+        with self.assertRaises(ValueError):
+            build_limiter(Settings({'LDAP_GATEWAY_RATE_LIMIT_DN_RATE': '1', 'LDAP_GATEWAY_RATE_LIMIT_DN_BURST': '0'}))
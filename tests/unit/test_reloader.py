@@ -0,0 +1,81 @@
+import os
+import signal
+import tempfile
+from unittest.mock import MagicMock, patch
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from ldap_otp_gateway import metrics
+from ldap_otp_gateway.config import Settings
+from ldap_otp_gateway.reloader import Reloader
+
+
+class TestReloader(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.apply = MagicMock()
+        self.reloader = Reloader(Settings({}), self.apply, reactor=self.clock)
+
+    @patch.dict(os.environ, {'OTP_CACHE_TTL': '10'})
+    def test_reload(self):
+        successes = metrics.CONFIG_RELOADS_SUCCESS.get()
+
+        self.assertTrue(self.reloader.reload())
+
+        [settings], _ = self.apply.call_args
+        self.assertEqual(10, settings.OTP_CACHE_TTL)
+        self.assertTrue(settings.reload_plugins)
+        self.assertIs(settings, self.reloader.settings)
+        self.assertEqual(successes + 1, metrics.CONFIG_RELOADS_SUCCESS.get())
+
+    @patch.dict(os.environ, {'OTP_CACHE_TTL': 'soon'})
+    def test_invalid_configuration_kept(self):
+        failures = metrics.CONFIG_RELOADS_FAILURE.get()
+        settings = self.reloader.settings
+
+        self.assertFalse(self.reloader.reload())
+
+        self.apply.assert_not_called()
+        self.assertIs(settings, self.reloader.settings)
+        self.assertEqual(failures + 1, metrics.CONFIG_RELOADS_FAILURE.get())
+
+    @patch.dict(os.environ, {'OTP_BACKEND_THREAD_POOL_SIZE': '20', 'OTP_CACHE_TTL': '10'})
+    def test_restart_only_settings_logged(self):
+        with self.assertLogs('ldap_otp_gateway.reloader', 'WARNING') as logs:
+            self.assertTrue(self.reloader.reload())
+
+        self.assertEqual(1, len(logs.output))
+        self.assertIn('OTP_BACKEND_THREAD_POOL_SIZE', logs.output[0])
+        self.assertNotIn('OTP_CACHE_TTL', logs.output[0])
+
+    def test_failing_apply_kept(self):
+        settings = self.reloader.settings
+        self.apply.side_effect = ModuleNotFoundError('missing')
+
+        self.assertFalse(self.reloader.reload())
+        self.assertIs(settings, self.reloader.settings)
+
+    def test_environment_loaded_first(self):
+        load_environment = MagicMock(side_effect=lambda: self.apply.assert_not_called())
+        reloader = Reloader(Settings({}), self.apply, load_environment=load_environment, reactor=self.clock)
+
+        reloader.reload()
+
+        load_environment.assert_called_once_with()
+        self.apply.assert_called_once()
+
+    def test_watched_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            reloader = Reloader(Settings({}), self.apply, watch_path=f.name, watch_interval=5, reactor=self.clock)
+            self.addCleanup(signal.signal, signal.SIGHUP, signal.getsignal(signal.SIGHUP))
+            reloader.start()
+            self.addCleanup(reloader.stop)
+
+            self.clock.advance(5)
+            self.apply.assert_not_called()
+
+            os.utime(f.name, (0, 0))
+            self.clock.advance(5)
+            self.apply.assert_called_once()
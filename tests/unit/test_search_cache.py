@@ -0,0 +1,155 @@
+import unittest
+
+from ldaptor.protocols import pureldap
+from ldaptor.protocols.ldap import ldaperrors
+from twisted.internet import task
+
+from ldap_otp_gateway import metrics
+from ldap_otp_gateway.config import Settings
+from ldap_otp_gateway.dn import split_dn
+from ldap_otp_gateway.search_cache import SearchCache, SearchShape, build_cache, parse_shapes, written_dns
+
+PEOPLE = 'ou=people,dc=example,dc=org'
+
+
+def search(base=b'', scope=pureldap.LDAP_SCOPE_baseObject, attribute='objectClass'):
+    return pureldap.LDAPSearchRequest(baseObject=base, scope=scope, filter=pureldap.LDAPFilter_present(attribute))
+
+
+def entry(dn):
+    return pureldap.LDAPSearchResultEntry(objectName=dn, attributes=[(b'cn', [b'user'])])
+
+
+def done(result_code=ldaperrors.Success.resultCode):
+    return pureldap.LDAPSearchResultDone(result_code)
+
+
+class TestSearchShape(unittest.TestCase):
+
+    def test_parse(self):
+        root_dse, people, groups = parse_shapes(f'base:; base:*,{PEOPLE} ;sub:ou=Groups,dc=example,dc=org')
+
+        self.assertTrue(root_dse.matches(pureldap.LDAP_SCOPE_baseObject, ()))
+        self.assertFalse(root_dse.matches(pureldap.LDAP_SCOPE_wholeSubtree, ()))
+        self.assertTrue(people.matches(pureldap.LDAP_SCOPE_baseObject, split_dn(f'uid=user,{PEOPLE}')))
+        self.assertFalse(people.matches(pureldap.LDAP_SCOPE_baseObject, split_dn(PEOPLE)))
+        self.assertTrue(groups.matches(pureldap.LDAP_SCOPE_wholeSubtree, split_dn('ou=groups, dc=example,dc=org')))
+
+    def test_any_dn(self):
+        shape = SearchShape.parse('one:*')
+
+        self.assertTrue(shape.matches(pureldap.LDAP_SCOPE_singleLevel, split_dn(PEOPLE)))
+        self.assertFalse(shape.matches(pureldap.LDAP_SCOPE_singleLevel, ()))
+
+    def test_invalid(self):
+        for value in ('subtree:dc=example', 'dc=example'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                SearchShape.parse(value)
+
+
+class TestSearchCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = SearchCache(parse_shapes(f'base:;sub:{PEOPLE}'), ttl=60, max_size=2, max_results=2,
+                                 reactor=self.clock)
+
+    def store(self, request, responses, identity=b'cn=user'):
+        cached, pending = self.cache.start(identity, request)
+        self.assertIsNone(cached)
+        for response in responses:
+            self.cache.collect(pending, response)
+
+    def test_hit(self):
+        hits = metrics.SEARCH_CACHE_HITS.get()
+        responses = [entry(b''), done()]
+        self.store(search(), responses)
+
+        cached, pending = self.cache.start(b'CN=User', search())
+        self.assertEqual(responses, cached)
+        self.assertIsNone(pending)
+        self.assertEqual(hits + 1, metrics.SEARCH_CACHE_HITS.get())
+
+    def test_keyed_by_identity_and_request(self):
+        self.store(search(), [done()])
+
+        self.assertEqual((None, None), self.cache.start(b'cn=user', search(scope=pureldap.LDAP_SCOPE_wholeSubtree)))
+        self.assertIsNone(self.cache.start(b'cn=other', search())[0])
+        self.assertIsNone(self.cache.start(b'cn=user', search(attribute='cn'))[0])
+
+    def test_expired(self):
+        self.store(search(), [done()])
+        self.clock.advance(60)
+
+        self.assertIsNone(self.cache.start(b'cn=user', search())[0])
+        self.assertEqual(0, len(self.cache.entries))
+
+    def test_least_recently_used_evicted(self):
+        people = search(PEOPLE.encode(), pureldap.LDAP_SCOPE_wholeSubtree)
+        self.store(search(), [done()])
+        self.store(people, [done()])
+        self.cache.start(b'cn=user', search())
+        self.store(search(attribute='cn'), [done()])
+
+        self.assertIsNotNone(self.cache.start(b'cn=user', search())[0])
+        self.assertIsNone(self.cache.start(b'cn=user', people)[0])
+
+    def test_not_cached(self):
+        for responses in ([entry(b'uid=1'), entry(b'uid=2'), entry(b'uid=3'), done()],
+                          [done(ldaperrors.LDAPSizeLimitExceeded.resultCode)],
+                          [pureldap.LDAPSearchResultReference([b'ldap://other']), done()]):
+            with self.subTest(responses=responses):
+                self.store(search(), responses)
+                self.assertEqual({}, self.cache.entries)
+
+    def test_invalidate(self):
+        people = search(PEOPLE.encode(), pureldap.LDAP_SCOPE_wholeSubtree)
+        self.store(search(), [done()])
+        self.store(people, [entry(f'uid=user,{PEOPLE}'.encode()), done()])
+
+        self.cache.invalidate(split_dn(f'uid=user,{PEOPLE}'))
+
+        self.assertIsNone(self.cache.start(b'cn=user', people)[0])
+        # the root DSE doesn't hold the written entry
+        self.assertIsNotNone(self.cache.start(b'cn=user', search())[0])
+
+    def test_not_stored_when_invalidated_meanwhile(self):
+        _, pending = self.cache.start(b'cn=user', search())
+        self.cache.invalidate(split_dn(PEOPLE))
+        self.cache.collect(pending, done())
+
+        self.assertEqual({}, self.cache.entries)
+
+    def test_overlaps(self):
+        base = split_dn(PEOPLE)
+        user = split_dn(f'uid=user,{PEOPLE}')
+        nested = split_dn(f'cn=device,uid=user,{PEOPLE}')
+        for scope, rdns, expected in ((pureldap.LDAP_SCOPE_baseObject, base, True),
+                                      (pureldap.LDAP_SCOPE_baseObject, user, False),
+                                      (pureldap.LDAP_SCOPE_singleLevel, user, True),
+                                      (pureldap.LDAP_SCOPE_singleLevel, nested, False),
+                                      (pureldap.LDAP_SCOPE_wholeSubtree, nested, True),
+                                      (pureldap.LDAP_SCOPE_baseObject, split_dn('dc=example,dc=org'), True),
+                                      (pureldap.LDAP_SCOPE_wholeSubtree, split_dn('ou=groups,dc=example,dc=org'),
+                                       False)):
+            with self.subTest(scope=scope, rdns=rdns):
+                self.assertEqual(expected, SearchCache.overlaps(base, scope, rdns))
+
+    def test_written_dns(self):
+        self.assertEqual([split_dn(PEOPLE)], written_dns(pureldap.LDAPDelRequest(entry=PEOPLE.encode())))
+        self.assertEqual([split_dn(f'uid=old,{PEOPLE}'), split_dn(f'uid=new,{PEOPLE}')],
+                         written_dns(pureldap.LDAPModifyDNRequest(entry=f'uid=old,{PEOPLE}'.encode(),
+                                                                  newrdn=b'uid=new', deleteoldrdn=True)))
+        self.assertEqual([], written_dns(search()))
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(build_cache(Settings({})))
+
+    def test_settings(self):
+        cache = build_cache(Settings({'LDAP_GATEWAY_SEARCH_CACHE_SHAPES': 'base:', 'LDAP_GATEWAY_SEARCH_CACHE_TTL': '5'}))
+
+        self.assertEqual(1, len(cache.shapes))
+        self.assertEqual(5, cache.ttl)
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import unittest
+
+from OpenSSL import SSL
+
+from ldap_otp_gateway import certs, metrics, tls
+from ldap_otp_gateway.config import Settings
+
+
+def pump(source, destination):
+    try:
+        destination.bio_write(source.bio_read(65536))
+    except SSL.WantReadError:
+        pass
+
+
+def connect(server_context, client_context, session=None) -> SSL.Connection:
+    """
+    In memory handshake, returning the client connection once closed.
+    """
+    server = SSL.Connection(server_context)
+    server.set_accept_state()
+    client = SSL.Connection(client_context)
+    client.set_connect_state()
+    if session is not None:
+        client.set_session(session)
+    for _ in range(10):
+        for connection in (client, server):
+            try:
+                connection.do_handshake()
+            except SSL.WantReadError:
+                pass
+        pump(client, server)
+        pump(server, client)
+    # read the TLS 1.3 session tickets, then close
+    try:
+        client.recv(1)
+    except SSL.WantReadError:
+        pass
+    client.shutdown()
+    pump(client, server)
+    server.shutdown()
+    return client
+
+
+class TestTLSOptions(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.key_path = os.path.join(directory.name, 'server.key.pem')
+        self.cert_path = os.path.join(directory.name, 'server.crt.pem')
+        certs.generate(self.key_path, self.cert_path)
+
+    def settings(self, **environ):
+        return Settings(dict(environ, LDAP_GATEWAY_SSL_KEY_PATH=self.key_path,
+                             LDAP_GATEWAY_SSL_CERT_PATH=self.cert_path))
+
+    def test_resumed_handshakes_counted(self):
+        full, resumed = metrics.TLS_HANDSHAKES_FULL.get(), metrics.TLS_HANDSHAKES_RESUMED.get()
+        server_context = tls.build_options(self.settings()).getContext()
+        client_context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+
+        client = connect(server_context, client_context)
+        self.assertEqual('TLSv1.3', client.get_protocol_version_name())
+        connect(server_context, client_context, client.get_session())
+
+        self.assertEqual(full + 1, metrics.TLS_HANDSHAKES_FULL.get())
+        self.assertEqual(resumed + 1, metrics.TLS_HANDSHAKES_RESUMED.get())
+
+    def test_tls_1_2_session_id_resumption(self):
+        resumed = metrics.TLS_HANDSHAKES_RESUMED.get()
+        server_context = tls.build_options(self.settings(LDAP_GATEWAY_TLS_SESSION_TICKETS='false')).getContext()
+        client_context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+        client_context.set_max_proto_version(SSL.TLS1_2_VERSION)
+
+        client = connect(server_context, client_context)
+        connect(server_context, client_context, client.get_session())
+
+        self.assertEqual(resumed + 1, metrics.TLS_HANDSHAKES_RESUMED.get())
+
+    def test_resumption_disabled(self):
+        resumed = metrics.TLS_HANDSHAKES_RESUMED.get()
+        server_context = tls.build_options(self.settings(LDAP_GATEWAY_TLS_SESSION_TICKETS='false',
+                                                         LDAP_GATEWAY_TLS_SESSION_CACHE='false')).getContext()
+        client_context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+
+        client = connect(server_context, client_context)
+        connect(server_context, client_context, client.get_session())
+
+        self.assertEqual(resumed, metrics.TLS_HANDSHAKES_RESUMED.get())
+
+    def test_minimum_version(self):
+        server_context = tls.build_options(self.settings(LDAP_GATEWAY_TLS_MIN_VERSION='1.3')).getContext()
+        client_context = SSL.Context(SSL.TLS_CLIENT_METHOD)
+        client_context.set_max_proto_version(SSL.TLS1_2_VERSION)
+
+        with self.assertRaises(SSL.Error):
+            connect(server_context, client_context)
+
+    def test_invalid_settings(self):
+        for name, value in (('LDAP_GATEWAY_TLS_MIN_VERSION', '1.1'), ('LDAP_GATEWAY_TLS_GROUPS', 'nope')):
+            with self.subTest(name=name), self.assertRaises(ValueError) as raised:
+                tls.build_options(self.settings(**{name: value}))
+            self.assertIn(name, str(raised.exception))
+
+    def test_certificate_chain(self):
+        with open(self.cert_path) as f:
+            pem = f.read()
+        with open(self.cert_path, 'a') as f:
+            f.write(pem)
+
+        key, certificate, chain = tls.load_certificate(self.key_path, self.cert_path)
+        self.assertEqual(1, len(chain))
+        self.assertEqual(certificate.get_subject(), chain[0].get_subject())
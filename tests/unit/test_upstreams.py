@@ -0,0 +1,146 @@
+from twisted.internet import defer, reactor, task
+from twisted.internet.error import ConnectError
+from twisted.trial import unittest
+
+from ldap_otp_gateway import metrics
+from ldap_otp_gateway.ldap_client import build_connector
+from ldap_otp_gateway.upstreams import LEAST_CONNECTIONS, Upstream, UpstreamSet
+from tests.unit.fake_ldap_server import FakeLDAPServerFactory, listen
+
+# nothing listens there
+DEAD_ENDPOINT = 'tcp:127.0.0.1:1'
+
+
+def connection_lost(client) -> defer.Deferred:
+    d = defer.Deferred()
+    client.notify_connection_lost(d.callback)
+    return d
+
+
+class TestUpstreamSet(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clients = []
+        self.addCleanup(self.close_clients)
+
+    def start_server(self):
+        server = FakeLDAPServerFactory()
+        port, endpoint = listen(server)
+        self.addCleanup(port.stopListening)
+        return server, port, endpoint
+
+    def build_set(self, endpoints, weights=None, **kwargs):
+        kwargs.setdefault('reactor', self.clock)
+        weights = weights or [1] * len(endpoints)
+        upstreams = [Upstream(endpoint, build_connector(reactor, endpoint), weight)
+                     for endpoint, weight in zip(endpoints, weights)]
+        return UpstreamSet(upstreams, **kwargs)
+
+    @defer.inlineCallbacks
+    def connect(self, upstream_set):
+        client = yield upstream_set.connect()
+        self.clients.append(client)
+        return client
+
+    def close_clients(self):
+        clients = [client for client in self.clients if client.connected]
+        for client in clients:
+            client.transport.loseConnection()
+        return defer.gatherResults([connection_lost(client) for client in clients])
+
+    @defer.inlineCallbacks
+    def test_failover(self):
+        server, _, endpoint = self.start_server()
+        upstream_set = self.build_set([DEAD_ENDPOINT, endpoint])
+        dead, alive = upstream_set.upstreams
+        ejections = metrics.LDAP_UPSTREAM_EJECTIONS.labels(DEAD_ENDPOINT).get()
+
+        yield self.connect(upstream_set)
+        self.assertEqual(1, server.connections)
+        self.assertFalse(dead.available)
+        self.assertEqual(0, metrics.LDAP_UPSTREAM_UP.labels(DEAD_ENDPOINT).get())
+        self.assertEqual(ejections + 1, metrics.LDAP_UPSTREAM_EJECTIONS.labels(DEAD_ENDPOINT).get())
+        self.assertEqual([alive, dead], upstream_set.candidates())
+
+    @defer.inlineCallbacks
+    def test_failover_order(self):
+        first, _, first_endpoint = self.start_server()
+        second, _, second_endpoint = self.start_server()
+        upstream_set = self.build_set([first_endpoint, second_endpoint])
+        for _ in range(3):
+            yield self.connect(upstream_set)
+        self.assertEqual((3, 0), (first.connections, second.connections))
+
+    @defer.inlineCallbacks
+    def test_all_failing(self):
+        upstream_set = self.build_set([DEAD_ENDPOINT, DEAD_ENDPOINT + '1'])
+        yield self.assertFailure(upstream_set.connect(), ConnectError)
+        self.assertEqual([False, False], [upstream.available for upstream in upstream_set.upstreams])
+        # still tried when all of them are ejected
+        yield self.assertFailure(upstream_set.connect(), ConnectError)
+
+    @defer.inlineCallbacks
+    def test_least_connections(self):
+        first, _, first_endpoint = self.start_server()
+        second, _, second_endpoint = self.start_server()
+        upstream_set = self.build_set([first_endpoint, second_endpoint], weights=[3, 1], policy=LEAST_CONNECTIONS)
+        clients = yield defer.gatherResults([self.connect(upstream_set) for _ in range(8)])
+        self.assertEqual((6, 2), (first.connections, second.connections))
+        self.assertEqual([6, 2], [upstream.connections for upstream in upstream_set.upstreams])
+
+        lost = connection_lost(clients[0])
+        clients[0].transport.loseConnection()
+        yield lost
+        self.assertEqual(7, sum(upstream.connections for upstream in upstream_set.upstreams))
+
+    @defer.inlineCallbacks
+    def test_readmitted_after_ejection_time(self):
+        server, _, endpoint = self.start_server()
+        upstream_set = self.build_set([endpoint, endpoint], ejection_time=30)
+        first = upstream_set.upstreams[0]
+        upstream_set.eject(first)
+        self.clock.advance(29)
+        self.assertEqual(upstream_set.upstreams[1], upstream_set.candidates()[0])
+        self.clock.advance(1)
+        self.assertEqual(first, upstream_set.candidates()[0])
+        self.assertTrue(first.available)
+        yield self.connect(upstream_set)
+
+    @defer.inlineCallbacks
+    def test_health_check_readmits(self):
+        server, _, endpoint = self.start_server()
+        upstream_set = self.build_set([endpoint, endpoint])
+        upstream = upstream_set.upstreams[0]
+        upstream_set.eject(upstream)
+        yield upstream_set.check(upstream)
+        self.assertTrue(upstream.available)
+        self.assertFalse(upstream.checking)
+        # the health check connection is closed, and not counted
+        self.assertEqual(0, upstream.connections)
+
+    @defer.inlineCallbacks
+    def test_health_check_ejects(self):
+        server, port, endpoint = self.start_server()
+        upstream_set = self.build_set([endpoint, DEAD_ENDPOINT])
+        yield port.stopListening()
+        yield upstream_set.check(upstream_set.upstreams[0])
+        self.assertFalse(upstream_set.upstreams[0].available)
+
+    def test_health_checks_scheduled(self):
+        upstream_set = self.build_set([DEAD_ENDPOINT, DEAD_ENDPOINT + '1'], health_check_interval=10)
+        checked = []
+        upstream_set.check = checked.append
+        upstream_set.start()
+        self.addCleanup(upstream_set.stop)
+        self.clock.advance(10)
+        self.assertEqual(upstream_set.upstreams, checked)
+
+    def test_single_upstream_not_checked(self):
+        upstream_set = self.build_set([DEAD_ENDPOINT], health_check_interval=10)
+        upstream_set.start()
+        self.assertIsNone(upstream_set.checker)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.build_set([DEAD_ENDPOINT], policy='random')
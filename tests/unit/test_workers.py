@@ -0,0 +1,171 @@
+import signal
+import socket
+
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from ldap_otp_gateway.workers import WorkerSupervisor, listen_socket
+
+
+class FakeProcess:
+
+    def __init__(self, pid, process_protocol):
+        self.pid = pid
+        self.proto = process_protocol
+        self.signals = []
+        self.ended = False
+
+    def signalProcess(self, signum):
+        if self.ended:
+            raise error.ProcessExitedAlready()
+        self.signals.append(signum)
+
+    def end(self, reason=None):
+        self.ended = True
+        self.proto.processEnded(failure.Failure(reason or error.ProcessDone(0)))
+
+
+class FakeReactor(task.Clock):
+
+    def __init__(self):
+        super().__init__()
+        self.spawned = []
+        self.triggers = []
+        self.stopped = False
+
+    def spawnProcess(self, process_protocol, executable, args, env=None, childFDs=None):
+        process = FakeProcess(1000 + len(self.spawned), process_protocol)
+        process.args = args
+        process.child_fds = childFDs
+        process_protocol.makeConnection(process)
+        self.spawned.append(process)
+        return process
+
+    def addSystemEventTrigger(self, phase, event, callable, *args):
+        self.triggers.append((phase, event, callable))
+
+    def stop(self):
+        self.stopped = True
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.supervisor = WorkerSupervisor(3, [6, 7], restart_delay=1.0, shutdown_timeout=5.0, reactor=self.reactor)
+
+    def test_start_spawns_workers_sharing_the_sockets(self):
+        self.supervisor.start()
+
+        self.assertEqual(3, len(self.reactor.spawned))
+        for index, process in enumerate(self.reactor.spawned):
+            self.assertEqual(['--worker-fds', '6,7', '--worker-index', str(index), '--worker-ready-fd', '8'],
+                             process.args[-6:])
+            self.assertEqual(6, process.child_fds[6])
+            self.assertEqual(7, process.child_fds[7])
+            self.assertEqual('r', process.child_fds[8])
+        self.assertIn(('before', 'shutdown', self.supervisor.stop), self.reactor.triggers)
+
+    def test_dead_worker_restarted(self):
+        self.supervisor.start()
+        self.reactor.spawned[1].end(error.ProcessTerminated(signal=signal.SIGKILL))
+
+        self.assertEqual(3, len(self.reactor.spawned))
+        self.reactor.advance(1.0)
+        self.assertEqual(4, len(self.reactor.spawned))
+        self.assertIs(self.reactor.spawned[3], self.supervisor.processes[1])
+
+    def test_crashing_worker_restart_backoff(self):
+        supervisor = WorkerSupervisor(1, [6, 7], restart_delay=1.0, max_restart_delay=4.0, reactor=self.reactor)
+        supervisor.start()
+
+        delays = []
+        for _ in range(4):
+            self.reactor.spawned[-1].end(error.ProcessTerminated(exitCode=1))
+            [call] = self.reactor.getDelayedCalls()
+            delays.append(call.getTime() - self.reactor.seconds())
+            self.reactor.advance(delays[-1])
+        self.assertEqual([1.0, 2.0, 4.0, 4.0], delays)
+
+        # a worker running long enough starts over from the shortest delay
+        self.reactor.advance(supervisor.healthy_uptime)
+        self.reactor.spawned[-1].end(error.ProcessTerminated(exitCode=1))
+        [call] = self.reactor.getDelayedCalls()
+        self.assertEqual(1.0, call.getTime() - self.reactor.seconds())
+
+    def test_crashing_worker_given_up(self):
+        supervisor = WorkerSupervisor(2, [6, 7], max_restarts=2, reactor=self.reactor)
+        supervisor.start()
+
+        for _ in range(2):
+            self.reactor.spawned[-1].end(error.ProcessTerminated(exitCode=1))
+            self.reactor.advance(supervisor.max_restart_delay)
+        self.assertFalse(self.reactor.stopped)
+        self.assertEqual(4, len(self.reactor.spawned))
+
+        self.reactor.spawned[-1].end(error.ProcessTerminated(exitCode=1))
+        self.assertTrue(self.reactor.stopped)
+        self.assertTrue(supervisor.failed)
+        self.assertEqual([], self.reactor.getDelayedCalls())
+
+    def test_stop_terminates_workers(self):
+        self.supervisor.start()
+        d = self.supervisor.stop()
+
+        for process in self.reactor.spawned:
+            self.assertEqual([signal.SIGTERM], process.signals)
+        for process in self.reactor.spawned:
+            process.end()
+        self.assertIsNone(self.successResultOf(d))
+
+        # stopped workers are not restarted
+        self.reactor.advance(1.0)
+        self.assertEqual(3, len(self.reactor.spawned))
+
+    def test_reload_forwarded_to_workers(self):
+        supervisor = WorkerSupervisor(2, [6, 7], extra_args=['--load-dotenv'], reactor=self.reactor)
+        supervisor.start()
+        for process in self.reactor.spawned:
+            process.proto.childDataReceived(8, b'ready')
+        supervisor.reload()
+
+        for process in self.reactor.spawned:
+            self.assertEqual('--load-dotenv', process.args[-1])
+            self.assertEqual([signal.SIGHUP], process.signals)
+
+    def test_reload_held_until_worker_ready(self):
+        self.supervisor.start()
+        ready, starting, _ = self.reactor.spawned
+        ready.proto.childDataReceived(8, b'ready')
+        self.supervisor.reload()
+        self.supervisor.reload()
+
+        self.assertEqual([signal.SIGHUP, signal.SIGHUP], ready.signals)
+        # the SIGHUP would kill a worker which didn't install its handler yet
+        self.assertEqual([], starting.signals)
+        starting.proto.childDataReceived(8, b'ready')
+        self.assertEqual([signal.SIGHUP], starting.signals)
+
+    def test_stop_kills_workers_after_timeout(self):
+        self.supervisor.start()
+        d = self.supervisor.stop()
+        self.reactor.spawned[0].end()
+
+        self.reactor.advance(5.0)
+
+        self.assertEqual([signal.SIGTERM], self.reactor.spawned[0].signals)
+        self.assertEqual([signal.SIGTERM, signal.SIGKILL], self.reactor.spawned[1].signals)
+        self.assertEqual([signal.SIGTERM, signal.SIGKILL], self.reactor.spawned[2].signals)
+        self.successResultOf(d)
+
+
+class TestListenSocket(unittest.TestCase):
+
+    def test_inheritable_listening_socket(self):
+        sock = listen_socket(0, interface='127.0.0.1')
+        self.addCleanup(sock.close)
+
+        self.assertTrue(sock.get_inheritable())
+        client = socket.create_connection(sock.getsockname())
+        self.addCleanup(client.close)